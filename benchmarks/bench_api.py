@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+"""
+Measures requests/sec of the JSON API with 1, 16 and 128 concurrent pollers.
+
+Compares wsgiref's single-threaded server (api threads = 0), which serves one
+request per connection, against the ThreadPoolWSGIServer, where each poller
+keeps its connection open between requests.  Every poller repeatedly asks
+for the latest emails of a sender, the way test workers poll for an email
+they are waiting on.  Runs against a throwaway database in a temp directory.
+
+Usage:
+    python benchmarks/bench_api.py [--pollers 1,16,128] [--requests 200] [--threads 16]
+                                   [--emails 5000]
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smtpy_config as config
+import smtpy_db
+
+
+def seed(database, count):
+    conn = smtpy_db.connect(database)
+    with conn:
+        smtpy_db.insert_mails(conn,
+                              [('127.0.0.1', 1234, 'Welcome %d' % i, 'sender%d@app.local' % (i % 50),
+                                str(['user%d@app.local' % i]), 'Hello\n' * 20)
+                               for i in range(count)])
+    conn.close()
+
+
+def start_api(threads):
+    import bottle
+    import smtpy_api
+
+    server = smtpy_api.MyWSGIRefServer(host='127.0.0.1', port=0, threads=threads)
+    thread = threading.Thread(target=bottle.run, kwargs=dict(server=server, quiet=True), daemon=True)
+    thread.start()
+    while server.server is None:
+        time.sleep(0.01)
+
+    def stop():
+        server.stop()
+        thread.join()
+        if threads <= 0:
+            server.server.server_close()
+
+    return server.server.server_port, stop
+
+
+def poller(port, requests, keep_alive, latencies, errors, timeout):
+    conn = None
+    for i in range(requests):
+        started = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            conn.request('GET', '/retrieve/emails?email=sender%d@app.local&amount=5' % (i % 50))
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise http.client.HTTPException(response.status)
+            if not keep_alive or response.will_close:
+                conn.close()
+                conn = None
+            latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--pollers', default='1,16,128')
+    parser.add_argument('--requests', type=int, default=200, help='requests per poller')
+    parser.add_argument('--threads', type=int, default=config.settings['api']['threads'])
+    parser.add_argument('--emails', type=int, default=5000)
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds before a request is counted as an error')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.settings['database'] = os.path.join(tmp, 'smtpy.db')
+        smtpy_db.create_schema(config.settings['database'])
+        seed(config.settings['database'], args.emails)
+
+        print('%d requests per poller, %d emails in the database' % (args.requests, args.emails))
+        print('%-22s %8s %12s %10s %10s %8s' % ('server', 'pollers', 'requests/s', 'p50 ms', 'p99 ms', 'errors'))
+        for name, threads in (('single-threaded', 0), ('threaded keep-alive', args.threads)):
+            for pollers in [int(p) for p in args.pollers.split(',')]:
+                port, stop = start_api(threads)
+                latencies = []
+                errors = []
+                workers = [threading.Thread(target=poller, args=(port, args.requests, threads > 0,
+                                                                 latencies, errors, args.timeout))
+                           for _ in range(pollers)]
+                started = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - started
+                stop()
+                print('%-22s %8d %12.1f %10.2f %10.2f %8d' % (
+                    name, pollers, len(latencies) / elapsed,
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 99) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
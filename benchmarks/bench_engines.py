@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+"""
+Compares the asyncore (smtpdutf8) and asyncio (smtpdasync) SMTP engines.
+
+Each engine is started on an ephemeral localhost port with a server that
+discards every message, and is then driven by a number of concurrent client
+sessions (EHLO, MAIL, RCPT, DATA, QUIT).  Reports sessions/sec and the
+p50/p99 session latency for each engine.  Sessions that do not complete
+within --timeout seconds (e.g. connections the asyncore engine's listen
+backlog dropped) are counted as errors.
+
+Usage:
+    python benchmarks/bench_engines.py [--sessions N] [--concurrency C] [--size BYTES]
+                                       [--recipients N] [--pipelining]
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smtpdasync
+
+
+class NullAsyncioServer(smtpdasync.SMTPServer):
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        return
+
+
+def start_asyncio():
+    server = NullAsyncioServer(('127.0.0.1', 0), None, decode_data=False)
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return port, server.close
+
+
+def start_asyncore():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import asyncore
+        import smtpdutf8
+
+    class NullAsyncoreServer(smtpdutf8.SMTPServer):
+        def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+            return
+
+    socket_map = {}
+    server = NullAsyncoreServer(('127.0.0.1', 0), None, map=socket_map,
+                                decode_data=False)
+    port = server.socket.getsockname()[1]
+    stopping = threading.Event()
+
+    def loop():
+        while not stopping.is_set() and socket_map:
+            asyncore.loop(timeout=0.05, map=socket_map, count=1)
+
+    def stop():
+        stopping.set()
+        thread.join()
+        asyncore.close_all(map=socket_map)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return port, stop
+
+
+async def read_reply(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by server')
+        if line[3:4] != b'-':
+            return line
+
+
+async def session(port, body, recipients, pipelining):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        await read_reply(reader)
+        writer.write(b'EHLO bench\r\n')
+        await read_reply(reader)
+        commands = [b'MAIL FROM:<from@bench.local>\r\n']
+        commands.extend(b'RCPT TO:<to%d@bench.local>\r\n' % i for i in range(recipients))
+        commands.append(b'DATA\r\n')
+        if pipelining:
+            # RFC 2920: send the whole envelope, then read all of the replies
+            writer.write(b''.join(commands))
+            for _ in commands:
+                await read_reply(reader)
+        else:
+            for command in commands:
+                writer.write(command)
+                await read_reply(reader)
+        writer.write(body)
+        reply = await read_reply(reader)
+        if not reply.startswith(b'250'):
+            raise ConnectionError(reply.decode('ascii', 'replace'))
+        writer.write(b'QUIT\r\n')
+        await read_reply(reader)
+    finally:
+        writer.close()
+
+
+async def drive(port, sessions, concurrency, body, timeout, recipients=1, pipelining=False):
+    latencies = []
+    errors = 0
+    remaining = iter(range(sessions))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(session(port, body, recipients, pipelining), timeout)
+                latencies.append(time.perf_counter() - started)
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies, errors
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def make_body(size):
+    line = b'The quick brown fox jumps over the lazy dog 0123456789.\r\n'
+    body = b'Subject: bench\r\n\r\n' + line * max(1, size // len(line))
+    return body + b'.\r\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds before a session is counted as an error')
+    parser.add_argument('--recipients', type=int, default=1)
+    parser.add_argument('--pipelining', action='store_true',
+                        help='send MAIL, RCPT and DATA in one write (RFC 2920)')
+    parser.add_argument('--engine', choices=('asyncore', 'asyncio', 'both'), default='both')
+    args = parser.parse_args()
+
+    engines = [('asyncore', start_asyncore), ('asyncio', start_asyncio)]
+    if args.engine != 'both':
+        engines = [e for e in engines if e[0] == args.engine]
+
+    body = make_body(args.size)
+    print('%d sessions, %d concurrent, %d byte bodies, %d recipients%s' % (
+        args.sessions, args.concurrency, len(body), args.recipients,
+        ', pipelined' if args.pipelining else ''))
+    print('%-10s %12s %10s %10s %8s' % ('engine', 'sessions/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name, start in engines:
+        port, stop = start()
+        try:
+            elapsed, latencies, errors = asyncio.run(
+                drive(port, args.sessions, args.concurrency, body, args.timeout,
+                      args.recipients, args.pipelining))
+        finally:
+            stop()
+        print('%-10s %12.1f %10.2f %10.2f %8d' % (
+            name, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+"""
+Measures messages/sec on the SQLite ingest path used by MockSmtpServer.
+
+Compares the old approach of opening a new connection per email (with a
+separate commit for the insert and for the old per-email purge) against
+the long-lived smtpy_db.MailWriter committing once per email, and against
+its queue which group-commits batches of emails.  The writer no longer
+purges, that is done by smtpy_db.MailSweeper in the background.  Runs
+against a throwaway database in a temp directory, and reports the size of
+the database file afterwards; with --compress-threshold the bodies are
+compressed as MockSmtpServer would.
+
+Usage:
+    python benchmarks/bench_ingest.py [--messages N] [--body-size BYTES] [--no-purge]
+                                      [--compress-threshold BYTES] [--compress-level 6]
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smtpy_db
+
+
+def ingest_connect_per_message(database, rows, purge):
+    for row in rows:
+        conn = smtpy_db.connect(database)
+        with conn:
+            smtpy_db.insert_mails(conn, [row])
+        if purge:
+            cutoff = int((time.time() - 30 * 60) * 1000)
+            conn.execute('DELETE FROM MailLog WHERE TimeStamp < ?', (cutoff,))
+            conn.commit()
+        conn.close()
+
+
+def ingest_mail_writer(database, rows, purge):
+    writer = smtpy_db.MailWriter(database)
+    try:
+        for row in rows:
+            writer.write_batch((row,))
+    finally:
+        writer.close()
+
+
+def ingest_group_commit(database, rows, purge):
+    writer = smtpy_db.MailWriter(database)
+    writer.start()
+    for row in rows:
+        writer.put(row)
+    writer.stop()
+    print('  queue high-water mark: %d' % writer.high_water_mark)
+
+
+# Bodies are a templated email, as most are
+def make_rows(count, body_size, threshold, level):
+    line = 'Hello user%d, to reset your password click https://app.local/reset?token=%08x\n'
+    return [smtpy_db.compress_row(
+                ('127.0.0.1', 40000 + i % 20000, 'Password reset %d' % i,
+                 'noreply@app.local', str(['user%d@app.local' % i]),
+                 ''.join(line % (i, i * 7919 + n) for n in range(max(1, body_size // len(line))))),
+                threshold, level)
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--body-size', type=int, default=2048)
+    parser.add_argument('--no-purge', action='store_true',
+                        help='leave out the per-email purge of the old approach')
+    parser.add_argument('--compress-threshold', type=int, default=0,
+                        help='compress bodies of at least this many bytes (0 for never)')
+    parser.add_argument('--compress-level', type=int, default=6)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = make_rows(args.messages, args.body_size, args.compress_threshold, args.compress_level)
+    prepared = time.perf_counter() - started
+    purge = not args.no_purge
+    print('%d messages, %d byte bodies, purge %s' % (args.messages, args.body_size, 'on' if purge else 'off'))
+    if args.compress_threshold > 0:
+        print('compressed bodies of %d+ bytes at level %d: %.1f msgs/s' % (
+            args.compress_threshold, args.compress_level, len(rows) / prepared))
+    print('%-22s %12s %10s' % ('ingest', 'msgs/s', 'db KB'))
+
+    for name, ingest in (('connect-per-message', ingest_connect_per_message),
+                         ('mail-writer', ingest_mail_writer),
+                         ('group-commit', ingest_group_commit)):
+        with tempfile.TemporaryDirectory() as tmp:
+            database = os.path.join(tmp, 'smtpy.db')
+            smtpy_db.create_schema(database)
+            started = time.perf_counter()
+            ingest(database, rows, purge)
+            elapsed = time.perf_counter() - started
+            size = sum(os.path.getsize(database + suffix) for suffix in ('', '-wal')
+                       if os.path.exists(database + suffix))
+        print('%-22s %12.1f %10d' % (name, len(rows) / elapsed, size // 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+"""
+Micro-benchmark of DATA reception: asynchat's terminator search followed by
+the old join/split/unstuff pass, against smtpdsession's incremental scanner.
+
+Bodies of 1 KB up to 32 MB are fed in to each in a few different chunk
+sizes, and the best throughput in MB/s of a few rounds is reported.  No
+sockets are involved, and the SMTP commands and replies around the message
+are left out, so this only measures the work done on the received bytes.
+Smaller bodies are received many times over in each round, so their timings
+aren't lost in the noise.
+
+Bodies have a dot-stuffed line every ten lines, unless --no-dots is given;
+most real emails have none.
+
+Usage:
+    python benchmarks/bench_terminator.py [--sizes 1K,64K,1M,8M,32M] [--chunks 1460,16384,65536]
+                                          [--rounds 3] [--no-dots]
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import sys
+import time
+import argparse
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smtpdasync
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 * 1024}
+    value = value.strip().upper()
+    if value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+def make_body(size, dots=True):
+    # Mostly plain text, with the odd dot-stuffed line
+    lines = [b'The quick brown fox jumps over the lazy dog 0123456789',
+             b'..dot-stuffed line' if dots else b'not a dot-stuffed line',
+             b'<p>Some HTML template text, repeated over and over</p>']
+    body = []
+    total = 0
+    i = 0
+    while total < size:
+        line = lines[0] if i % 10 else lines[1 + (i // 10) % 2]
+        body.append(line)
+        total += len(line) + 2
+        i += 1
+    return b'\r\n'.join(body) + b'\r\n.\r\n'
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+# How many times a body is received, so that about 32 MB is received in all
+def repeats(size):
+    return max(1, 32 * 1024 * 1024 // size)
+
+
+def run_legacy(chunks, repeat=1):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import asynchat
+
+    class LegacyChannel(asynchat.async_chat):
+        def __init__(self):
+            asynchat.async_chat.__init__(self)
+            self.set_terminator(b'\r\n.\r\n')
+            self.received_lines = []
+            self.result = None
+
+        def recv(self, buffer_size):
+            return self.pending
+
+        def collect_incoming_data(self, data):
+            self.received_lines.append(data)
+
+        def found_terminator(self):
+            line = b''.join(self.received_lines)
+            self.received_lines = []
+            data = []
+            for text in line.split(b'\r\n'):
+                if text and text[0] == 46:
+                    data.append(text[1:])
+                else:
+                    data.append(text)
+            self.result = b'\n'.join(data)
+
+    channel = LegacyChannel()
+    elapsed = 0
+    for i in range(repeat):
+        started = time.perf_counter()
+        for chunk in chunks:
+            channel.pending = chunk
+            channel.handle_read()
+        elapsed += time.perf_counter() - started
+    return elapsed, channel.result
+
+
+class NullTransport:
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 0)
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class NullServer:
+    data_size_limit = 0
+    enable_SMTPUTF8 = False
+    _decode_data = False
+    data_spool_size = 64 * 1024 * 1024
+    stream_data = False
+
+    def __init__(self):
+        self._sessions = set()
+        self.result = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.result = data
+
+
+# Scans chunks as the session does once DATA has been accepted, taking the
+# message as the old channel did: without the command handling, delivery and
+# reply around it, which are the same either way
+def run_scanner(chunks, repeat=1):
+    server = NullServer()
+    session = smtpdasync.SMTPProtocol(server)
+    session.connection_made(NullTransport())
+    session.data_received(b'HELO bench\r\nMAIL FROM:<a@bench>\r\nRCPT TO:<b@bench>\r\n')
+    elapsed = 0
+    for i in range(repeat):
+        session._open_data_file()
+        started = time.perf_counter()
+        for chunk in chunks:
+            if session._scan_data(chunk) is not None:
+                break
+        server.result = session._message_data()
+        elapsed += time.perf_counter() - started
+        session._close_data_file()
+    return elapsed, server.result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='1K,64K,1M,8M,32M')
+    parser.add_argument('--chunks', default='1460,16384,65536')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--no-dots', action='store_true')
+    args = parser.parse_args()
+
+    print('%8s %8s %14s %14s %8s' % ('body', 'chunk', 'asynchat MB/s', 'scanner MB/s', 'speedup'))
+    for size in [parse_size(s) for s in args.sizes.split(',')]:
+        body = make_body(size, not args.no_dots)
+        for chunk_size in [parse_size(c) for c in args.chunks.split(',')]:
+            chunks = chunked(body, chunk_size)
+            repeat = repeats(len(body))
+            legacy = scanner = None
+            for i in range(max(1, args.rounds)):
+                elapsed, legacy_result = run_legacy(chunks, repeat)
+                legacy = elapsed if legacy is None else min(legacy, elapsed)
+                elapsed, scanner_result = run_scanner(chunks, repeat)
+                scanner = elapsed if scanner is None else min(scanner, elapsed)
+                if legacy_result != scanner_result:
+                    raise SystemExit('results differ for %d byte body' % len(body))
+            mb = len(body) * repeat / (1024.0 * 1024.0)
+            print('%8d %8d %14.1f %14.1f %7.1fx' % (
+                len(body), chunk_size, mb / legacy, mb / scanner, legacy / scanner))
+
+
+if __name__ == '__main__':
+    main()
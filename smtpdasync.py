@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+"""An asyncio based SMTP server engine.
+
+This is a drop-in alternative to smtpdutf8.SMTPServer that runs each client
+connection as an asyncio Protocol on a single event loop, instead of an
+asyncore/asynchat channel polled via select().  The event loop uses the best
+selector the platform has (epoll, kqueue, IOCP), so it is not bound by
+FD_SETSIZE and is able to hold thousands of concurrent sessions.  It also
+keeps working on Python 3.12+ where asyncore and asynchat no longer exist.
+
+The SMTP conversation itself is handled by smtpdsession.SMTPSession, the same
+state machine the asyncore engine uses, and servers implement the same
+process_message(peer, mailfrom, rcpttos, data, **kwargs) hook.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import time
+import asyncio
+from warnings import warn
+import smtpdsession
+from smtpdsession import (SMTPSession, DATA_SIZE_DEFAULT,
+                          DATA_SPOOL_SIZE_DEFAULT)
+
+__all__ = ["SMTPProtocol", "SMTPServer"]
+
+
+class SMTPProtocol(SMTPSession, asyncio.Protocol):
+
+    def __init__(self, server):
+        self.transport = None
+        self.peer = None
+        self._server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self._init_session(self._server,
+                           self._server.data_size_limit,
+                           self._server.enable_SMTPUTF8,
+                           self._server._decode_data)
+        self._server._sessions.add(self)
+        self._greet()
+
+    def connection_lost(self, exc):
+        self._server._sessions.discard(self)
+        self.transport = None
+        self._in_buffer = b''
+        self._close_data_file()
+
+    def data_received(self, data):
+        self.feed(data)
+
+    # Session transport hooks
+    def _write(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def close_when_done(self):
+        # Closing an asyncio transport flushes whatever is still buffered.
+        if self.transport is not None:
+            self.transport.close()
+
+
+class SMTPServer:
+    # SMTPProtocol class to use for managing client connections
+    protocol_class = SMTPProtocol
+    # Size at which a message being received spills from memory to disk
+    data_spool_size = DATA_SPOOL_SIZE_DEFAULT
+    # Pass process_message the spooled message file, rather than its contents
+    stream_data = False
+    # Pass process_message the message with the CRLF line endings it was sent
+    # with, rather than turning them into LF
+    keep_crlf = False
+
+    def __init__(self, localaddr, remoteaddr,
+                 data_size_limit=DATA_SIZE_DEFAULT, map=None,
+                 enable_SMTPUTF8=False, decode_data=None, backlog=100,
+                 reuse_port=False, sock=None):
+        self._localaddr = localaddr
+        self._remoteaddr = remoteaddr
+        self.data_size_limit = data_size_limit
+        self.enable_SMTPUTF8 = enable_SMTPUTF8
+        if enable_SMTPUTF8:
+            if decode_data:
+                raise ValueError("The decode_data and enable_SMTPUTF8"
+                                 " parameters cannot be set to True at the"
+                                 " same time.")
+            decode_data = False
+        if decode_data is None:
+            warn("The decode_data default of True will change to False in 3.6;"
+                 " specify an explicit value for this keyword",
+                 DeprecationWarning, 2)
+            decode_data = True
+        self._decode_data = decode_data
+        self._sessions = set()
+
+        # Bind straight away, so that errors surface from the constructor
+        # just as they do for the asyncore engine.  With reuse_port, several
+        # processes can each bind the same address and the kernel spreads
+        # connections across them; alternatively an already listening sock
+        # (eg: one shared with other processes) can be served instead.
+        self._loop = asyncio.new_event_loop()
+        try:
+            if sock is not None:
+                create = self._loop.create_server(
+                    lambda: self.protocol_class(self), sock=sock,
+                    backlog=backlog)
+            else:
+                create = self._loop.create_server(
+                    lambda: self.protocol_class(self),
+                    localaddr[0], localaddr[1], reuse_address=True,
+                    reuse_port=reuse_port or None, backlog=backlog)
+            self._server = self._loop.run_until_complete(create)
+        except:
+            self._loop.close()
+            raise
+        print('%s started at %s\n\tLocal addr: %s\n\tRemote addr:%s' % (
+            self.__class__.__name__, time.ctime(time.time()),
+            localaddr, remoteaddr), file=smtpdsession.DEBUGSTREAM)
+
+    @property
+    def sockets(self):
+        return self._server.sockets
+
+    def serve_forever(self):
+        """Run the event loop until close() is called."""
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            for session in list(self._sessions):
+                if session.transport is not None:
+                    session.transport.abort()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    def close(self):
+        """Stop serving; this is safe to call from any thread."""
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    # API for "doing something useful with the message"
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        """Override this abstract method to handle messages from the client.
+
+        The arguments, and the expected return value, are exactly the same as
+        for smtpdutf8.SMTPServer.process_message.
+        """
+        raise NotImplementedError
@@ -0,0 +1,752 @@
+#! /usr/bin/env python3
+"""Transport independent RFC 5321 session state machine.
+
+This holds the SMTP command and DATA handling that used to live directly in
+smtpdutf8.SMTPChannel, so that it can be shared between the asyncore engine
+(smtpdutf8) and the asyncio engine (smtpdasync).  Neither asyncore nor
+asynchat are imported here, so this module keeps working on Python 3.12+.
+
+A concrete session must supply the transport methods:
+
+    _write(data)        queue the given bytes for sending to the client
+    close_when_done()   close the connection once all queued data is sent
+
+and pass everything it receives from the client to feed().
+"""
+
+import io
+import re
+import socket
+import tempfile
+import collections
+from warnings import warn
+from email._header_value_parser import get_addr_spec, get_angle_addr
+
+__all__ = ["SMTPSession", "DATA_SIZE_DEFAULT", "DATA_SPOOL_SIZE_DEFAULT"]
+
+__version__ = 'Python SMTP proxy version 0.3'
+
+
+class Devnull:
+    def write(self, msg): pass
+    def flush(self): pass
+
+
+DEBUGSTREAM = Devnull()
+NEWLINE = '\n'
+DATA_SIZE_DEFAULT = 33554432
+# DATA is received into a buffer that moves from memory to a temporary file
+# once it grows past this many bytes.
+DATA_SPOOL_SIZE_DEFAULT = 1048576
+DATA_TERMINATOR = b'\r\n.\r\n'
+# A line starting with a dot, which is either the terminator or dot-stuffed
+DATA_DOT_LINE = DATA_TERMINATOR[:3]
+# What can be carried over between chunks as the start of a terminator
+DATA_TERMINATOR_STARTS = tuple(DATA_TERMINATOR[:size] for size in (4, 3, 2, 1))
+# Sizes given to MAIL (SIZE=) and BDAT are ASCII digits.  str.isdigit() also
+# accepts other digits, such as '\u00b2', which int() then fails on.
+SIZE_DIGITS = re.compile(r'[0-9]+')
+
+
+class DataSpool:
+    """The buffer a message is received into.
+
+    Written bytes are kept as a list of chunks until there are more than
+    max_size of them (0 for no limit), then moved to a temporary file.  Most
+    messages are small and never get that far, and for those this costs no
+    more than the list, unlike tempfile.SpooledTemporaryFile."""
+
+    __slots__ = ('max_size', 'size', 'chunks', 'file')
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        self.file = None
+
+    def write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.file = tempfile.TemporaryFile()
+            self.file.writelines(self.chunks)
+            self.chunks = None
+
+    def getvalue(self):
+        """Return everything written, as one bytes object."""
+        if self.file is None:
+            # Joined once, so asking again (or for the file) copies nothing
+            if len(self.chunks) > 1:
+                self.chunks = [b''.join(self.chunks)]
+            return self.chunks[0] if self.chunks else b''
+        self.file.seek(0)
+        return self.file.read()
+
+    def getfile(self):
+        """Return a binary file of everything written, positioned at its
+        start.  It is only valid until the spool is closed.
+
+        A spool still in memory gives a BytesIO sharing its bytes, and one
+        that has moved to its temporary file gives that file, which is
+        never read back into memory here."""
+        if self.file is None:
+            return io.BytesIO(self.getvalue())
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.chunks = None
+
+
+class SMTPSession:
+    COMMAND = 0
+    DATA = 1
+    BDAT = 2
+
+    command_size_limit = 512
+    command_size_limits = collections.defaultdict(lambda x=command_size_limit: x)
+
+    @property
+    def max_command_size_limit(self):
+        try:
+            return max(self.command_size_limits.values())
+        except ValueError:
+            return self.command_size_limit
+
+    def _init_session(self, server, data_size_limit=DATA_SIZE_DEFAULT,
+                      enable_SMTPUTF8=False, decode_data=None):
+        """Set up the per-session state; called from the transport's init."""
+        self.smtp_server = server
+        self.data_size_limit = data_size_limit
+        self.enable_SMTPUTF8 = enable_SMTPUTF8
+        if enable_SMTPUTF8:
+            if decode_data:
+                ValueError("decode_data and enable_SMTPUTF8 cannot be set to"
+                           " True at the same time")
+            decode_data = False
+        if decode_data is None:
+            warn("The decode_data default of True will change to False in 3.6;"
+                 " specify an explicit value for this keyword",
+                 DeprecationWarning, 3)
+            decode_data = True
+        self._decode_data = decode_data
+        self.data_spool_size = getattr(server, 'data_spool_size',
+                                       DATA_SPOOL_SIZE_DEFAULT)
+        self.keep_crlf = getattr(server, 'keep_crlf', False)
+        self.data_file = None
+        self._in_buffer = b''
+        self._replies = None
+        self.quitting = False
+        if decode_data:
+            self._emptystring = ''
+            self._linesep = '\r\n'
+            self._dotsep = '.'
+            self._newline = NEWLINE
+        else:
+            self._emptystring = b''
+            self._linesep = b'\r\n'
+            self._dotsep = ord(b'.')
+            self._newline = b'\n'
+        self._set_rset_state()
+        self.seen_greeting = ''
+        self.extended_smtp = False
+        # Per session, as EHLO grows these limits and many sessions can be
+        # open on the one event loop at the same time.
+        self.command_size_limits = collections.defaultdict(
+            lambda x=self.command_size_limit: x)
+        self.fqdn = socket.getfqdn()
+
+    def _greet(self):
+        print('Peer:', repr(self.peer), file=DEBUGSTREAM)
+        self.push('220 %s %s' % (self.fqdn, __version__))
+
+    def _set_post_data_state(self):
+        """Reset state variables to their post-DATA state."""
+        self.smtp_state = self.COMMAND
+        self.mailfrom = None
+        self.rcpttos = []
+        self.require_SMTPUTF8 = False
+        self.num_bytes = 0
+        self.mail_body = '7BIT'
+        self._bdat_size = self._bdat_remaining = 0
+        self._bdat_received = 0
+        self._bdat_last = False
+        self._bdat_error = None
+        self._close_data_file()
+
+    def _set_rset_state(self):
+        """Reset all state variables except the greeting."""
+        self._set_post_data_state()
+        self.received_data = ''
+        self.received_lines = []
+
+    def _open_data_file(self):
+        self._close_data_file()
+        self.data_file = DataSpool(self.data_spool_size)
+        # The line ending of the DATA command itself is where the first
+        # line of the message starts, so the scanner begins as though it has
+        # just seen a CRLF that is not part of the message.
+        self._data_tail = b'\r\n'
+        self._data_virtual_crlf = True
+        self._data_kept = []
+        self._data_kept_size = 0
+        self._data_stuffed = False
+
+    def _close_data_file(self):
+        data_file, self.data_file = getattr(self, 'data_file', None), None
+        if data_file is not None:
+            data_file.close()
+
+    def push(self, msg):
+        reply = bytes(
+            msg + '\r\n', 'utf-8' if self.require_SMTPUTF8 else 'ascii')
+        if self._replies is not None:
+            self._replies.append(reply)
+        else:
+            self._write(reply)
+
+    def _flush_replies(self):
+        replies = self._replies
+        if replies:
+            self._replies = []
+            self._write(b''.join(replies))
+
+    def feed(self, data):
+        """Process bytes received from the client.
+
+        Commands are split on CRLF and passed through collect_incoming_data()
+        and found_terminator(), as asynchat would.  DATA goes through
+        _scan_data() instead, which searches each chunk once as it arrives.
+
+        Replies to all of the commands in data are held back and sent in a
+        single write once it has been processed, so that a client using
+        PIPELINING (RFC 2920) gets its batch of replies back together."""
+        self._replies = []
+        try:
+            self._feed(data)
+        finally:
+            self._flush_replies()
+            self._replies = None
+
+    def _feed(self, data):
+        buf = self._in_buffer + data
+        self._in_buffer = b''
+        while buf and not self.quitting:
+            if self.smtp_state == self.BDAT:
+                buf = self._read_chunk(buf)
+                continue
+            if self.smtp_state == self.DATA:
+                end = self._scan_data(buf)
+                if end is None:
+                    return
+                buf = buf[end:]
+                self._end_data()
+                continue
+            index = buf.find(b'\r\n')
+            if index == -1:
+                # Keep a trailing CR, in case the LF is in the next chunk
+                if buf.endswith(b'\r'):
+                    buf, self._in_buffer = buf[:-1], b'\r'
+                if buf:
+                    self.collect_incoming_data(buf)
+                return
+            if index > 0:
+                self.collect_incoming_data(buf[:index])
+            buf = buf[index + 2:]
+            self.found_terminator()
+
+    def _scan_data(self, data):
+        """Incrementally scan DATA for the <CRLF>.<CRLF> terminator.
+
+        Each chunk is searched once for the terminator.  If it is not there,
+        the longest tail of the chunk that could be the start of it (at most
+        four bytes) is carried over to the next chunk, and everything before
+        that is kept as received.  So apart from those few bytes, nothing is
+        ever searched twice.  What has been kept is only unstuffed and
+        written to the spool once the terminator is found, or once there is
+        more than data_spool_size of it, so a message that fits in memory is
+        unstuffed in one pass however many chunks it arrived in.
+
+        Returns the offset into data just past the terminator, or None if
+        the terminator has not been seen yet."""
+        self.num_bytes += len(data)
+        tail = self._data_tail
+        if tail:
+            data = tail + data
+        skip = len(tail)
+        # Usually the first line starting with a dot is the terminator, and
+        # then there are no dot-stuffed lines to undo
+        index = data.find(DATA_DOT_LINE)
+        if index != -1 and not data.startswith(DATA_TERMINATOR, index):
+            self._data_stuffed = True
+            index = data.find(DATA_TERMINATOR, index)
+        if index != -1:
+            # The CRLF that starts the terminator ends the message's last line
+            end = index + 2 if self.keep_crlf else index
+            if self._data_kept:
+                self._keep_data(data[:end])
+                self._flush_data()
+            elif end:
+                self._write_data(data[:end])
+            self._data_tail = b''
+            self.num_bytes -= len(data) - index - len(DATA_TERMINATOR)
+            return index + len(DATA_TERMINATOR) - skip
+        hold = len(data)
+        for start in DATA_TERMINATOR_STARTS:
+            if data.endswith(start):
+                hold -= len(start)
+                break
+        self._keep_data(data[:hold])
+        self._data_tail = data[hold:]
+        # Past the size limit, _write_data() drops what is kept
+        if (self._data_kept_size > self.data_spool_size or
+                self.data_size_limit and self.num_bytes > self.data_size_limit):
+            self._flush_data()
+        return None
+
+    def _keep_data(self, data):
+        if data:
+            self._data_kept.append(data)
+            self._data_kept_size += len(data)
+
+    def _flush_data(self):
+        kept = self._data_kept
+        if kept:
+            self._data_kept = []
+            self._data_kept_size = 0
+            self._write_data(kept[0] if len(kept) == 1 else b''.join(kept))
+            self._data_stuffed = False
+
+    def _write_data(self, data):
+        """Write scanned DATA to the spool, undoing the dot transparency and
+        (unless keep_crlf is set) line endings according to RFC 5321, Section
+        4.5.2.  data never ends part way through a CRLF, or a CRLF and the dot
+        after it."""
+        if self.data_size_limit and self.num_bytes > self.data_size_limit:
+            return
+        # Splitting and joining is quicker than bytes.replace() for these
+        if self._data_stuffed:
+            data = b'\r\n'.join(data.split(DATA_DOT_LINE))
+        if self.keep_crlf:
+            if self._data_virtual_crlf:
+                self._data_virtual_crlf = False
+                data = data[2:]
+            self.data_file.write(data)
+            return
+        lines = data.split(b'\r\n')
+        if self._data_virtual_crlf:
+            self._data_virtual_crlf = False
+            del lines[0]
+        self.data_file.write(b'\n'.join(lines))
+
+    def _read_chunk(self, data):
+        """Read the next part of a BDAT chunk straight into the spool.
+
+        The chunk's exact size is known up front, so there is no terminator
+        to search for and no dot transparency to undo.  Returns whatever
+        follows the chunk in data."""
+        size = min(self._bdat_remaining, len(data))
+        if size:
+            self._bdat_remaining -= size
+            if self._bdat_error is None:
+                self.num_bytes += size
+                if not (self.data_size_limit and
+                        self.num_bytes > self.data_size_limit):
+                    self._write_chunk(data[:size])
+        if not self._bdat_remaining:
+            self._end_chunk()
+        return data[size:]
+
+    def _write_chunk(self, data, final=False):
+        if self.mail_body == 'BINARYMIME' or self.keep_crlf:
+            self.data_file.write(data)
+            return
+        # Text bodies get the same CRLF to LF conversion as DATA, holding
+        # back a trailing CR in case its LF starts the next chunk.
+        data = self._data_tail + data
+        self._data_tail = b''
+        if not final and data.endswith(b'\r'):
+            data, self._data_tail = data[:-1], b'\r'
+        self.data_file.write(data.replace(b'\r\n', b'\n'))
+
+    def _end_chunk(self):
+        self.smtp_state = self.COMMAND
+        if self._bdat_error is not None:
+            self.push(self._bdat_error)
+            self._bdat_error = None
+            self.num_bytes = 0
+        elif self._bdat_last:
+            self._write_chunk(b'', final=True)
+            self._deliver()
+        else:
+            # num_bytes counts the length of each command line as it is read,
+            # so the size of the message so far is kept aside until the next
+            # BDAT command picks it up again.
+            self._bdat_received, self.num_bytes = self.num_bytes, 0
+            self.push('250 OK %d octets received' % self._bdat_size)
+
+    def collect_incoming_data(self, data):
+        limit = self.max_command_size_limit
+        if limit and self.num_bytes > limit:
+            return
+        elif limit:
+            self.num_bytes += len(data)
+        if self._decode_data:
+            self.received_lines.append(str(data, 'utf-8'))
+        else:
+            self.received_lines.append(data)
+
+    def _message_data(self):
+        """Return the received DATA as process_message expects it.
+
+        Servers with a true stream_data attribute are given a binary file of
+        the spool, positioned at the start of the message; otherwise it is
+        joined into one bytes (or str, with decode_data) object."""
+        if getattr(self.smtp_server, 'stream_data', False):
+            return self.data_file.getfile()
+        data = self.data_file.getvalue()
+        if self._decode_data:
+            data = str(data, 'utf-8')
+        return data
+
+    def found_terminator(self):
+        line = self._emptystring.join(self.received_lines)
+        print('Data:', repr(line), file=DEBUGSTREAM)
+        self.received_lines = []
+        if self.smtp_state == self.COMMAND:
+            sz, self.num_bytes = self.num_bytes, 0
+            if not line:
+                self.push('500 Error: bad syntax')
+                return
+            if not self._decode_data:
+                line = str(line, 'utf-8')
+            i = line.find(' ')
+            if i < 0:
+                command = line.upper()
+                arg = None
+            else:
+                command = line[:i].upper()
+                arg = line[i+1:].strip()
+            max_sz = (self.command_size_limits[command]
+                        if self.extended_smtp else self.command_size_limit)
+            if sz > max_sz:
+                self.push('500 Error: line too long')
+                return
+            method = getattr(self, 'smtp_' + command, None)
+            if not method:
+                self.push('500 Error: command "%s" not recognized' % command)
+                return
+            method(arg)
+            return
+        else:
+            if self.smtp_state != self.DATA:
+                self.push('451 Internal confusion')
+                self.num_bytes = 0
+                return
+            self._end_data()
+
+    def _end_data(self):
+        """Called once the DATA terminator has been seen."""
+        self._deliver()
+
+    def _deliver(self):
+        """Hand a fully received message (from DATA or BDAT) to the server."""
+        if self.data_size_limit and self.num_bytes > self.data_size_limit:
+            self._set_post_data_state()
+            self.push('552 Error: Too much mail data')
+            return
+        args = (self.peer, self.mailfrom, self.rcpttos, self._message_data())
+        kwargs = {}
+        if not self._decode_data:
+            kwargs = {
+                'mail_options': self.mail_options,
+                'rcpt_options': self.rcpt_options,
+            }
+        status = self.smtp_server.process_message(*args, **kwargs)
+        self._set_post_data_state()
+        if not status:
+            self.push('250 OK')
+        else:
+            self.push(status)
+
+    # SMTP and ESMTP commands
+    def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+            return
+        # See issue #21783 for a discussion of this behavior.
+        if self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self._set_rset_state()
+        self.seen_greeting = arg
+        self.push('250 %s' % self.fqdn)
+
+    def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+        # See issue #21783 for a discussion of this behavior.
+        if self.seen_greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+        self._set_rset_state()
+        self.seen_greeting = arg
+        self.extended_smtp = True
+        self.push('250-%s' % self.fqdn)
+        if self.data_size_limit:
+            self.push('250-SIZE %s' % self.data_size_limit)
+            self.command_size_limits['MAIL'] += 26
+        if not self._decode_data:
+            self.push('250-8BITMIME')
+            self.push('250-CHUNKING')
+            self.push('250-BINARYMIME')
+        if self.enable_SMTPUTF8:
+            self.push('250-SMTPUTF8')
+            self.command_size_limits['MAIL'] += 10
+        self.push('250-PIPELINING')
+        self.push('250 HELP')
+
+    def smtp_NOOP(self, arg):
+        if arg:
+            self.push('501 Syntax: NOOP')
+        else:
+            self.push('250 OK')
+
+    def smtp_QUIT(self, arg):
+        # args is ignored
+        self.push('221 Bye')
+        self.quitting = True
+        self._flush_replies()
+        self.close_when_done()
+
+    def _strip_command_keyword(self, keyword, arg):
+        keylen = len(keyword)
+        if arg[:keylen].upper() == keyword:
+            return arg[keylen:].strip()
+        return ''
+
+    def _getaddr(self, arg):
+        if not arg:
+            return '', ''
+        if arg.lstrip().startswith('<'):
+            address, rest = get_angle_addr(arg)
+        else:
+            address, rest = get_addr_spec(arg)
+        if not address:
+            return address, rest
+        return address.addr_spec, rest
+
+    def _getparams(self, params):
+        # Return params as dictionary. Return None if not all parameters
+        # appear to be syntactically valid according to RFC 1869.
+        result = {}
+        for param in params:
+            param, eq, value = param.partition('=')
+            if not param.isalnum() or eq and not value:
+                return None
+            result[param] = value if eq else True
+        return result
+
+    def smtp_HELP(self, arg):
+        if arg:
+            extended = ' [SP <mail-parameters>]'
+            lc_arg = arg.upper()
+            if lc_arg == 'EHLO':
+                self.push('250 Syntax: EHLO hostname')
+            elif lc_arg == 'HELO':
+                self.push('250 Syntax: HELO hostname')
+            elif lc_arg == 'MAIL':
+                msg = '250 Syntax: MAIL FROM: <address>'
+                if self.extended_smtp:
+                    msg += extended
+                self.push(msg)
+            elif lc_arg == 'RCPT':
+                msg = '250 Syntax: RCPT TO: <address>'
+                if self.extended_smtp:
+                    msg += extended
+                self.push(msg)
+            elif lc_arg == 'DATA':
+                self.push('250 Syntax: DATA')
+            elif lc_arg == 'RSET':
+                self.push('250 Syntax: RSET')
+            elif lc_arg == 'NOOP':
+                self.push('250 Syntax: NOOP')
+            elif lc_arg == 'QUIT':
+                self.push('250 Syntax: QUIT')
+            elif lc_arg == 'VRFY':
+                self.push('250 Syntax: VRFY <address>')
+            else:
+                self.push('501 Supported commands: EHLO HELO MAIL RCPT '
+                          'DATA RSET NOOP QUIT VRFY')
+        else:
+            self.push('250 Supported commands: EHLO HELO MAIL RCPT DATA '
+                      'RSET NOOP QUIT VRFY')
+
+    def smtp_VRFY(self, arg):
+        if arg:
+            address, params = self._getaddr(arg)
+            if address:
+                self.push('252 Cannot VRFY user, but will accept message '
+                          'and attempt delivery')
+            else:
+                self.push('502 Could not VRFY %s' % arg)
+        else:
+            self.push('501 Syntax: VRFY <address>')
+
+    def smtp_MAIL(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first')
+            return
+        print('===> MAIL', arg, file=DEBUGSTREAM)
+        syntaxerr = '501 Syntax: MAIL FROM: <address>'
+        if self.extended_smtp:
+            syntaxerr += ' [SP <mail-parameters>]'
+        if arg is None:
+            self.push(syntaxerr)
+            return
+        arg = self._strip_command_keyword('FROM:', arg)
+        address, params = self._getaddr(arg)
+        if not address:
+            self.push(syntaxerr)
+            return
+        if not self.extended_smtp and params:
+            self.push(syntaxerr)
+            return
+        if self.mailfrom:
+            self.push('503 Error: nested MAIL command')
+            return
+        self.mail_options = params.upper().split()
+        params = self._getparams(self.mail_options)
+        if params is None:
+            self.push(syntaxerr)
+            return
+        body = '7BIT'
+        if not self._decode_data:
+            body = params.pop('BODY', '7BIT')
+            if body not in ['7BIT', '8BITMIME', 'BINARYMIME']:
+                self.push('501 Error: BODY can only be one of 7BIT, 8BITMIME,'
+                          ' BINARYMIME')
+                return
+        if self.enable_SMTPUTF8:
+            smtputf8 = params.pop('SMTPUTF8', False)
+            if smtputf8 is True:
+                self.require_SMTPUTF8 = True
+            elif smtputf8 is not False:
+                self.push('501 Error: SMTPUTF8 takes no arguments')
+                return
+        size = params.pop('SIZE', None)
+        if size:
+            if not SIZE_DIGITS.fullmatch(size):
+                self.push(syntaxerr)
+                return
+            elif self.data_size_limit and int(size) > self.data_size_limit:
+                self.push('552 Error: message size exceeds fixed maximum message size')
+                return
+        if len(params.keys()) > 0:
+            self.push('555 MAIL FROM parameters not recognized or not implemented')
+            return
+        self.mailfrom = address
+        self.mail_body = body
+        print('sender:', self.mailfrom, file=DEBUGSTREAM)
+        self.push('250 OK')
+
+    def smtp_RCPT(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first');
+            return
+        print('===> RCPT', arg, file=DEBUGSTREAM)
+        if not self.mailfrom:
+            self.push('503 Error: need MAIL command')
+            return
+        syntaxerr = '501 Syntax: RCPT TO: <address>'
+        if self.extended_smtp:
+            syntaxerr += ' [SP <mail-parameters>]'
+        if arg is None:
+            self.push(syntaxerr)
+            return
+        arg = self._strip_command_keyword('TO:', arg)
+        address, params = self._getaddr(arg)
+        if not address:
+            self.push(syntaxerr)
+            return
+        if not self.extended_smtp and params:
+            self.push(syntaxerr)
+            return
+        self.rcpt_options = params.upper().split()
+        params = self._getparams(self.rcpt_options)
+        if params is None:
+            self.push(syntaxerr)
+            return
+        # XXX currently there are no options we recognize.
+        if len(params.keys()) > 0:
+            self.push('555 RCPT TO parameters not recognized or not implemented')
+            return
+        self.rcpttos.append(address)
+        print('recips:', self.rcpttos, file=DEBUGSTREAM)
+        self.push('250 OK')
+
+    def smtp_RSET(self, arg):
+        if arg:
+            self.push('501 Syntax: RSET')
+            return
+        self._set_rset_state()
+        self.push('250 OK')
+
+    def smtp_DATA(self, arg):
+        if not self.seen_greeting:
+            self.push('503 Error: send HELO first');
+            return
+        if not self.rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            self.push('501 Syntax: DATA')
+            return
+        if self.mail_body == 'BINARYMIME':
+            self.push('503 Error: BINARYMIME requires BDAT')
+            return
+        if self.data_file is not None:
+            self.push('503 Error: BDAT transaction in progress')
+            return
+        self.smtp_state = self.DATA
+        self._open_data_file()
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+
+    def smtp_BDAT(self, arg):
+        # RFC 3030 CHUNKING: BDAT <chunk-size> [LAST], followed by exactly
+        # chunk-size octets of the message.
+        if self._decode_data:
+            self.push('500 Error: command "BDAT" not recognized')
+            return
+        args = arg.split() if arg else []
+        if (not 1 <= len(args) <= 2 or not SIZE_DIGITS.fullmatch(args[0]) or
+                (len(args) == 2 and args[1].upper() != 'LAST')):
+            self.push('501 Syntax: BDAT <chunk-size> [LAST]')
+            return
+        # From here on the chunk has to be read, even if only to discard it
+        self._bdat_size = self._bdat_remaining = int(args[0])
+        self.num_bytes = self._bdat_received
+        self._bdat_last = len(args) == 2
+        self._bdat_error = None
+        if not self.seen_greeting:
+            self._bdat_error = '503 Error: send HELO first'
+        elif not self.rcpttos:
+            self._bdat_error = '503 Error: need RCPT command'
+        elif self.data_file is None:
+            self._open_data_file()
+            self._data_tail = b''
+        self.smtp_state = self.BDAT
+        if not self._bdat_remaining:
+            self._end_chunk()
+
+    # Commands that have not been implemented
+    def smtp_EXPN(self, arg):
+        self.push('502 EXPN not implemented')
+
@@ -7,28 +7,55 @@ Company: Cadaeic Studios
 License: MIT (see LICENSE for details)
 """
 
+import re
 import json
-import sqlite3
+import time
+import queue
+import socket
+import selectors
+import threading
+import contextlib
 import strex
+import smtpy_db
+import smtpy_notify
+import smtpy_storage
 import smtpy_config as config
-from bottle import route, run, request, ServerAdapter
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from bottle import route, run, request, response, ServerAdapter, parse_range_header
 
 
-# Formats the datarows into a nice dictionary
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+# Where the emails are read from, as per the storage backend setting (see smtpy_storage)
+store = smtpy_storage.default_store()
 
-def close_conn(curs, conn):
-    try:
-        if conn is not None:
-            conn.close()
-        if curs is not None:
-            curs.close()
-    except Exception:
-        return
+# Learns of newly stored emails, for requests waiting on them: from the smtp service,
+# or straight from the store if it's in this process's memory
+listener = smtpy_notify.MailListener(config.settings['api']['host'],
+                                     None if store.in_memory else config.settings['api']['notify_port'])
+store.subscribe(listener.publish)
+
+# How often a waiting request checks the database itself, in case a notification was lost
+WAIT_RECHECK_SECONDS = 5
+
+# Waiting requests hold an API thread, so fewer can wait at once than there are
+# threads, leaving at least one for other requests. If none can, they don't wait
+WAITER_LIMIT = max(0, min(config.settings['api']['max_waiters'], config.settings['api']['threads'] - 1))
+waiter_slots = threading.BoundedSemaphore(WAITER_LIMIT) if WAITER_LIMIT > 0 else None
+
+# Streams are sent by threads of their own (see ThreadPoolWSGIServer.detach), so
+# need the threaded server, and only so many can be open at once
+stream_slots = threading.BoundedSemaphore(config.settings['api']['max_streams'])
+STREAM_ENVIRON_KEY = 'smtpy.stream'
+
+# Seconds a client refused with a 503 is told to wait before trying again
+BUSY_RETRY_SECONDS = 1
+
+# How often a stream sends a comment when there are no new emails, so a client that
+# has gone away is noticed
+STREAM_HEARTBEAT_SECONDS = 15
+
+# Most emails a stream sends from one query of the database
+STREAM_BATCH_SIZE = 500
 
 
 # Retrieve an email from the database for the mailLogId supplied.
@@ -43,27 +70,83 @@ def retrieve_email():
         if int(mailLogId) <= 0:
             return {'error':'no mailLogId supplied'}
 
-        try:
-            conn = None
-            curs = None
-            
-            conn = sqlite3.connect(config.settings['database'])
-            conn.row_factory = dict_factory
-            curs = conn.cursor()
-            
-            sql = 'SELECT MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp FROM MailLog WHERE MailLogId = ? ORDER BY MailLogId DESC LIMIT 1'
-            curs.execute(sql, (mailLogId,))
-            value = curs.fetchone()
-            
-            curs.close()
-            conn.close()
-
-            if value is None:
-                return '{}'
-            return json.JSONEncoder().encode(value)
-        except Exception as e:
-            close_conn(curs, conn)
-            return {'error':str(e)}
+        value = store.get(int(mailLogId))
+
+        if value is None:
+            return '{}'
+        return json.JSONEncoder().encode(value)
+    except Exception as e:
+        return {'error':str(e)}
+
+
+# Retrieve the raw message of an email for the mailLogId supplied, exactly as it was
+# received, as message/rfc822. A Range header can be sent for just part of it, eg:
+# 'Range: bytes=0-1023' for its first 1KB.
+#
+# Examples:
+#       /retrieve/raw?mailLogId=1337
+@route('/retrieve/raw', method='GET')
+def retrieve_raw():
+    stack = contextlib.ExitStack()
+    try:
+        mailLogId = strex.safeguard(request.query.mailLogId, 0)
+
+        if int(mailLogId) <= 0:
+            return {'error':'no mailLogId supplied'}
+
+        # Anything the store keeps open is kept until the raw message has been sent
+        raw = store.open_raw(int(mailLogId), stack)
+        if raw is None:
+            stack.close()
+            return {'error':'no raw message for that mailLogId'}
+
+        raw, start, size = raw
+        stack.callback(raw.close)
+        offset, length = 0, size
+
+        # Only a single range is served, otherwise the whole message is, as it is
+        # for a Range header that isn't well formed
+        range_set = byte_range_set(request.environ.get('HTTP_RANGE'))
+        if range_set is not None:
+            ranges = list(parse_range_header('bytes=' + range_set, size))
+            if not ranges:
+                stack.close()
+                response.status = 416
+                response['Content-Range'] = 'bytes */%d' % size
+                return ''
+            if len(ranges) == 1:
+                offset, end = ranges[0]
+                length = end - offset
+                response.status = 206
+                response['Content-Range'] = 'bytes %d-%d/%d' % (offset, end - 1, size)
+
+        response['Content-Type'] = 'message/rfc822'
+        response['Content-Disposition'] = 'inline; filename="%d.eml"' % int(mailLogId)
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Length'] = length
+        return FileRange(raw, start + offset, length, stack.close)
+    except Exception as e:
+        stack.close()
+        return {'error':str(e)}
+
+
+# Retrieve the attachments of an email for the mailLogId supplied: the FileName,
+# ContentType, ContentId, TransferEncoding and Size (as sent, eg: in base64) of each.
+# Only attachments stored apart from the email are listed (see attachment_threshold).
+#
+# Examples:
+#       /retrieve/attachments?mailLogId=1337
+@route('/retrieve/attachments', method='GET')
+def retrieve_attachments():
+    try:
+        mailLogId = strex.safeguard(request.query.mailLogId, 0)
+
+        if int(mailLogId) <= 0:
+            return {'error':'no mailLogId supplied'}
+
+        values = store.attachments(int(mailLogId))
+
+        return json.JSONEncoder().encode(values)
     except Exception as e:
         return {'error':str(e)}
 
@@ -85,27 +168,85 @@ def retrieve_emails():
         if int(amount) < 1:
             amount = 1
 
-        try:
-            conn = None
-            curs = None
-            
-            conn = sqlite3.connect(config.settings['database'])
-            conn.row_factory = dict_factory
-            curs = conn.cursor()
-
-            sql = 'SELECT MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp FROM MailLog WHERE Sender = ? ORDER BY MailLogId DESC LIMIT ?'
-            curs.execute(sql, (email, amount,))
-            values = curs.fetchall()
-            
-            curs.close()
-            conn.close()
-
-            if values is None:
-                return '{}'
-            return json.JSONEncoder().encode(values)
-        except Exception as e:
-            close_conn(curs, conn)
-            return {'error':str(e)}
+        values = store.query(sender=email, amount=int(amount))
+
+        return json.JSONEncoder().encode(values)
+    except Exception as e:
+        return {'error':str(e)}
+
+
+# Retrieve the top x emails from the database sent to the recipient email supplied.
+# The email is matched regardless of case. If the amount is not passed it is defaulted to 1.
+#
+# Example:
+#       /retrieve/emails/to?email=to@domain.com&amount=2
+@route('/retrieve/emails/to', method='GET')
+def retrieve_emails_to():
+    try:
+        email = request.query.email
+        amount = strex.safeguard(request.query.amount, 1)
+
+        if strex.is_none_or_empty(email):
+            return {'error':'no email supplied'}
+
+        if int(amount) < 1:
+            amount = 1
+
+        values = store.query(recipient=email, amount=int(amount))
+
+        return json.JSONEncoder().encode(values)
+    except Exception as e:
+        return {'error':str(e)}
+
+
+# Retrieve the top x emails from the database sent to any recipient at the domain supplied.
+# The domain is matched regardless of case. If the amount is not passed it is defaulted to 1.
+#
+# Example:
+#       /retrieve/emails/domain?domain=domain.com&amount=2
+@route('/retrieve/emails/domain', method='GET')
+def retrieve_emails_domain():
+    try:
+        domain = request.query.domain
+        amount = strex.safeguard(request.query.amount, 1)
+
+        if strex.is_none_or_empty(domain):
+            return {'error':'no domain supplied'}
+
+        if int(amount) < 1:
+            amount = 1
+
+        values = store.query(domain=domain, amount=int(amount))
+
+        return json.JSONEncoder().encode(values)
+    except Exception as e:
+        return {'error':str(e)}
+
+
+# Search the subject and body of the emails in the database, returning the top x
+# matches, best first. The query is an SQLite FTS5 query, eg: 'reset AND password',
+# '"order confirmed"' or 'invoic*'; text that isn't a valid query (such as an email
+# address) is searched for word by word. If the amount is not passed it is defaulted
+# to 10, and it can be at most the max_search_results setting. With the database
+# split into partitions (see partition_minutes), the matches of every partition are
+# ordered together, though each partition ranks its emails only against its own.
+#
+# Example:
+#       /search/emails?q=password%20reset&amount=5
+@route('/search/emails', method='GET')
+def search_emails():
+    try:
+        q = request.query.q
+        amount = int(strex.safeguard(request.query.amount, 10))
+
+        if strex.is_none_or_empty(q) or not q.strip():
+            return {'error':'no q supplied'}
+
+        amount = min(max(1, amount), config.settings['api']['max_search_results'])
+
+        values = store.search(q, amount)
+
+        return json.JSONEncoder().encode(values)
     except Exception as e:
         return {'error':str(e)}
 
@@ -133,29 +274,10 @@ def create_email():
         if strex.is_none_or_empty(recipients):
             return {'error':'no recipients supplied'}
 
-        try:
-            conn = None
-            curs = None
-            
-            conn = sqlite3.connect(config.settings['database'])
-            conn.row_factory = dict_factory
-            curs = conn.cursor()
-
-            sql = 'INSERT INTO MailLog(IPAddress, PortNumber, Subject, Sender, Recipients, Body) VALUES (?, ?, ?, ?, ?, ?)'
-            curs.execute(sql, (str(ip), str(port), str(subject), str(sender), str(recipients), str(body)))
-            _id = curs.lastrowid
-
-            sql = 'SELECT MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp FROM MailLog WHERE MailLogId = ? ORDER BY MailLogId DESC LIMIT 1'
-            curs.execute(sql, (_id,))
-            value = curs.fetchone()
-            
-            conn.commit()
-            curs.close()
-            conn.close()
-            return json.JSONEncoder().encode(value)
-        except Exception as e:
-            close_conn(curs, conn)
-            return {'error':str(e)}
+        row = smtpy_db.compress_row((str(ip), str(port), str(subject), str(sender), str(recipients), str(body)),
+                                    *smtpy_db.compression_settings())
+        value = store.get(store.store([row]))
+        return json.JSONEncoder().encode(value)
     except Exception as e:
         return {'error':str(e)}
 
@@ -172,23 +294,9 @@ def delete_email():
         if int(mailLogId) <= 0:
             return {'error':'no mailLogId supplied'}
 
-        try:
-            conn = None
-            curs = None
-            
-            conn = sqlite3.connect(config.settings['database'])
-            curs = conn.cursor()
-            
-            sql = 'DELETE FROM MailLog WHERE MailLogId = ?'
-            curs.execute(sql, (mailLogId,))
-
-            conn.commit()
-            curs.close()
-            conn.close()
-            return '{}'
-        except Exception as e:
-            close_conn(curs, conn)
-            return {'error':str(e)}
+        store.delete(mail_log_id=int(mailLogId))
+
+        return '{}'
     except Exception as e:
         return {'error':str(e)}
 
@@ -205,56 +313,528 @@ def delete_emails():
         if strex.is_none_or_empty(email):
             return {'error':'no email supplied'}
 
-        try:
-            conn = None
-            curs = None
-            
-            conn = sqlite3.connect(config.settings['database'])
-            curs = conn.cursor()
-            
-            sql = 'DELETE FROM MailLog WHERE Sender = ?'
-            curs.execute(sql, (email,))
-            
-            conn.commit()
-            curs.close()
-            conn.close()
-            return '{}'
-        except Exception as e:
-            close_conn(curs, conn)
-            return {'error':str(e)}
+        store.delete(sender=email)
+
+        return '{}'
     except Exception as e:
         return {'error':str(e)}
 
 
+# Wait for an email to be stored for the sender email supplied, and then retrieve the
+# top x emails like /retrieve/emails. If there's already an email it is returned
+# straight away; to only wait for a new email, pass the last MailLogId seen as after.
+# The timeout is in seconds, defaulting to 30; if no email is stored in time, an
+# empty list is returned. If too many requests are already waiting, a 503 is returned.
+#
+# Example:
+#       /wait/emails?email=from@domain.com&timeout=10&after=1337
+@route('/wait/emails', method='GET')
+def wait_emails():
+    return wait_for_emails(lambda email, after, amount: store.query(sender=email, after=after, amount=amount),
+                           lambda email, sender, recipients: sender == email)
+
+
+# As /wait/emails, but waits for an email to be stored for the recipient email supplied.
+#
+# Example:
+#       /wait/emails/to?email=to@domain.com&timeout=10
+@route('/wait/emails/to', method='GET')
+def wait_emails_to():
+    return wait_for_emails(lambda email, after, amount: store.query(recipient=email, after=after, amount=amount),
+                           lambda email, sender, recipients: is_recipient(email, recipients))
+
+
+# Returns whether an email address is one of an email's stored recipients
+def is_recipient(email, recipients):
+    email = smtpy_db.fold_address(email)
+    return any(email == smtpy_db.fold_address(r) for r in smtpy_db.recipient_list(recipients))
+
+
+# Waits for and retrieves emails using query(email, after, amount). The listener is
+# used to wake up once an email for which match is true has been stored, and the
+# store is also checked every WAIT_RECHECK_SECONDS. A request only takes one of the
+# waiter_slots once it has to wait, and without any it just checks the once
+def wait_for_emails(query, match):
+    waiting = False
+    try:
+        email = request.query.email
+        amount = strex.safeguard(request.query.amount, 1)
+        after = strex.safeguard(request.query.after, 0)
+        timeout = strex.safeguard(request.query.timeout, 30)
+
+        if strex.is_none_or_empty(email):
+            return {'error':'no email supplied'}
+
+        if int(amount) < 1:
+            amount = 1
+
+        timeout = max(0, min(float(timeout), config.settings['api']['max_wait_seconds']))
+        if waiter_slots is None:
+            timeout = 0
+        deadline = time.monotonic() + timeout
+        after = int(after)
+
+        while True:
+            # Anything stored after this point will be seen by the listener
+            latest = listener.latest
+            values = query(email, after, int(amount))
+
+            remaining = deadline - time.monotonic()
+            if values or remaining <= 0 or listener.closed:
+                return json.JSONEncoder().encode(values)
+
+            if not waiting:
+                if not waiter_slots.acquire(blocking=False):
+                    return busy('too many requests are waiting for emails')
+                waiting = True
+
+            listener.wait(lambda sender, recipients: match(email, sender, recipients),
+                          max(after, latest), min(remaining, WAIT_RECHECK_SECONDS))
+    except Exception as e:
+        return {'error':str(e)}
+    finally:
+        if waiting:
+            waiter_slots.release()
+
+
+# Refuses a request with a 503, for the client to try again shortly
+def busy(message):
+    response.status = 503
+    response['Retry-After'] = str(BUSY_RETRY_SECONDS)
+    return {'error':message}
+
+
+# Stream a Server-Sent Event for every email stored from now on, optionally only those
+# from a sender and/or to a recipient. Each event's id is the MailLogId, and its data
+# is the email's MailLogId, Sender, Recipients, Subject and Size (of the body, in bytes).
+# A client reconnecting with a Last-Event-ID header (or lastEventId parameter) is first
+# sent every email stored after that MailLogId, so none are missed.
+#
+# Each stream is sent by a thread of its own, and at most max_streams can be open at
+# once; any more are refused with a 503, as are all streams with threads at 0.
+#
+# Example:
+#       /stream/emails?sender=from@domain.com&recipient=to@domain.com
+@route('/stream/emails', method='GET')
+def stream_emails():
+    if config.settings['api']['threads'] <= 0:
+        return busy('streams need the threaded server, with threads above 0')
+
+    try:
+        sender = strex.safeguard(request.query.sender)
+        recipient = strex.safeguard(request.query.recipient)
+        last_id = strex.safeguard(request.get_header('Last-Event-ID'), request.query.lastEventId)
+
+        if strex.is_none_or_empty(last_id):
+            last_id = store.last_id()
+        last_id = int(last_id)
+    except Exception as e:
+        return {'error':str(e)}
+
+    def match(event_sender, event_recipients):
+        return ((not sender or event_sender == sender) and
+                (not recipient or is_recipient(recipient, event_recipients)))
+
+    if not stream_slots.acquire(blocking=False):
+        return busy('too many streams are open')
+
+    request.environ[STREAM_ENVIRON_KEY] = True
+    response.content_type = 'text/event-stream; charset=utf-8'
+    response.set_header('Cache-Control', 'no-cache')
+    return email_events(last_id, sender, recipient, match)
+
+
+# Generates the events for /stream/emails, for the emails after last_id. The store
+# is read from after each notification of a matching email, and every
+# WAIT_RECHECK_SECONDS in case a notification was lost. The stream's slot is given
+# back once it's closed. The events are yielded already encoded, as bottle would
+# otherwise encode them using the response of the thread serving the request, not
+# of the stream's own thread
+def email_events(last_id, sender, recipient, match):
+    try:
+        yield b'retry: 2000\n\n'
+        heartbeat = time.monotonic() + STREAM_HEARTBEAT_SECONDS
+
+        while not listener.closed:
+            latest = listener.latest
+            values = store.summaries(last_id, sender, recipient, STREAM_BATCH_SIZE)
+
+            if values:
+                last_id = values[-1]['MailLogId']
+                heartbeat = time.monotonic() + STREAM_HEARTBEAT_SECONDS
+                yield ''.join('id: %d\ndata: %s\n\n' % (value['MailLogId'], json.JSONEncoder().encode(value))
+                              for value in values).encode('utf-8')
+                if len(values) == STREAM_BATCH_SIZE:
+                    continue
+            elif time.monotonic() >= heartbeat:
+                heartbeat = time.monotonic() + STREAM_HEARTBEAT_SECONDS
+                yield b': heartbeat\n\n'
+
+            listener.wait(match, max(last_id, latest),
+                          min(WAIT_RECHECK_SECONDS, max(0, heartbeat - time.monotonic())))
+    finally:
+        stream_slots.release()
+
+
 
 __server__ = None
 
 # Start the bottle server
 def __init__():
     global __server__
-    __server__ = MyWSGIRefServer(host=config.settings['api']['host'], port=config.settings['api']['port'])
+    listener.start()
+    __server__ = MyWSGIRefServer(host=config.settings['api']['host'], port=config.settings['api']['port'],
+                                 threads=config.settings['api']['threads'],
+                                 keepalive_timeout=config.settings['api']['keepalive_timeout'])
     run(server=__server__, quiet=True)
 
 
 # Stop the bottle server
 def __stop__():
     global __server__
+    # Stop listening first, so waiting requests and streams give up
+    listener.stop()
     __server__.stop()
+    store.close()
 
 
-# Custom server to run bottle
+# Custom server to run bottle. If threads is more than 0 requests are served by
+# a ThreadPoolWSGIServer, otherwise by wsgiref's single-threaded server
 class MyWSGIRefServer(ServerAdapter):
     server = None
 
     def run(self, handler):
-        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        from wsgiref.simple_server import make_server
+        threads = self.options.pop('threads', 0)
+        keepalive_timeout = self.options.pop('keepalive_timeout', 15)
+
+        handler_class = KeepAliveRequestHandler if threads > 0 else WSGIRequestHandler
         if self.quiet:
-            class QuietHandler(WSGIRequestHandler):
+            class QuietHandler(handler_class):
                 def log_request(*args, **kw): pass
-            self.options['handler_class'] = QuietHandler
-        self.server = make_server(self.host, self.port, handler, **self.options)
+            handler_class = QuietHandler
+
+        if threads > 0:
+            self.server = ThreadPoolWSGIServer((self.host, self.port), handler_class,
+                                               threads=threads, keepalive_timeout=keepalive_timeout)
+            self.server.set_app(handler)
+        else:
+            self.options['handler_class'] = handler_class
+            self.server = make_server(self.host, self.port, handler, **self.options)
         self.server.serve_forever()
 
     def stop(self):
         self.server.shutdown()
 
+
+# WSGI server handing requests to a pool of threads, and keeping connections open
+# between requests (HTTP/1.1 keep-alive). Only connections with a request waiting
+# are given to the pool: idle connections are watched by a separate thread, so
+# many idle pollers don't tie up the threads, and are closed after being idle for
+# keepalive_timeout seconds. Streams are detached from the pool, and sent by
+# threads of their own.
+class ThreadPoolWSGIServer(WSGIServer):
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, threads=16, keepalive_timeout=15):
+        WSGIServer.__init__(self, server_address, RequestHandlerClass)
+        self.keepalive_timeout = keepalive_timeout
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='smtpy-api')
+        self._stopping = False
+        self._idle = {}
+        self._streams = set()
+        self._streams_lock = threading.Lock()
+        self._waiting = queue.SimpleQueue()
+        self._selector = selectors.DefaultSelector()
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._selector.register(self._wake_recv, selectors.EVENT_READ)
+        self._watcher = threading.Thread(target=self._watch_idle, name='smtpy-api-keepalive', daemon=True)
+        self._watcher.start()
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._serve_connection, request, client_address)
+
+    def _serve_connection(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._serve(handler)
+
+    # Serves the requests waiting on a connection, then hands it back to be watched
+    def _serve(self, handler):
+        try:
+            keep_alive = handler.handle()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            keep_alive = False
+
+        if handler.detached:
+            return
+        if keep_alive and not self._stopping:
+            self._waiting.put(handler)
+            self._wake()
+        else:
+            self._close(handler)
+
+    # Hands a connection's response to a thread of its own, which calls send and
+    # then closes the connection, so the pool's thread is free for other requests
+    def detach(self, handler, send):
+        handler.detached = True
+        thread = threading.Thread(target=self._send_detached, args=(handler, send),
+                                  name='smtpy-api-stream', daemon=True)
+        with self._streams_lock:
+            self._streams.add(thread)
+        thread.start()
+
+    def _send_detached(self, handler, send):
+        try:
+            send()
+        except (ConnectionError, TimeoutError):
+            pass
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self._close(handler)
+            with self._streams_lock:
+                self._streams.discard(threading.current_thread())
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except Exception:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _wake(self):
+        try:
+            self._wake_send.send(b'\0')
+        except OSError:
+            pass
+
+    def _watch_idle(self):
+        while not self._stopping:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.fileobj is self._wake_recv:
+                    try:
+                        self._wake_recv.recv(4096)
+                    except OSError:
+                        pass
+                else:
+                    self._selector.unregister(key.fileobj)
+                    del self._idle[key.data]
+                    self.pool.submit(self._serve, key.data)
+
+            now = time.monotonic()
+            while True:
+                try:
+                    handler = self._waiting.get_nowait()
+                except queue.Empty:
+                    break
+                self._selector.register(handler.request, selectors.EVENT_READ, handler)
+                self._idle[handler] = now
+
+            for handler, since in list(self._idle.items()):
+                if now - since > self.keepalive_timeout:
+                    self._selector.unregister(handler.request)
+                    del self._idle[handler]
+                    self._close(handler)
+
+    def shutdown(self):
+        WSGIServer.shutdown(self)
+        self._stopping = True
+        self._wake()
+        self._watcher.join()
+        self.pool.shutdown(wait=True)
+
+        # Streams end once the listener has stopped, which is before the server is
+        with self._streams_lock:
+            streams = list(self._streams)
+        for thread in streams:
+            thread.join(self.keepalive_timeout)
+
+        for handler in list(self._idle):
+            self._close(handler)
+        self._idle.clear()
+        while True:
+            try:
+                self._close(self._waiting.get_nowait())
+            except queue.Empty:
+                break
+
+        self._selector.close()
+        self._wake_recv.close()
+        self._wake_send.close()
+        self.server_close()
+
+
+# wsgiref's request handler, changed to live for as long as its connection does.
+# Each call to handle() serves the requests waiting on the connection, and returns
+# True if the connection should then be kept open for further requests.
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response's headers and body together, and straight away; otherwise
+    # Nagle's algorithm holds back a response on a kept-alive connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # Set once the connection's been handed to a thread of its own (see detach)
+    detached = False
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.timeout = server.keepalive_timeout
+        self.setup()
+
+    def handle(self):
+        while True:
+            self.handle_one_request()
+            if self.detached or self.close_connection:
+                return False
+            if not self.has_pending_request():
+                return True
+
+    def handle_one_request(self):
+        self.close_connection = True
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.raw_requestline or not self.parse_request():
+            return
+
+        # A request body the application doesn't read would be taken as the next
+        # request, so only keep the connection open if there isn't one
+        if self.headers.get('Transfer-Encoding') or int(self.headers.get('Content-Length') or 0) > 0:
+            self.close_connection = True
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                         self.get_environ(), multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not handler.keep_alive:
+            self.close_connection = True
+
+    # Checks, without blocking, whether the client has already sent another request
+    def has_pending_request(self):
+        try:
+            self.connection.setblocking(False)
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+
+# wsgiref's server handler, responding as HTTP/1.1. The connection can only be
+# kept open once the response is done if its length was given up front
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+    keep_alive = False
+
+    def close(self):
+        self.keep_alive = self.headers is not None and 'Content-Length' in self.headers
+        ServerHandler.close(self)
+
+    # A stream (see /stream/emails) can stay open indefinitely, so is sent by a
+    # thread of its own rather than holding one of the pool's
+    def finish_response(self):
+        if self.environ.get(STREAM_ENVIRON_KEY):
+            self.request_handler.server.detach(self.request_handler,
+                                               lambda: ServerHandler.finish_response(self))
+        else:
+            ServerHandler.finish_response(self)
+
+    # wsgiref doesn't flush the headers of a response without a body, which would
+    # otherwise sit in the buffer of a kept-alive connection
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        self._flush()
+
+    # A FileRange of a real file is sent with socket.sendfile(), so the kernel copies
+    # it straight from the file to the connection. Anything else is read and written
+    # a block at a time
+    def sendfile(self):
+        filelike = self.result.filelike
+        if not isinstance(filelike, FileRange) or not filelike.has_fileno():
+            return False
+
+        if not self.headers_sent:
+            self.bytes_sent = filelike.length
+            self.send_headers()
+        self._flush()
+        self.request_handler.connection.sendfile(filelike.file, filelike.offset, filelike.length)
+        return True
+
+
+# A range-spec of a Range header, eg: 0-1023, 1024- or -512
+_RANGE_SPEC = re.compile(r'(\d*)-(\d*)', re.ASCII)
+
+
+# Returns the ranges of a Range header (what follows 'bytes='), or None if there's
+# no header or it isn't well formed (see RFC 9110, 14.1.1), in which case it's
+# ignored rather than refused. Whether the ranges can be satisfied isn't checked
+def byte_range_set(header):
+    if not header:
+        return None
+    unit, equals, range_set = header.partition('=')
+    if not equals or unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in range_set.split(',') if spec.strip()]
+    if not specs:
+        return None
+    for spec in specs:
+        match = _RANGE_SPEC.fullmatch(spec)
+        if match is None or match.group(0) == '-':
+            return None
+        first, last = match.groups()
+        if first and last and int(last) < int(first):
+            return None
+    return ','.join(specs)
+
+
+# length bytes of a file-like object from offset, returned by a route as a file to
+# respond with. Once it's closed, on_close is called (or otherwise the file is closed)
+class FileRange(object):
+
+    def __init__(self, file, offset, length, on_close=None):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.on_close = on_close
+        self.remaining = length
+        self.file.seek(offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size > 0 else b''
+        self.remaining -= len(data)
+        return data
+
+    # Whether the file is a real file, which can be sent with sendfile()
+    def has_fileno(self):
+        try:
+            self.file.fileno()
+            return True
+        except (AttributeError, OSError):
+            return False
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+        else:
+            self.file.close()
+
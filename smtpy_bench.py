@@ -0,0 +1,271 @@
+#! /usr/bin/env python3
+"""
+This is the smtpy load generator, used to get a repeatable measure of how
+fast the SMTP service receives emails.
+
+It opens a number of concurrent connections to an SMTP listener and sends a
+number of emails down each one, then reports the emails/sec along with the
+p50/p95/p99 latency of each SMTP phase:
+
+    connect     - opening the TCP connection
+    greeting    - waiting for the 220 greeting (plus the EHLO reply)
+    mail        - MAIL FROM
+    rcpt        - every RCPT TO of an email
+    data        - from sending DATA, up to the 250 after the message
+
+The emails are a mix of plain text, HTML (multipart/alternative) and emails
+with attachments (multipart/mixed), built with the email package, padded
+out to the requested size.
+
+Using --local starts smtpy_service's MockSmtpServer in this process against
+a throwaway database in a temp directory, so no other service is needed.
+Otherwise the listener at --host/--port is used (defaulting to the one in
+the smtp-config).
+
+Usage:
+    python smtpy_bench.py --local [--connections 50] [--messages 20] [--size 4096]
+                          [--mix plain:70,html:20,attachment:10] [--recipients 1]
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import smtpy_config as config
+from email.message import EmailMessage
+
+
+PHASES = ('connect', 'greeting', 'mail', 'rcpt', 'data')
+
+MIME_TYPES = ('plain', 'html', 'attachment')
+
+TEXT_LINE = 'The quick brown fox jumps over the lazy dog 0123456789.\n'
+
+
+# Builds an email of roughly the given size, as bytes ready to be sent after DATA
+def make_email(kind, size, sender, recipients, number):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = ', '.join(recipients)
+    message['Subject'] = 'smtpy-bench %s %d' % (kind, number)
+
+    if kind == 'attachment':
+        text = TEXT_LINE * max(1, size // 4 // len(TEXT_LINE))
+        message.set_content(text)
+        # base64 grows the attachment by a third, so aim it at the remaining size
+        attachment = os.urandom(max(1, (size - len(text)) * 3 // 4))
+        message.add_attachment(attachment, maintype='application',
+                               subtype='octet-stream', filename='bench.bin')
+    elif kind == 'html':
+        text = TEXT_LINE * max(1, size // 2 // len(TEXT_LINE))
+        message.set_content(text)
+        message.add_alternative('<html><body><p>%s</p></body></html>' % text.replace('\n', '<br>\n'),
+                                subtype='html')
+    else:
+        message.set_content(TEXT_LINE * max(1, size // len(TEXT_LINE)))
+
+    data = message.as_bytes().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    # Dot-stuff, and terminate the DATA
+    data = data.replace(b'\r\n.', b'\r\n..')
+    if data.startswith(b'.'):
+        data = b'.' + data
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+# Parses a mix such as 'plain:70,html:20,attachment:10' into (kinds, weights)
+def parse_mix(value):
+    kinds = []
+    weights = []
+    for part in value.split(','):
+        kind, _, weight = part.partition(':')
+        kind = kind.strip().lower()
+        if kind not in MIME_TYPES:
+            raise argparse.ArgumentTypeError('unknown email type %r, expected one of %s' % (kind, ', '.join(MIME_TYPES)))
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+async def read_reply(reader, expect):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by server')
+        if line[3:4] != b'-':
+            break
+    if not line.startswith(expect):
+        raise ConnectionError(line.decode('ascii', 'replace').strip())
+    return line
+
+
+# One connection, sending emails from the shared iterator of emails until it runs out
+async def session(host, port, emails, timings, results):
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    timings['connect'].append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await read_reply(reader, b'220')
+        writer.write(b'EHLO smtpy-bench\r\n')
+        await read_reply(reader, b'250')
+        timings['greeting'].append(time.perf_counter() - started)
+
+        for sender, recipients, data in emails:
+            try:
+                started = time.perf_counter()
+                writer.write(b'MAIL FROM:<%s>\r\n' % sender.encode('ascii'))
+                await read_reply(reader, b'250')
+                timings['mail'].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                for recipient in recipients:
+                    writer.write(b'RCPT TO:<%s>\r\n' % recipient.encode('ascii'))
+                    await read_reply(reader, b'250')
+                timings['rcpt'].append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                writer.write(b'DATA\r\n')
+                await read_reply(reader, b'354')
+                writer.write(data)
+                await read_reply(reader, b'250')
+                timings['data'].append(time.perf_counter() - started)
+                results['sent'] += 1
+            except ConnectionError as e:
+                # A refused email (eg: 451 when the write queue is full) doesn't
+                # end the session, so reset it and carry on with the next one
+                results['errors'] += 1
+                results['last_error'] = str(e)
+                if reader.at_eof():
+                    raise
+                writer.write(b'RSET\r\n')
+                await read_reply(reader, b'250')
+
+        writer.write(b'QUIT\r\n')
+        await read_reply(reader, b'221')
+    finally:
+        writer.close()
+
+
+async def run(host, port, connections, emails, timings, results):
+    emails = iter(emails)
+
+    async def connection():
+        try:
+            await session(host, port, emails, timings, results)
+        except (OSError, ConnectionError) as e:
+            results['errors'] += 1
+            results['last_error'] = str(e)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(connections)))
+    return time.perf_counter() - started
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+# Starts MockSmtpServer in this process, on an ephemeral localhost port,
+# returning the port and a function to stop it
+def start_local(database):
+    config.settings['database'] = database
+    import smtpy_db
+    import smtpy_service
+    smtpy_db.create_schema(database)
+
+    server = smtpy_service.MockSmtpServer(
+        ('127.0.0.1', 0),
+        None,
+        enable_SMTPUTF8 = config.settings['smtp']['use_utf8'],
+        decode_data = (not config.settings['smtp']['use_utf8']))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.close()
+        thread.join()
+        server.writer.stop()
+        return server.writer.high_water_mark
+
+    return server.sockets[0].getsockname()[1], stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--local', action='store_true',
+                        help='start MockSmtpServer in this process against a temp database')
+    parser.add_argument('--host', default=config.settings['smtp']['host'])
+    parser.add_argument('--port', type=int, default=config.settings['smtp']['port'])
+    parser.add_argument('--connections', type=int, default=50,
+                        help='number of concurrent connections')
+    parser.add_argument('--messages', type=int, default=20,
+                        help='number of emails sent per connection')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='approximate size of each email in bytes')
+    parser.add_argument('--mix', type=parse_mix, default='plain:70,html:20,attachment:10',
+                        help='weighted mix of email types: %s' % ', '.join(MIME_TYPES))
+    parser.add_argument('--recipients', type=int, default=1,
+                        help='number of recipients per email')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Build every email up front, so only the SMTP exchange is timed
+    rng = random.Random(args.seed)
+    kinds, weights = args.mix
+    sender = 'noreply@smtpy-bench.local'
+    emails = []
+    for number in range(args.connections * args.messages):
+        kind = rng.choices(kinds, weights)[0]
+        recipients = ['user%d.%d@smtpy-bench.local' % (number, i) for i in range(max(1, args.recipients))]
+        emails.append((sender, recipients, make_email(kind, args.size, sender, recipients, number)))
+
+    timings = dict((phase, []) for phase in PHASES)
+    results = dict(sent=0, errors=0, last_error=None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        host, port, stop = args.host, args.port, None
+        if args.local:
+            host = '127.0.0.1'
+            port, stop = start_local(os.path.join(tmp, 'smtpy.db'))
+
+        try:
+            elapsed = asyncio.run(run(host, port, args.connections, emails, timings, results))
+        finally:
+            high_water_mark = stop() if stop is not None else None
+
+    print('%d connections x %d emails, ~%d bytes, mix %s, %d recipients, against %s:%d%s' % (
+        args.connections, args.messages, args.size,
+        ','.join('%s:%g' % kw for kw in zip(kinds, weights)),
+        args.recipients, host, port, ' (local)' if args.local else ''))
+    print('%d sent, %d errors in %.2fs: %.1f emails/sec' % (
+        results['sent'], results['errors'], elapsed, results['sent'] / elapsed))
+    if results['last_error']:
+        print('last error: %s' % results['last_error'])
+    if high_water_mark is not None:
+        print('write queue high-water mark: %d' % high_water_mark)
+
+    print('%-10s %10s %10s %10s %10s' % ('phase', 'count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for phase in PHASES:
+        values = timings[phase]
+        print('%-10s %10d %10.2f %10.2f %10.2f' % (
+            phase, len(values),
+            percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
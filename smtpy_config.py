@@ -13,6 +13,50 @@ settings = dict(
     # Location of the SQLite database (will be auto-created)
     database = 'path/to/your/smtpy.db',
 
+    # SQLite settings applied to every connection the smtp service and API open.
+    # The profile is one of:
+    #   durable - WAL journal, with every commit synced to disk
+    #   ci-fast - WAL journal, never syncing and using more memory; fastest, but
+    #             emails can be lost if the machine (not just smtpy) crashes
+    # Any of journal_mode, synchronous, mmap_size, cache_size, temp_store and
+    # busy_timeout (ms) can also be set here, to override the profile's value.
+    #
+    # Email bodies and raw messages of at least compress_threshold bytes are
+    # stored zlib-compressed, at compress_level (1 fastest to 9 smallest). Use
+    # a threshold of 0 to store them uncompressed.
+    #
+    # Attachments of at least attachment_threshold bytes are stored once, no
+    # matter how many emails they're attached to (once per partition, when
+    # partition_minutes is set). Use 0 to store every email's attachments
+    # within it.
+    #
+    # Set segment_directory to store the emails as received (their raw messages)
+    # in files in that directory, of about segment_size_mb each, rather than in
+    # the database. Old emails are then purged a whole file at a time.
+    #
+    # Set partition_minutes (eg: 10) to split the database into a new file for
+    # each that many minutes, next to the database. Old emails are then purged by
+    # deleting whole files once all of their emails are older than the smtp
+    # purge_after_minutes, rather than one at a time; so emails are kept for up
+    # to partition_minutes longer
+    #
+    # Set backend to 'memory' to keep emails only in the smtp service's memory,
+    # rather than in the database: at most memory_max_emails of them, using at
+    # most about memory_max_mb, with the least recently read dropped first. The
+    # smtp service then serves the API itself, so don't start the API service.
+    storage = dict(
+        backend = 'sqlite',
+        memory_max_emails = 10000,
+        memory_max_mb = 256,
+        profile = 'durable',
+        compress_threshold = 0,
+        compress_level = 6,
+        attachment_threshold = 1024,
+        segment_directory = None,
+        segment_size_mb = 64,
+        partition_minutes = 0
+    ),
+
     # SMTP settings for host/port and service information
     smtp = dict(
         svc_name = 'Smtpy Service',
@@ -20,8 +64,29 @@ settings = dict(
         svc_description = 'This is the service which runs the mock SMTP service',
         purge_email = True,
         use_utf8 = True,
+
+        # When purge_email is enabled, emails older than purge_after_minutes
+        # are deleted every purge_interval_seconds, purge_chunk_size at a time
+        purge_after_minutes = 30,
+        purge_interval_seconds = 60,
+        purge_chunk_size = 500,
+
         host = '127.0.0.1',
-        port = 25
+        port = 25,
+
+        # Number of SMTP worker processes sharing the host/port. Each worker
+        # runs its own event loop, and all received emails are written to the
+        # database by the service process. Use 1 to handle everything in the
+        # service process itself
+        workers = 1,
+
+        # Received emails are queued and written to the database in batches.
+        # A batch is written once it has batch_size emails, or once its oldest
+        # email has waited batch_max_delay_ms. If queue_size emails are waiting
+        # to be written, further emails are refused with a temporary error.
+        batch_size = 500,
+        batch_max_delay_ms = 50,
+        queue_size = 50000
     ),
 
     # API settings for host/port and service information
@@ -30,6 +95,30 @@ settings = dict(
         svc_display_name = 'Smtpy API Service',
         svc_description = 'This is the service which runs the smtpy API service',
         host = '127.0.0.1',
-        port = 8081
+        port = 8081,
+
+        # Number of threads serving API requests, over HTTP/1.1 keep-alive
+        # connections. Connections that are idle for keepalive_timeout seconds
+        # are closed. Set threads to 0 to use the single-threaded server
+        threads = 16,
+        keepalive_timeout = 15,
+
+        # UDP port on the api host, on which the smtp service tells the API of
+        # newly stored emails so /wait/emails can answer straight away. Use 0
+        # to disable. Waiting requests give up after at most max_wait_seconds,
+        # and each one holds an API thread while waiting, so at most max_waiters
+        # (and always fewer than threads) can wait at once; any more are refused
+        # with a 503. With threads at 0 or 1 requests don't wait at all
+        notify_port = 8082,
+        max_wait_seconds = 120,
+        max_waiters = 8,
+
+        # Most /stream/emails streams open at once; any more are refused with a
+        # 503. Each is sent by a thread of its own rather than one of threads,
+        # so streams aren't served at all with threads at 0
+        max_streams = 16,
+
+        # Most emails /search/emails returns for one query
+        max_search_results = 100
     )
 )
@@ -0,0 +1,1616 @@
+#! /usr/bin/env python3
+"""
+SQLite helpers for the smtpy services: opening connections to the database,
+creating the schema, the long-lived writer that records received email, and
+the pools of connections used by the API.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import io
+import os
+import re
+import ast
+import mmap
+import heapq
+import time
+import calendar
+import zlib
+import hashlib
+import codecs
+import queue
+import sqlite3
+import threading
+import contextlib
+import urllib.request
+import smtpy_segments
+import smtpy_config as config
+
+
+# Number of prepared statements each connection keeps cached. Every statement
+# smtpy runs uses a fixed SQL string with ? parameters, so on a long-lived
+# connection each one is only ever compiled once.
+CACHED_STATEMENTS = 64
+
+# Named sets of the PRAGMAs applied to each connection, picked by the storage
+# 'profile' setting. Both use a WAL journal, so the API's reads never wait on
+# ingest's writes (or the other way round), and wait busy_timeout ms for a lock
+STORAGE_PROFILES = {
+    'durable': dict(
+        journal_mode = 'WAL',
+        synchronous = 'FULL',
+        mmap_size = 0,
+        cache_size = -8192,
+        temp_store = 'DEFAULT',
+        busy_timeout = 5000),
+
+    'ci-fast': dict(
+        journal_mode = 'WAL',
+        synchronous = 'OFF',
+        mmap_size = 268435456,
+        cache_size = -65536,
+        temp_store = 'MEMORY',
+        busy_timeout = 10000),
+}
+
+# The PRAGMAs applied to each connection, in order. journal_mode is only set by
+# connections that can write, as it is stored in the database itself
+STORAGE_PRAGMAS = ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store')
+
+# Version of the schema created by create_schema, recorded in PRAGMA user_version.
+# Version 1 (user_version 0) had TEXT ports and timestamps, and an AUTOINCREMENT key;
+# version 2 didn't have the columns parsed from each email (see smtpy_mime), and
+# version 3 didn't have the MailSearch full-text index, version 4 couldn't store
+# compressed emails, version 5 didn't store attachments apart from the emails,
+# version 6 couldn't store raw messages in a segment log, and version 7 couldn't be
+# split into partitions
+SCHEMA_VERSION = 8
+
+# The port is an integer, and the TimeStamp is in milliseconds since the epoch (UTC).
+# MailLogIds are handed out from MailLogSequence (see insert_mails), rather than by
+# AUTOINCREMENT which updates sqlite_sequence for every email inserted. Body is the
+# email's text body, and RawMessage the email as it was received.
+#
+# Large bodies and raw messages can be stored zlib-compressed (see compress_row). A
+# compressed Body or HtmlBody is a BLOB rather than TEXT, and is read back with the
+# smtpy_text() SQL function; a compressed RawMessage has RawCompressed set to 1.
+#
+# With a segment log (see smtpy_segments), the raw message is stored in it instead of
+# in RawMessage, at RawOffset in segment RawSegment, and is RawLength bytes long
+CREATE_MAIL_LOG_SQL = """CREATE TABLE IF NOT EXISTS MailLog
+                    (
+                        MailLogId INTEGER PRIMARY KEY,
+                        IPAddress TEXT,
+                        PortNumber INTEGER,
+                        Subject TEXT,
+                        Sender TEXT,
+                        Recipients TEXT,
+                        Body TEXT,
+                        TimeStamp INTEGER NOT NULL DEFAULT (CAST(ROUND((JULIANDAY('now') - 2440587.5) * 86400000) AS INTEGER)),
+                        MessageId TEXT,
+                        ToHeader TEXT,
+                        CcHeader TEXT,
+                        DateHeader TEXT,
+                        ContentType TEXT,
+                        HtmlBody TEXT,
+                        Size INTEGER,
+                        RawMessage BLOB,
+                        RawCompressed INTEGER,
+                        RawSegment INTEGER,
+                        RawOffset INTEGER,
+                        RawLength INTEGER
+                    )"""
+
+# Adds the columns new in version 3 to a version 2 MailLog
+ADD_MAIL_LOG_V3_COLUMNS_SQL = (
+    'ALTER TABLE MailLog ADD COLUMN MessageId TEXT',
+    'ALTER TABLE MailLog ADD COLUMN ToHeader TEXT',
+    'ALTER TABLE MailLog ADD COLUMN CcHeader TEXT',
+    'ALTER TABLE MailLog ADD COLUMN DateHeader TEXT',
+    'ALTER TABLE MailLog ADD COLUMN ContentType TEXT',
+    'ALTER TABLE MailLog ADD COLUMN HtmlBody TEXT',
+    'ALTER TABLE MailLog ADD COLUMN Size INTEGER',
+    'ALTER TABLE MailLog ADD COLUMN RawMessage BLOB')
+
+# Adds the column new in version 5 to a version 3 or 4 MailLog, and drops the version
+# 4 full-text index triggers, to be recreated reading compressed bodies
+UPGRADE_MAIL_LOG_V5_SQL = (
+    'ALTER TABLE MailLog ADD COLUMN RawCompressed INTEGER',
+    'DROP TRIGGER IF EXISTS TR_MailSearch_Insert',
+    'DROP TRIGGER IF EXISTS TR_MailSearch_Delete',
+    'DROP TRIGGER IF EXISTS TR_MailSearch_Update')
+
+# Adds the columns new in version 7 to an earlier MailLog
+ADD_MAIL_LOG_V7_COLUMNS_SQL = (
+    'ALTER TABLE MailLog ADD COLUMN RawSegment INTEGER',
+    'ALTER TABLE MailLog ADD COLUMN RawOffset INTEGER',
+    'ALTER TABLE MailLog ADD COLUMN RawLength INTEGER')
+
+# Holds the last MailLogId handed out, so MailLogIds are never reused even once
+# the emails with the highest MailLogIds have been deleted. A database is Sealed
+# once a newer partition has taken over from it (see open_partition), after which
+# no more emails can be inserted into it
+CREATE_MAIL_LOG_SEQUENCE_SQL = 'CREATE TABLE IF NOT EXISTS MailLogSequence (LastMailLogId INTEGER NOT NULL, Sealed INTEGER NOT NULL DEFAULT 0)'
+
+# Adds the column new in version 8 to an earlier MailLogSequence
+ADD_MAIL_LOG_SEQUENCE_V8_COLUMN_SQL = 'ALTER TABLE MailLogSequence ADD COLUMN Sealed INTEGER NOT NULL DEFAULT 0'
+
+# Reserves the next ? MailLogIds; LastMailLogId is then the last one of them. Nothing
+# is reserved in a sealed database
+RESERVE_MAIL_IDS_SQL = 'UPDATE MailLogSequence SET LastMailLogId = MAX(LastMailLogId, (SELECT COALESCE(MAX(MailLogId), 0) FROM MailLog)) + ? WHERE Sealed = 0'
+
+# The last MailLogId handed out from a database, for the next partition to carry on from
+SELECT_HIGHEST_MAIL_ID_SQL = 'SELECT MAX(LastMailLogId, (SELECT COALESCE(MAX(MailLogId), 0) FROM MailLog)) FROM MailLogSequence'
+
+SEAL_MAIL_LOG_SEQUENCE_SQL = 'UPDATE MailLogSequence SET Sealed = 1'
+
+SELECT_SEALED_SQL = 'SELECT Sealed FROM MailLogSequence'
+
+# Carries on from the last MailLogId handed out from another database, and unseals
+SEED_MAIL_LOG_SEQUENCE_SQL = 'UPDATE MailLogSequence SET LastMailLogId = MAX(LastMailLogId, ?), Sealed = 0'
+
+SELECT_LAST_RESERVED_MAIL_ID_SQL = 'SELECT LastMailLogId FROM MailLogSequence'
+
+# Each email is inserted from a row of (ip, port, subject, sender, recipients, body,
+# message_id, to, cc, date, content_type, html_body, size, raw, raw_compressed,
+# attachments); rows can stop after the body, the rest then being NULL. The
+# recipients of a received email are a list (see recipients_text), and the
+# attachments are a list of rows from extract_attachments. The last three values
+# are where the raw message was written to a segment log, if it was (see insert_mails)
+INSERT_MAIL_SQL = """INSERT INTO MailLog(MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body,
+                        MessageId, ToHeader, CcHeader, DateHeader, ContentType, HtmlBody, Size, RawMessage, RawCompressed,
+                        RawSegment, RawOffset, RawLength)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+MAIL_ROW_LENGTH = 16
+
+ROW_RECIPIENTS = 4
+
+# Positions in a row of the values compress_row can compress
+ROW_BODY = 5
+ROW_HTML_BODY = 11
+ROW_SIZE = 12
+ROW_RAW = 13
+ROW_RAW_COMPRESSED = 14
+ROW_ATTACHMENTS = 15
+
+# Positions in an attachment's row (see extract_attachments)
+ATTACHMENT_DATA = 2
+ATTACHMENT_COMPRESSED = 3
+
+# The columns returned by the API, with the port and TimeStamp in their version 1 formats.
+# The raw message isn't returned, as it can be large, and bodies are decompressed
+MAIL_COLUMNS = """MailLogId, IPAddress, CAST(PortNumber AS TEXT) AS PortNumber, Subject, Sender, Recipients,
+                    smtpy_text(Body) AS Body,
+                    STRFTIME('%Y-%m-%d %H:%M:%S', TimeStamp / 1000, 'unixepoch') AS TimeStamp,
+                    MessageId, ToHeader, CcHeader, DateHeader, ContentType, smtpy_text(HtmlBody) AS HtmlBody,
+                    COALESCE(Size, LENGTH(CAST(Body AS BLOB))) AS Size"""
+
+SELECT_MAIL_SQL = 'SELECT ' + MAIL_COLUMNS + ' FROM MailLog WHERE MailLogId = ?'
+
+SELECT_MAIL_BY_SENDER_SQL = 'SELECT ' + MAIL_COLUMNS + ' FROM MailLog WHERE Sender = ? ORDER BY MailLogId DESC LIMIT ?'
+
+# As above, but only emails after a MailLogId
+SELECT_MAIL_BY_SENDER_AFTER_SQL = 'SELECT ' + MAIL_COLUMNS + ' FROM MailLog WHERE Sender = ? AND MailLogId > ? ORDER BY MailLogId DESC LIMIT ?'
+
+# Recipients are looked up by their case-folded address (see fold_address), or domain
+SELECT_MAIL_BY_RECIPIENT_SQL = 'SELECT ' + MAIL_COLUMNS + """ FROM MailLog WHERE MailLogId IN
+                    (SELECT MailLogId FROM MailRecipient WHERE Address = ? ORDER BY MailLogId DESC LIMIT ?)
+                    ORDER BY MailLogId DESC"""
+
+SELECT_MAIL_BY_RECIPIENT_AFTER_SQL = 'SELECT ' + MAIL_COLUMNS + """ FROM MailLog WHERE MailLogId IN
+                    (SELECT MailLogId FROM MailRecipient WHERE Address = ? AND MailLogId > ? ORDER BY MailLogId DESC LIMIT ?)
+                    ORDER BY MailLogId DESC"""
+
+SELECT_MAIL_BY_DOMAIN_SQL = 'SELECT ' + MAIL_COLUMNS + """ FROM MailLog WHERE MailLogId IN
+                    (SELECT DISTINCT MailLogId FROM MailRecipient WHERE Domain = ? ORDER BY MailLogId DESC LIMIT ?)
+                    ORDER BY MailLogId DESC"""
+
+SELECT_MAIL_BY_DOMAIN_AFTER_SQL = 'SELECT ' + MAIL_COLUMNS + """ FROM MailLog WHERE MailLogId IN
+                    (SELECT DISTINCT MailLogId FROM MailRecipient WHERE Domain = ? AND MailLogId > ? ORDER BY MailLogId DESC LIMIT ?)
+                    ORDER BY MailLogId DESC"""
+
+# Summaries of up to ? emails after a MailLogId, oldest first, optionally only those
+# from a sender and/or to a recipient (an empty string means any). MailLogIds are
+# given out and committed in order, so following on from the last MailLogId seen
+# never misses an email
+SELECT_MAIL_SUMMARIES_AFTER_SQL = """SELECT MailLogId, Sender, Recipients, Subject, COALESCE(Size, LENGTH(CAST(Body AS BLOB))) AS Size
+                    FROM MailLog WHERE MailLogId > ? AND (? = '' OR Sender = ?) AND (? = '' OR EXISTS
+                        (SELECT 1 FROM MailRecipient WHERE Address = ? AND MailRecipient.MailLogId = MailLog.MailLogId))
+                    ORDER BY MailLogId LIMIT ?"""
+
+# The last MailLogId stored, if there are any emails
+SELECT_LAST_MAIL_ID_SQL = 'SELECT MailLogId FROM MailLog ORDER BY MailLogId DESC LIMIT 1'
+
+DELETE_MAIL_SQL = 'DELETE FROM MailLog WHERE MailLogId = ?'
+
+DELETE_MAIL_BY_SENDER_SQL = 'DELETE FROM MailLog WHERE Sender = ?'
+
+CREATE_MAIL_LOG_TIMESTAMP_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS IX_MailLog_TimeStamp ON MailLog(TimeStamp)'
+
+CREATE_MAIL_LOG_SENDER_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS IX_MailLog_Sender ON MailLog(Sender)'
+
+# Only the emails with their raw message in a segment log are indexed by segment
+CREATE_MAIL_LOG_SEGMENT_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS IX_MailLog_RawSegment ON MailLog(RawSegment) WHERE RawSegment IS NOT NULL'
+
+# The oldest segment any email still has its raw message in
+SELECT_FIRST_RAW_SEGMENT_SQL = 'SELECT MIN(RawSegment) FROM MailLog WHERE RawSegment IS NOT NULL'
+
+# One row for each recipient of an email, with their address case-folded and its
+# domain, so emails can be looked up by recipient or domain using the indexes
+CREATE_MAIL_RECIPIENT_SQL = """CREATE TABLE IF NOT EXISTS MailRecipient
+                    (
+                        MailLogId INTEGER NOT NULL,
+                        Address TEXT NOT NULL,
+                        Domain TEXT NOT NULL
+                    )"""
+
+CREATE_MAIL_RECIPIENT_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS IX_MailRecipient_Address ON MailRecipient(Address, MailLogId)',
+    'CREATE INDEX IF NOT EXISTS IX_MailRecipient_Domain ON MailRecipient(Domain, MailLogId)',
+    'CREATE INDEX IF NOT EXISTS IX_MailRecipient_MailLogId ON MailRecipient(MailLogId)')
+
+# However an email is deleted (by the API, or when purged), its recipients go with it
+CREATE_MAIL_LOG_DELETE_TRIGGER_SQL = """CREATE TRIGGER IF NOT EXISTS TR_MailLog_Delete AFTER DELETE ON MailLog
+                    BEGIN
+                        DELETE FROM MailRecipient WHERE MailLogId = OLD.MailLogId;
+                    END"""
+
+INSERT_MAIL_RECIPIENT_SQL = 'INSERT INTO MailRecipient(MailLogId, Address, Domain) VALUES (?, ?, ?)'
+
+# Full-text index of each email's Subject and Body. The text itself isn't stored
+# again, as the index reads it from MailLog (an FTS5 'external content' table)
+CREATE_MAIL_SEARCH_SQL = """CREATE VIRTUAL TABLE IF NOT EXISTS MailSearch USING fts5
+                    (
+                        Subject, Body,
+                        content = 'MailLog', content_rowid = 'MailLogId',
+                        tokenize = 'unicode61 remove_diacritics 2'
+                    )"""
+
+# The index is kept in step with MailLog by these triggers, so emails are indexed as
+# they're stored, and each deleted email (by the API, or when purged) is removed
+# from it on its own, without rebuilding the index.
+#
+# A compressed Body has to be indexed as text with smtpy_text(), which only exists on
+# connections from connect(). So the triggers only use it if compression is enabled,
+# or any Body is already compressed (see create_search_triggers); otherwise they index
+# the Body as it is, and emails can be inserted or deleted by any SQLite client, such
+# as the sqlite3 shell
+MAIL_SEARCH_TRIGGERS_SQL = (
+    """CREATE TRIGGER IF NOT EXISTS TR_MailSearch_Insert AFTER INSERT ON MailLog
+                    BEGIN
+                        INSERT INTO MailSearch(rowid, Subject, Body) VALUES (NEW.MailLogId, NEW.Subject, %(new_body)s);
+                    END""",
+    """CREATE TRIGGER IF NOT EXISTS TR_MailSearch_Delete AFTER DELETE ON MailLog
+                    BEGIN
+                        INSERT INTO MailSearch(MailSearch, rowid, Subject, Body) VALUES ('delete', OLD.MailLogId, OLD.Subject, %(old_body)s);
+                    END""",
+    """CREATE TRIGGER IF NOT EXISTS TR_MailSearch_Update AFTER UPDATE OF Subject, Body ON MailLog
+                    BEGIN
+                        INSERT INTO MailSearch(MailSearch, rowid, Subject, Body) VALUES ('delete', OLD.MailLogId, OLD.Subject, %(old_body)s);
+                        INSERT INTO MailSearch(rowid, Subject, Body) VALUES (NEW.MailLogId, NEW.Subject, %(new_body)s);
+                    END""")
+
+CREATE_MAIL_SEARCH_TRIGGERS_SQL = tuple(sql % {'new_body': 'NEW.Body', 'old_body': 'OLD.Body'}
+                                        for sql in MAIL_SEARCH_TRIGGERS_SQL)
+
+CREATE_MAIL_SEARCH_TEXT_TRIGGERS_SQL = tuple(sql % {'new_body': 'smtpy_text(NEW.Body)', 'old_body': 'smtpy_text(OLD.Body)'}
+                                             for sql in MAIL_SEARCH_TRIGGERS_SQL)
+
+DROP_MAIL_SEARCH_TRIGGERS_SQL = ('DROP TRIGGER IF EXISTS TR_MailSearch_Insert',
+                                 'DROP TRIGGER IF EXISTS TR_MailSearch_Delete',
+                                 'DROP TRIGGER IF EXISTS TR_MailSearch_Update')
+
+SELECT_MAIL_SEARCH_TRIGGER_SQL = "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'TR_MailSearch_Insert'"
+
+SELECT_ANY_COMPRESSED_BODY_SQL = "SELECT 1 FROM MailLog WHERE typeof(Body) = 'blob' LIMIT 1"
+
+# Indexes the emails already in MailLog, when MailSearch is first created. This reads
+# the bodies as stored, so must only be run before any have been compressed
+REBUILD_MAIL_SEARCH_SQL = "INSERT INTO MailSearch(MailSearch) VALUES ('rebuild')"
+
+# Attachments, stored once for however many emails they're attached to. Each is keyed
+# by the SHA-256 of its content as it was sent (eg: in base64), and RefCount is the
+# number of MailAttachment rows using it. Unused attachments (a RefCount of 0) are
+# deleted by the MailSweeper, rather than as soon as the last email using them is
+CREATE_MAIL_BLOB_SQL = """CREATE TABLE IF NOT EXISTS MailBlob
+                    (
+                        BlobHash TEXT PRIMARY KEY,
+                        Data BLOB NOT NULL,
+                        Compressed INTEGER,
+                        RefCount INTEGER NOT NULL
+                    )"""
+
+CREATE_MAIL_BLOB_UNUSED_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS IX_MailBlob_Unused ON MailBlob(RefCount) WHERE RefCount <= 0'
+
+# The attachments of each email. Their content has been taken out of the email's
+# RawMessage, and goes back in at Position (see read_raw_message)
+CREATE_MAIL_ATTACHMENT_SQL = """CREATE TABLE IF NOT EXISTS MailAttachment
+                    (
+                        MailLogId INTEGER NOT NULL,
+                        Position INTEGER NOT NULL,
+                        BlobHash TEXT NOT NULL,
+                        FileName TEXT,
+                        ContentType TEXT,
+                        ContentId TEXT,
+                        TransferEncoding TEXT,
+                        Size INTEGER NOT NULL
+                    )"""
+
+CREATE_MAIL_ATTACHMENT_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS IX_MailAttachment_MailLogId ON MailAttachment(MailLogId, Position)'
+
+# A deleted email's attachments go with it, each releasing its MailBlob
+CREATE_MAIL_ATTACHMENT_TRIGGERS_SQL = (
+    """CREATE TRIGGER IF NOT EXISTS TR_MailAttachment_MailLog_Delete AFTER DELETE ON MailLog
+                    BEGIN
+                        DELETE FROM MailAttachment WHERE MailLogId = OLD.MailLogId;
+                    END""",
+    """CREATE TRIGGER IF NOT EXISTS TR_MailAttachment_Delete AFTER DELETE ON MailAttachment
+                    BEGIN
+                        UPDATE MailBlob SET RefCount = RefCount - 1 WHERE BlobHash = OLD.BlobHash;
+                    END""")
+
+# Stores an attachment, or if it's already stored, uses it once more
+UPSERT_MAIL_BLOB_SQL = """INSERT INTO MailBlob(BlobHash, Data, Compressed, RefCount) VALUES (?, ?, ?, 1)
+                    ON CONFLICT(BlobHash) DO UPDATE SET RefCount = RefCount + 1"""
+
+SELECT_MAIL_BLOB_ROWID_SQL = 'SELECT rowid FROM MailBlob WHERE BlobHash = ?'
+
+USE_MAIL_BLOB_SQL = 'UPDATE MailBlob SET RefCount = RefCount + 1 WHERE BlobHash = ?'
+
+# Stores an attachment that's still spooled (see SpooledData) as a blob of zeros the
+# size of it, for it to be copied into (see write_blob)
+INSERT_SPOOLED_MAIL_BLOB_SQL = 'INSERT INTO MailBlob(BlobHash, Data, Compressed, RefCount) VALUES (?, zeroblob(?), NULL, 1)'
+
+# Likewise makes room for an email's raw message that's still spooled
+RESERVE_RAW_MESSAGE_SQL = 'UPDATE MailLog SET RawMessage = zeroblob(?) WHERE MailLogId = ?'
+
+INSERT_MAIL_ATTACHMENT_SQL = """INSERT INTO MailAttachment(MailLogId, Position, BlobHash, FileName, ContentType, ContentId, TransferEncoding, Size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+SELECT_MAIL_ATTACHMENTS_SQL = """SELECT FileName, ContentType, ContentId, TransferEncoding, Size, BlobHash
+                    FROM MailAttachment WHERE MailLogId = ? ORDER BY Position"""
+
+SELECT_RAW_MESSAGE_SQL = 'SELECT RawMessage, RawCompressed, RawSegment, RawOffset, RawLength FROM MailLog WHERE MailLogId = ?'
+
+# The size of an email's raw message as stored, whether it's compressed, whether
+# any attachments have been taken out of it, and where it is in the segment log
+SELECT_RAW_MESSAGE_INFO_SQL = """SELECT COALESCE(LENGTH(RawMessage), RawLength), RawCompressed,
+                        EXISTS (SELECT 1 FROM MailAttachment WHERE MailAttachment.MailLogId = MailLog.MailLogId),
+                        RawSegment, RawOffset
+                    FROM MailLog WHERE MailLogId = ?"""
+
+SELECT_MAIL_ATTACHMENT_DATA_SQL = """SELECT Position, Data, Compressed FROM MailAttachment JOIN MailBlob USING (BlobHash)
+                    WHERE MailLogId = ? ORDER BY Position"""
+
+# Deletes up to ? of the attachments no email uses any more
+DELETE_UNUSED_MAIL_BLOBS_SQL = """DELETE FROM MailBlob WHERE BlobHash IN
+                    (SELECT BlobHash FROM MailBlob WHERE RefCount <= 0 LIMIT ?)"""
+
+# Up to ? emails matching a full-text query, best match first, with the MatchRank
+# they're ordered by. Matches in the Subject count for ten times those in the Body
+SEARCH_MAIL_SQL = 'SELECT ' + MAIL_COLUMNS + """, MatchRank FROM MailLog JOIN
+                    (SELECT rowid AS MatchId, bm25(MailSearch, 10.0, 1.0) AS MatchRank FROM MailSearch
+                        WHERE MailSearch MATCH ? ORDER BY MatchRank LIMIT ?)
+                    ON MailLogId = MatchId ORDER BY MatchRank"""
+
+# Deletes up to ? emails older than ? (a TimeStamp in milliseconds).
+# The index on TimeStamp means this only ever touches the rows it deletes.
+PURGE_MAIL_SQL = """DELETE FROM MailLog WHERE MailLogId IN
+                    (SELECT MailLogId FROM MailLog WHERE TimeStamp < ? LIMIT ?)"""
+
+# A version 1 MailLog is renamed to this by create_schema, and its emails are then
+# moved over to the new MailLog by migrate()
+LEGACY_MAIL_LOG = 'MailLog_v1'
+
+# Drops the version 1 MailLog's trigger and indexes, so the names can be reused
+DROP_LEGACY_OBJECTS_SQL = (
+    'DROP TRIGGER IF EXISTS TR_MailLog_Delete',
+    'DROP INDEX IF EXISTS IX_MailLog_TimeStamp',
+    'DROP INDEX IF EXISTS IX_MailLog_Sender')
+
+SELECT_LEGACY_MAIL_SQL = 'SELECT MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp FROM ' + LEGACY_MAIL_LOG + ' ORDER BY MailLogId DESC LIMIT ?'
+
+# Version 1 TimeStamps are text in UTC, eg: '2015-07-01 12:00:00'
+INSERT_LEGACY_MAIL_SQL = """INSERT OR IGNORE INTO MailLog(MailLogId, IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(CAST(ROUND((JULIANDAY(?) - 2440587.5) * 86400000) AS INTEGER), 0))"""
+
+DELETE_LEGACY_MAIL_SQL = 'DELETE FROM ' + LEGACY_MAIL_LOG + ' WHERE MailLogId >= ?'
+
+# Queued to tell the writer thread to flush and stop. This has to survive
+# being pickled through a multiprocessing queue, so it can't be a bare object()
+_STOP = None
+
+# Bytes copied at a time from data still in the file an email was spooled to
+COPY_CHUNK_SIZE = 1048576
+
+
+# Data of a received email still in the file it was spooled to, as the memory map it
+# was parsed through (see smtpy_mime.message_data): the parts of the map given by
+# pieces, as (start, end), one after another. A row's raw message and attachments
+# can be these, and are then copied into storage a chunk at a time, so an email too
+# big to have been received into memory isn't read into it to be stored either.
+# All of an email's data shares the one map, which close() closes
+class SpooledData(object):
+
+    def __init__(self, data, pieces):
+        self.data = data
+        self.pieces = pieces
+        self.size = sum(end - start for start, end in pieces)
+
+    def __len__(self):
+        return self.size
+
+    # Yields the data, up to COPY_CHUNK_SIZE bytes at a time
+    def chunks(self):
+        for start, end in self.pieces:
+            for pos in range(start, end, COPY_CHUNK_SIZE):
+                yield self.data[pos:min(pos + COPY_CHUNK_SIZE, end)]
+
+    # Returns all of the data, read into memory
+    def read(self):
+        return b''.join(self.chunks())
+
+    def close(self):
+        self.data.close()
+
+
+# Returns the chunks of a raw message or attachment's data, which is either bytes
+# or SpooledData
+def data_chunks(data):
+    return data.chunks() if isinstance(data, SpooledData) else (data,)
+
+
+# Returns the SHA-256 (in hex) of a raw message or attachment's data
+def hash_data(data):
+    digest = hashlib.sha256()
+    for chunk in data_chunks(data):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Returns the SpooledData of a row (its raw message and attachments that are)
+def spooled_data(row):
+    values = []
+    if len(row) > ROW_RAW and isinstance(row[ROW_RAW], SpooledData):
+        values.append(row[ROW_RAW])
+    if len(row) > ROW_ATTACHMENTS and row[ROW_ATTACHMENTS]:
+        values.extend(a[ATTACHMENT_DATA] for a in row[ROW_ATTACHMENTS] if isinstance(a[ATTACHMENT_DATA], SpooledData))
+    return values
+
+
+# Returns a row with any of its data that's still spooled read into memory, eg: to
+# pickle it onto a multiprocessing queue, or for a MemoryStore to keep
+def read_row(row):
+    if not spooled_data(row):
+        return row
+    row = list(row)
+    if isinstance(row[ROW_RAW], SpooledData):
+        row[ROW_RAW] = row[ROW_RAW].read()
+    if len(row) > ROW_ATTACHMENTS and row[ROW_ATTACHMENTS]:
+        row[ROW_ATTACHMENTS] = [
+            a[:ATTACHMENT_DATA] + (a[ATTACHMENT_DATA].read(),) + a[ATTACHMENT_DATA + 1:]
+            if isinstance(a[ATTACHMENT_DATA], SpooledData) else a
+            for a in row[ROW_ATTACHMENTS]]
+    return tuple(row)
+
+
+# Closes the file a row's data was spooled to, once it has been stored
+def close_row(row):
+    for data in spooled_data(row):
+        data.close()
+
+
+# Copies spooled data into a blob the size of it (eg: made with zeroblob()), a chunk
+# at a time, as SQLite's incremental blob I/O allows
+def write_blob(conn, table, column, rowid, data):
+    with conn.blobopen(table, column, rowid) as blob:
+        for chunk in data.chunks():
+            blob.write(chunk)
+
+
+# Returns the list of addresses from an email's recipients. Received emails have
+# them as a list, which is stored as its repr (eg: "['a@b.com']"), while emails
+# created through the API have them comma separated. Only the stored repr, as read
+# back or from an older version, has to be parsed
+def recipient_list(recipients):
+    if isinstance(recipients, (list, tuple)):
+        return [str(r) for r in recipients]
+    recipients = str(recipients)
+    if recipients.startswith('['):
+        try:
+            value = ast.literal_eval(recipients)
+            if isinstance(value, (list, tuple)):
+                return [str(v) for v in value]
+        except (ValueError, SyntaxError):
+            pass
+    return [r.strip() for r in recipients.split(',') if r.strip()]
+
+
+# Returns an email's recipients as they're stored in the Recipients column: a list
+# as its repr, as smtpy has always stored them for received emails, and anything
+# else (such as an API's comma separated recipients) as it is
+def recipients_text(recipients):
+    if isinstance(recipients, (list, tuple)):
+        return str([str(r) for r in recipients])
+    return recipients
+
+
+# Returns an email address in the form recipients are looked up by
+def fold_address(address):
+    return address.strip().strip('<>').casefold()
+
+
+# Returns the (MailLogId, Address, Domain) rows to insert for an email's recipients
+def recipient_rows(mail_log_id, recipients):
+    rows = []
+    for address in dict.fromkeys(fold_address(r) for r in recipient_list(recipients)):
+        rows.append((mail_log_id, address, address.rpartition('@')[2]))
+    return rows
+
+
+# Inserts emails, as rows for INSERT_MAIL_SQL, along with their recipients and
+# attachments. This must be run in a transaction. The emails are given consecutive
+# MailLogIds, reserved with one update of MailLogSequence, and the last of them is
+# returned. If their raw messages have been written to a segment log, locations has
+# the (segment, offset, length) of each (or None for an email without one), and the
+# raw messages aren't stored in MailLog. Raw messages and attachments that are still
+# spooled (see SpooledData) are copied into their blobs a chunk at a time.
+#
+# Attachments already stored are only used once more. Those that aren't are stored
+# compressed if they're at least threshold bytes long (see compress), so only they
+# are ever compressed
+def insert_mails(conn, rows, locations=None, threshold=0, level=6):
+    blob_io = hasattr(conn, 'blobopen')
+    curs = conn.cursor()
+    curs.row_factory = None
+    if curs.execute(RESERVE_MAIL_IDS_SQL, (len(rows),)).rowcount == 0:
+        curs.close()
+        raise sqlite3.OperationalError('database is sealed, as a newer partition has taken over from it')
+    last_id = curs.execute(SELECT_LAST_RESERVED_MAIL_ID_SQL).fetchone()[0]
+    first_id = last_id - len(rows) + 1
+
+    mails = []
+    spooled = []
+    for i, row in enumerate(rows):
+        mail = (first_id + i,) + tuple(row[:ROW_ATTACHMENTS]) + (None,) * (ROW_ATTACHMENTS - len(row))
+        mail = mail[:ROW_RECIPIENTS + 1] + (recipients_text(row[ROW_RECIPIENTS]),) + mail[ROW_RECIPIENTS + 2:]
+        location = locations[i] if locations is not None else None
+        if location is not None:
+            mail = mail[:ROW_RAW + 1] + (None,) + mail[ROW_RAW + 2:] + tuple(location)
+        else:
+            raw = mail[ROW_RAW + 1]
+            if isinstance(raw, SpooledData):
+                if blob_io:
+                    spooled.append((first_id + i, raw))
+                    raw = None
+                else:
+                    raw = raw.read()
+                mail = mail[:ROW_RAW + 1] + (raw,) + mail[ROW_RAW + 2:]
+            mail += (None, None, None)
+        mails.append(mail)
+    curs.executemany(INSERT_MAIL_SQL, mails)
+    for mail_log_id, raw in spooled:
+        curs.execute(RESERVE_RAW_MESSAGE_SQL, (len(raw), mail_log_id))
+        write_blob(conn, 'MailLog', 'RawMessage', mail_log_id, raw)
+
+    recipients = []
+    blobs = []
+    attachments = []
+    for i, row in enumerate(rows):
+        recipients.extend(recipient_rows(first_id + i, row[ROW_RECIPIENTS]))
+        if len(row) > ROW_ATTACHMENTS and row[ROW_ATTACHMENTS]:
+            for position, blob_hash, data, compressed, size, filename, content_type, content_id, transfer_encoding in row[ROW_ATTACHMENTS]:
+                blobs.append((blob_hash, data, compressed))
+                attachments.append((first_id + i, position, blob_hash, filename, content_type, content_id, transfer_encoding, size))
+    curs.executemany(INSERT_MAIL_RECIPIENT_SQL, recipients)
+    for blob_hash, data, compressed in blobs:
+        if curs.execute(SELECT_MAIL_BLOB_ROWID_SQL, (blob_hash,)).fetchone() is not None:
+            curs.execute(USE_MAIL_BLOB_SQL, (blob_hash,))
+            continue
+        if threshold > 0 and not compressed:
+            packed = compress(data, threshold, level)
+            if packed is not None:
+                data, compressed = packed, 1
+        if isinstance(data, SpooledData):
+            if blob_io:
+                curs.execute(INSERT_SPOOLED_MAIL_BLOB_SQL, (blob_hash, len(data)))
+                write_blob(conn, 'MailBlob', 'Data', curs.lastrowid, data)
+                continue
+            data = data.read()
+        curs.execute(UPSERT_MAIL_BLOB_SQL, (blob_hash, data, compressed))
+    if attachments:
+        curs.executemany(INSERT_MAIL_ATTACHMENT_SQL, attachments)
+    curs.close()
+    return last_id
+
+
+# Takes the attachments (smtpy_mime.Attachment) of at least threshold bytes out of an
+# email's raw message, returning what's left of the raw message, and a row for each
+# attachment taken of (position, blob_hash, data, compressed, size, filename,
+# content_type, content_id, transfer_encoding). The position is where its data goes
+# back into what's left. A threshold of 0 means none are taken.
+#
+# For an email parsed from the file it was spooled to (whose raw message is a memory
+# map), what's left and the attachments' data are SpooledData of that map, and are
+# only hashed here, a chunk at a time; nothing is copied out of the file until stored
+def extract_attachments(raw, attachments, threshold):
+    spooled = isinstance(raw, mmap.mmap)
+    pieces = []
+    rows = []
+    pos = 0
+    taken = 0
+    for attachment in (attachments if threshold > 0 else ()):
+        size = attachment.end - attachment.start
+        if size < threshold or attachment.start < pos:
+            continue
+        if spooled:
+            data = SpooledData(raw, [(attachment.start, attachment.end)])
+        else:
+            data = raw[attachment.start:attachment.end]
+        pieces.append((pos, attachment.start))
+        rows.append((attachment.start - taken, hash_data(data), data, None, size,
+                     attachment.filename, attachment.content_type, attachment.content_id,
+                     attachment.transfer_encoding))
+        taken += size
+        pos = attachment.end
+    pieces.append((pos, len(raw)))
+
+    if spooled:
+        return SpooledData(raw, pieces), rows
+    if not rows:
+        return raw, []
+    return b''.join(raw[start:end] for start, end in pieces), rows
+
+
+# Opens an email's raw message, as it was received, returning a file-like object to
+# read it from, where in it the raw message starts, and its size; or None if it has
+# no raw message. A raw message stored as received is read straight from its segment
+# file, or from the database with incremental blob I/O while the connection is kept;
+# otherwise it's put back together in memory
+def open_raw_message(conn, mail_log_id):
+    curs = conn.cursor()
+    curs.row_factory = None
+    row = curs.execute(SELECT_RAW_MESSAGE_INFO_SQL, (mail_log_id,)).fetchone()
+    curs.close()
+    if row is None or row[0] is None:
+        return None
+
+    size, compressed, has_attachments, segment, offset = row
+    if not compressed and not has_attachments:
+        if segment is not None:
+            return smtpy_segments.open_segment(segment_directory(), segment), offset, size
+        if hasattr(conn, 'blobopen'):
+            return conn.blobopen('MailLog', 'RawMessage', mail_log_id, readonly=True), 0, size
+
+    raw = read_raw_message(conn, mail_log_id)
+    return io.BytesIO(raw), 0, len(raw)
+
+
+# Returns an email's raw message as it was received (with its attachments put back),
+# or None if it has no raw message
+def read_raw_message(conn, mail_log_id):
+    curs = conn.cursor()
+    curs.row_factory = None
+    row = curs.execute(SELECT_RAW_MESSAGE_SQL, (mail_log_id,)).fetchone()
+    if row is None or (row[0] is None and row[2] is None):
+        curs.close()
+        return None
+
+    stored, compressed, segment, offset, length = row
+    if segment is not None:
+        stored = smtpy_segments.read(segment_directory(), segment, offset, length)
+    raw = join_attachments(stored, compressed, curs.execute(SELECT_MAIL_ATTACHMENT_DATA_SQL, (mail_log_id,)))
+    curs.close()
+    return raw
+
+
+# Returns a raw message as it was received, from the raw message as stored (which
+# may be compressed), and the (position, data, compressed) of each of the
+# attachments taken out of it, in order of position
+def join_attachments(stored, compressed, attachments):
+    raw = zlib.decompress(stored) if compressed else bytes(stored)
+    pieces = []
+    pos = 0
+    for position, data, compressed in attachments:
+        pieces.append(raw[pos:position])
+        pieces.append(zlib.decompress(data) if compressed else data)
+        pos = position
+
+    if not pieces:
+        return raw
+    pieces.append(raw[pos:])
+    return b''.join(pieces)
+
+
+# Returns a full-text query that searches for each of the words in text, as is.
+# Used for text that isn't a valid query, eg: 'user@domain.com' or 'C++'
+def search_terms(text):
+    return ' '.join('"%s"' % word.replace('"', '""') for word in text.split())
+
+
+# Returns the size at least which attachments are stored apart from their emails, as
+# per the storage settings. A threshold of 0 means they're always left in the email
+def attachment_threshold():
+    return config.settings.get('storage', {}).get('attachment_threshold', 0)
+
+
+# Returns the directory of the segment log raw messages are stored in, as per the
+# storage settings, or None if they're stored in the database
+def segment_directory():
+    return config.settings.get('storage', {}).get('segment_directory') or None
+
+
+# Returns the segment log for the MailWriter to store raw messages in, and the
+# MailSweeper to purge, as per the storage settings; or None if they're stored in
+# the database. Segments are synced to disk unless the database isn't
+def segment_log():
+    directory = segment_directory()
+    if directory is None:
+        return None
+    storage = config.settings.get('storage', {})
+    sync = str(storage_settings().get('synchronous', 'FULL')).upper() not in ('OFF', '0')
+    return smtpy_segments.SegmentLog(directory, int(storage.get('segment_size_mb', 64) * 1024 * 1024), sync)
+
+
+# Returns the minutes of each partition the database is split into, as per the
+# storage settings. A partition_minutes of 0 means it isn't split
+def partition_minutes():
+    return config.settings.get('storage', {}).get('partition_minutes', 0) or 0
+
+
+# Returns the minutes emails are kept for, as per the smtp settings, or None if
+# they're never purged
+def retention_minutes():
+    smtp = config.settings.get('smtp', {})
+    if smtp.get('purge_email') is not True:
+        return None
+    return smtp.get('purge_after_minutes', 30)
+
+
+# Returns the (threshold, level) bodies and raw messages are compressed with, as per
+# the storage settings. A threshold of 0 means they're never compressed
+def compression_settings():
+    storage = config.settings.get('storage', {})
+    return storage.get('compress_threshold', 0), storage.get('compress_level', 6)
+
+
+# Returns the row of an email to insert, with its bodies and raw message compressed if
+# they are at least threshold bytes long (and compressing them saves space). Its
+# attachments are left to be compressed as they're stored, and only if they aren't
+# already (see insert_mails and compress_attachments)
+def compress_row(row, threshold=0, level=6):
+    row = list(row) + [None] * (MAIL_ROW_LENGTH - len(row))
+    if threshold <= 0:
+        return tuple(row)
+
+    for i in (ROW_BODY, ROW_HTML_BODY):
+        if isinstance(row[i], str):
+            value = row[i].encode('utf-8')
+            if i == ROW_BODY and row[ROW_SIZE] is None:
+                row[ROW_SIZE] = len(value)
+            row[i] = compress(value, threshold, level) or row[i]
+
+    if row[ROW_RAW] is not None and not row[ROW_RAW_COMPRESSED]:
+        raw = compress(row[ROW_RAW], threshold, level)
+        if raw is not None:
+            row[ROW_RAW], row[ROW_RAW_COMPRESSED] = raw, 1
+    return tuple(row)
+
+
+# Returns the rows of attachments (see extract_attachments), with the data of those
+# of at least threshold bytes compressed, for a store that keeps every attachment
+# (rather than each only once, as insert_mails does)
+def compress_attachments(attachments, threshold=0, level=6):
+    if threshold <= 0 or not attachments:
+        return attachments
+
+    compressed = []
+    for attachment in attachments:
+        data = None if attachment[ATTACHMENT_COMPRESSED] else compress(attachment[ATTACHMENT_DATA], threshold, level)
+        if data is not None:
+            attachment = attachment[:ATTACHMENT_DATA] + (data, 1) + attachment[ATTACHMENT_COMPRESSED + 1:]
+        compressed.append(attachment)
+    return compressed
+
+
+# Returns data compressed, or None if it's shorter than threshold or doesn't shrink.
+# SpooledData is compressed a chunk at a time
+def compress(data, threshold, level=6):
+    if len(data) < threshold:
+        return None
+    if isinstance(data, SpooledData):
+        compressor = zlib.compressobj(level)
+        compressed = b''.join([compressor.compress(chunk) for chunk in data.chunks()] + [compressor.flush()])
+    else:
+        compressed = zlib.compress(data, level)
+    if len(compressed) >= len(data):
+        return None
+    return compressed
+
+
+# The smtpy_text() SQL function: returns a Body or HtmlBody as text, decompressing it
+# if it was stored compressed
+def inflate_text(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8', 'replace')
+    return value
+
+
+# Opens a new connection to the smtpy database, with the storage settings applied.
+# A read_only connection can only query the database (which must already exist),
+# and isn't able to write to it
+def connect(database=None, read_only=False, check_same_thread=True):
+    database = database or config.settings['database']
+    if not read_only:
+        conn = sqlite3.connect(database, cached_statements=CACHED_STATEMENTS,
+                               check_same_thread=check_same_thread)
+    else:
+        uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(database))
+        conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS,
+                               check_same_thread=check_same_thread)
+        conn.execute('PRAGMA query_only = ON')
+
+    try:
+        conn.create_function('smtpy_text', 1, inflate_text, deterministic=True)
+        apply_storage_settings(conn, read_only)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+# Returns the storage PRAGMAs to use: the storage profile's, with any overrides
+def storage_settings():
+    storage = config.settings.get('storage', {})
+    profile = storage.get('profile', 'durable')
+    if profile not in STORAGE_PROFILES:
+        raise ValueError('unknown storage profile %r, expected one of: %s' % (profile, ', '.join(sorted(STORAGE_PROFILES))))
+
+    settings = dict(STORAGE_PROFILES[profile])
+    for name in STORAGE_PRAGMAS:
+        if name in storage:
+            settings[name] = storage[name]
+    return settings
+
+
+def apply_storage_settings(conn, read_only=False):
+    settings = storage_settings()
+    for name in STORAGE_PRAGMAS:
+        value = settings.get(name)
+        if value is None or (read_only and name == 'journal_mode'):
+            continue
+        if not re.match('^-?[A-Za-z0-9_]+$', str(value)):
+            raise ValueError('invalid storage setting %s = %r' % (name, value))
+        conn.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+
+
+# Creates the database and the required tables, if they don't yet exist. A version
+# 1 MailLog is renamed to MailLog_v1 and a new MailLog created in its place, for the
+# emails to be moved over by migrate(); returns True if there are any to move. A
+# later MailLog just has the new columns added
+def create_schema(database=None):
+    conn = connect(database)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            if version < 2 and table_exists(conn, 'MailLog'):
+                for sql in DROP_LEGACY_OBJECTS_SQL:
+                    conn.execute(sql)
+                conn.execute('ALTER TABLE MailLog RENAME TO ' + LEGACY_MAIL_LOG)
+            elif table_exists(conn, 'MailLog'):
+                if version < 3:
+                    for sql in ADD_MAIL_LOG_V3_COLUMNS_SQL:
+                        conn.execute(sql)
+                if version < 5:
+                    for sql in UPGRADE_MAIL_LOG_V5_SQL:
+                        conn.execute(sql)
+                if version < 7:
+                    for sql in ADD_MAIL_LOG_V7_COLUMNS_SQL:
+                        conn.execute(sql)
+
+            if version < 8 and table_exists(conn, 'MailLogSequence'):
+                conn.execute(ADD_MAIL_LOG_SEQUENCE_V8_COLUMN_SQL)
+
+            new_recipients = not table_exists(conn, 'MailRecipient')
+            new_search = not table_exists(conn, 'MailSearch')
+            create_tables(conn)
+            if new_search:
+                conn.execute(REBUILD_MAIL_SEARCH_SQL)
+
+            # Carry on from the last MailLogId the version 1 MailLog handed out
+            if table_exists(conn, LEGACY_MAIL_LOG):
+                last_id = conn.execute('SELECT COALESCE(MAX(MailLogId), 0) FROM ' + LEGACY_MAIL_LOG).fetchone()[0]
+                if table_exists(conn, 'sqlite_sequence'):
+                    seq = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (LEGACY_MAIL_LOG,)).fetchone()
+                    last_id = max(last_id, seq[0] if seq else 0)
+                conn.execute('UPDATE MailLogSequence SET LastMailLogId = MAX(LastMailLogId, ?)', (last_id,))
+
+                if new_recipients:
+                    for mail_log_id, recipients in conn.execute('SELECT MailLogId, Recipients FROM ' + LEGACY_MAIL_LOG).fetchall():
+                        conn.executemany(INSERT_MAIL_RECIPIENT_SQL, recipient_rows(mail_log_id, recipients or ''))
+
+            conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        else:
+            create_tables(conn)
+        if partition_minutes() <= 0:
+            unseal(conn, database or config.settings['database'])
+        conn.commit()
+
+        return table_exists(conn, LEGACY_MAIL_LOG)
+    finally:
+        conn.close()
+
+
+def create_tables(conn):
+    conn.execute(CREATE_MAIL_LOG_SQL)
+    conn.execute(CREATE_MAIL_LOG_TIMESTAMP_INDEX_SQL)
+    conn.execute(CREATE_MAIL_LOG_SENDER_INDEX_SQL)
+    conn.execute(CREATE_MAIL_LOG_SEGMENT_INDEX_SQL)
+    conn.execute(CREATE_MAIL_LOG_SEQUENCE_SQL)
+    conn.execute('INSERT INTO MailLogSequence(LastMailLogId) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM MailLogSequence)')
+    conn.execute(CREATE_MAIL_RECIPIENT_SQL)
+    for sql in CREATE_MAIL_RECIPIENT_INDEXES_SQL:
+        conn.execute(sql)
+    conn.execute(CREATE_MAIL_LOG_DELETE_TRIGGER_SQL)
+    conn.execute(CREATE_MAIL_SEARCH_SQL)
+    create_search_triggers(conn)
+    conn.execute(CREATE_MAIL_BLOB_SQL)
+    conn.execute(CREATE_MAIL_BLOB_UNUSED_INDEX_SQL)
+    conn.execute(CREATE_MAIL_ATTACHMENT_SQL)
+    conn.execute(CREATE_MAIL_ATTACHMENT_INDEX_SQL)
+    for sql in CREATE_MAIL_ATTACHMENT_TRIGGERS_SQL:
+        conn.execute(sql)
+
+
+# Creates the MailSearch triggers, using smtpy_text() only if compression is enabled or
+# any Body is compressed, and replacing the existing ones if they don't. Once they're
+# using it, the emails are only checked for a compressed Body if compression has since
+# been disabled
+def create_search_triggers(conn):
+    existing = conn.execute(SELECT_MAIL_SEARCH_TRIGGER_SQL).fetchone()
+    using_text = existing is not None and 'smtpy_text' in existing[0]
+
+    use_text = compression_settings()[0] > 0
+    if not use_text and using_text:
+        use_text = conn.execute(SELECT_ANY_COMPRESSED_BODY_SQL).fetchone() is not None
+
+    if existing is not None and use_text != using_text:
+        for sql in DROP_MAIL_SEARCH_TRIGGERS_SQL:
+            conn.execute(sql)
+    for sql in (CREATE_MAIL_SEARCH_TEXT_TRIGGERS_SQL if use_text else CREATE_MAIL_SEARCH_TRIGGERS_SQL):
+        conn.execute(sql)
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+# The database can be split into partitions, one for each partition_minutes of
+# time, so purging old emails is just deleting whole files. Each partition is a
+# database of its own, next to the database and named after it with the (UTC)
+# start of its time, eg: smtpy-201507011200.db. New emails are only inserted into
+# the newest partition, and the database itself is then only read from, as the
+# oldest partition (it holds any emails from before the database was split).
+#
+# MailLogIds carry on from one partition to the next: each new partition starts
+# from the last MailLogId of the one before, which is sealed so that nothing more
+# can be inserted into it.
+PARTITION_TIME_FORMAT = '%Y%m%d%H%M'
+
+
+# Returns the path of the partition of database starting at start (seconds since the epoch)
+def partition_path(database, start):
+    root, ext = os.path.splitext(database)
+    return '%s-%s%s' % (root, time.strftime(PARTITION_TIME_FORMAT, time.gmtime(start)), ext)
+
+
+# Returns the (start, path) of each of the partitions of database, oldest first
+def partitions(database):
+    root, ext = os.path.splitext(database)
+    directory, prefix = os.path.split(root)
+    pattern = re.compile(re.escape(prefix) + r'-(\d{12})' + re.escape(ext) + '$')
+    try:
+        names = os.listdir(directory or '.')
+    except FileNotFoundError:
+        return []
+
+    found = []
+    for name in names:
+        match = pattern.match(name)
+        if match is not None:
+            start = calendar.timegm(time.strptime(match.group(1), PARTITION_TIME_FORMAT))
+            found.append((start, os.path.join(directory, name)))
+    found.sort()
+    return found
+
+
+# Returns the start of the partition_minutes long partition the time now is in
+def partition_start(now, minutes):
+    return int(now // (minutes * 60)) * minutes * 60
+
+
+# Returns the databases emails are read from, newest first: just the database, or
+# if it's split into partitions, those whose emails haven't all expired followed by
+# the database itself
+def database_paths(database=None):
+    database = database or config.settings['database']
+    minutes = partition_minutes()
+    if minutes <= 0:
+        return [database]
+
+    retention = retention_minutes()
+    cutoff = None if retention is None else time.time() - retention * 60
+    paths = [path for start, path in reversed(partitions(database))
+             if cutoff is None or start + minutes * 60 > cutoff]
+    paths.append(database)
+    return paths
+
+
+# Returns the database new emails are inserted into: the database, or if it's split
+# into partitions, the partition for now (see open_partition)
+def current_database(database=None):
+    database = database or config.settings['database']
+    minutes = partition_minutes()
+    if minutes <= 0:
+        return database
+    return open_partition(database, minutes)
+
+
+# Returns the path of the newest partition of database, first starting a new one
+# if the newest is older than the partition_minutes now is in. A new partition
+# is started while holding the write lock of the newest (or the database itself,
+# if there's no partition yet), which is then sealed, so an email can't be inserted
+# into it after the new partition has carried on from its last MailLogId
+def open_partition(database, minutes, now=None):
+    start = partition_start(time.time() if now is None else now, minutes)
+    existing = partitions(database)
+    if existing and existing[-1][0] >= start:
+        return existing[-1][1]
+
+    conn = connect(existing[-1][1] if existing else database)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+
+        # Another writer may have started it while waiting for the lock
+        existing = partitions(database)
+        if existing and existing[-1][0] >= start:
+            conn.rollback()
+            return existing[-1][1]
+
+        path = partition_path(database, start)
+        create_partition(path, conn.execute(SELECT_HIGHEST_MAIL_ID_SQL).fetchone()[0])
+        conn.execute(SEAL_MAIL_LOG_SEQUENCE_SQL)
+        conn.commit()
+        return path
+    finally:
+        conn.close()
+
+
+# Creates a partition, carrying on from last_id. It's created under another name
+# and then renamed, so it's never seen without its tables
+def create_partition(path, last_id):
+    creating = path + '.tmp'
+    create_schema(creating)
+    conn = connect(creating)
+    try:
+        with conn:
+            conn.execute(SEED_MAIL_LOG_SEQUENCE_SQL, (last_id,))
+    finally:
+        conn.close()
+    os.replace(creating, path)
+
+
+# Deletes a partition, along with its WAL files. A partition that can't be deleted
+# yet (eg: on Windows, while the API has it open) is left in place; returns whether
+# it was deleted
+def drop_partition(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    for suffix in ('-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+    return True
+
+
+# Once the database is no longer split into partitions, emails are inserted into it
+# again: it's unsealed, carrying on from the last MailLogId of the newest partition
+def unseal(conn, database):
+    row = conn.execute(SELECT_SEALED_SQL).fetchone()
+    if row is None or not row[0]:
+        return
+
+    last_id = 0
+    existing = partitions(database)
+    if existing:
+        newest = connect(existing[-1][1], read_only=True)
+        try:
+            last_id = newest.execute(SELECT_HIGHEST_MAIL_ID_SQL).fetchone()[0]
+        finally:
+            newest.close()
+    conn.execute(SEED_MAIL_LOG_SEQUENCE_SQL, (last_id,))
+
+
+# Moves the emails from a version 1 MailLog over to the new MailLog, newest first,
+# batch_size emails per transaction so ingest and the API carry on in between. The
+# port becomes an integer, the TimeStamp milliseconds, and bodies that were stored
+# as the repr of the received bytes are decoded. Returns how many were moved
+def migrate(database=None, batch_size=1000):
+    conn = connect(database)
+    total = 0
+    try:
+        while table_exists(conn, LEGACY_MAIL_LOG):
+            with conn:
+                rows = conn.execute(SELECT_LEGACY_MAIL_SQL, (batch_size,)).fetchall()
+                if rows:
+                    conn.executemany(INSERT_LEGACY_MAIL_SQL, [migrate_row(row) for row in rows])
+                    conn.execute(DELETE_LEGACY_MAIL_SQL, (rows[-1][0],))
+            if not rows:
+                conn.execute('DROP TABLE ' + LEGACY_MAIL_LOG)
+            total += len(rows)
+        return total
+    finally:
+        conn.close()
+
+
+# Converts a version 1 email's row for the new MailLog
+def migrate_row(row):
+    mail_log_id, ip, port, subject, sender, recipients, body, timestamp = row
+    try:
+        port = int(port)
+    except (TypeError, ValueError):
+        pass
+    return (mail_log_id, ip, port, subject, sender, recipients, decode_legacy_body(body), timestamp)
+
+
+# Version 1 bodies received over SMTP were the tail of the repr of the email's bytes,
+# eg: "Hello\\nWorld\\n'", on one line; those are decoded, other bodies are kept as is
+def decode_legacy_body(body):
+    if not isinstance(body, str) or '\n' in body or not body.endswith(("'", '"')):
+        return body
+    try:
+        return codecs.escape_decode(body[:-1].encode('latin-1', 'backslashreplace'))[0].decode('utf-8', 'replace')
+    except (ValueError, UnicodeError):
+        return body
+
+
+# Pool of long-lived connections, borrowed by threads for as long as they need one:
+#
+#   with pool.connection() as conn:
+#       conn.execute(...)
+#
+# Connections are kept open between borrows, so each keeps its cache of prepared
+# statements. The most recently returned connection is borrowed first, and up to
+# size idle connections are kept; beyond that returned connections are closed.
+# A connection that raised an error while borrowed is closed rather than returned.
+#
+# If the database is split into partitions, a connection can be borrowed for any
+# one of them, and up to size idle connections are kept for each. fetch() and
+# execute_all() run a statement against every partition.
+class ConnectionPool(object):
+
+    def __init__(self, database=None, size=16, read_only=False, row_factory=None):
+        self.database = database
+        self.size = max(1, size)
+        self.read_only = read_only
+        self.row_factory = row_factory
+        self._idle = []
+        self._lock = threading.Lock()
+
+    # Borrows a connection to the database, or to one of its partitions
+    @contextlib.contextmanager
+    def connection(self, database=None):
+        database = database or self.database or config.settings['database']
+        conn = self._borrow(database)
+        try:
+            yield conn
+        except BaseException:
+            self._discard(conn)
+            raise
+        self._return(database, conn)
+
+    def _borrow(self, database):
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == database:
+                    return self._idle.pop(i)[1]
+
+        conn = connect(database, read_only=self.read_only, check_same_thread=False)
+        conn.row_factory = self.row_factory
+        return conn
+
+    def _return(self, database, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if sum(1 for idle in self._idle if idle[0] == database) < self.size:
+                self._idle.append((database, conn))
+                return
+        conn.close()
+
+    # Returns the databases to read from, newest first (see database_paths). Idle
+    # connections to any others, such as partitions that have expired, are closed
+    def databases(self):
+        paths = database_paths(self.database)
+        with self._lock:
+            stale = [idle[1] for idle in self._idle if idle[0] not in paths]
+            if stale:
+                self._idle = [idle for idle in self._idle if idle[0] in paths]
+        for conn in stale:
+            self._discard(conn)
+        return paths
+
+    # Runs a query against each of the databases, newest first (or oldest first),
+    # returning all of their rows; or just the first amount, in which case the rest
+    # of the databases aren't queried once amount rows have been found. With a key,
+    # every database is queried, and their rows merged in order of key (each
+    # database's rows must already be in that order) before taking the first amount
+    def fetch(self, sql, params=(), amount=None, newest_first=True, key=None):
+        paths = self.databases()
+        main = paths[-1]
+        if not newest_first:
+            paths.reverse()
+
+        values = []
+        merged = []
+        for database in paths:
+            try:
+                with self.connection(database) as conn:
+                    rows = conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                # A partition can expire, and be deleted, while it's being queried
+                if database == main or os.path.exists(database):
+                    raise
+                continue
+            if key is not None:
+                merged.append(rows)
+                continue
+            values.extend(rows)
+            if amount is not None and len(values) >= amount:
+                return values[:amount]
+
+        if key is not None:
+            values = list(heapq.merge(*merged, key=key))
+            return values if amount is None else values[:amount]
+        return values
+
+    # Runs a statement against each of the databases, each in its own transaction
+    def execute_all(self, sql, params=()):
+        for database in self.databases():
+            with self.connection(database) as conn:
+                with conn:
+                    conn.execute(sql, params)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    # Closes all of the idle connections
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for database, conn in idle:
+            self._discard(conn)
+
+
+# Long-lived writer used to record received email. Emails are put onto a
+# bounded in-memory queue, and a background thread drains it - inserting many
+# emails per transaction with executemany. A batch is flushed once it reaches
+# batch_size emails, or once its oldest email has waited batch_delay seconds,
+# so there is one commit per batch rather than one per email.
+#
+# The writer's connection is opened on first use and kept open; if it ever
+# fails it is thrown away and reopened, and the batch is retried once.
+#
+# Once a batch is committed, on_commit is called with the MailLogId given to its
+# first email, and the batch's rows (whose MailLogIds follow on from the first).
+#
+# A multiprocessing queue can be passed in as mail_queue, in which case
+# MailWriters in other processes that are never started can put emails onto
+# it, and they will be written by the one started writer draining it.
+#
+# The started writer keeps the high_water_mark of its queue: the most emails seen
+# waiting on it at once, which can be read at any time. A writer that's never
+# started doesn't own its queue, so doesn't keep one.
+#
+# Given a SegmentLog as segments, each batch's raw messages are appended to it
+# before the batch is inserted, rather than being stored in MailLog.
+#
+# With partition_minutes, the database is split into partitions (see
+# open_partition), and each batch is inserted into the partition for the time
+# it's written.
+#
+# Attachments not already stored are compressed as they're inserted, if they're
+# at least compress_threshold bytes long (see insert_mails).
+class MailWriter(object):
+
+    def __init__(self, database=None, batch_size=500, batch_delay=0.05,
+                 queue_size=50000, on_error=None, mail_queue=None, on_commit=None,
+                 segments=None, partition_minutes=0, compress_threshold=0, compress_level=6):
+        self.database = database or config.settings['database']
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.on_error = on_error
+        self.on_commit = on_commit
+        self.segments = segments
+        self.partition_minutes = partition_minutes
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.queue = mail_queue if mail_queue is not None else queue.Queue(queue_size)
+        self.high_water_mark = 0
+        self.conn = None
+        self.conn_database = None
+        self.partition_end = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='MailWriter', daemon=True)
+            self._thread.start()
+
+    # Queues an email, where row is as for INSERT_MAIL_SQL.
+    # Raises queue.Full if the writer has fallen too far behind.
+    def put(self, row):
+        if not isinstance(self.queue, queue.Queue):
+            # A multiprocessing queue pickles the row, so nothing can be left spooled
+            spooled, row = row, read_row(row)
+            close_row(spooled)
+        self.queue.put_nowait(row)
+        if self._thread is not None:
+            self._track_size(self.queue.qsize())
+
+    def _track_size(self, size):
+        if size > self.high_water_mark:
+            self.high_water_mark = size
+
+    # Flushes anything still queued, then stops the writer thread
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        else:
+            self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            row = self.queue.get()
+            if row is _STOP:
+                break
+
+            batch = [row]
+            self._track_size(self.queue.qsize() + 1)
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    row = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+            finally:
+                for row in batch:
+                    close_row(row)
+
+        # The connection belongs to this thread, so it has to be closed here
+        self.close()
+
+    # Records a batch of emails in one transaction
+    def write_batch(self, rows):
+        locations = None
+        if self.segments is not None:
+            locations = self.write_segments(rows)
+
+        try:
+            last_id = self._write_batch(rows, locations)
+        except sqlite3.Error:
+            self._disconnect()
+            last_id = self._write_batch(rows, locations)
+
+        if self.on_commit is not None:
+            self.on_commit(last_id - len(rows) + 1, rows)
+
+    # Appends the raw messages of a batch of emails to the segment log, returning
+    # where each was written (or None for an email without one)
+    def write_segments(self, rows):
+        raws = [row[ROW_RAW] if len(row) > ROW_RAW else None for row in rows]
+        written = iter(self.segments.append([raw for raw in raws if raw is not None]))
+        return [next(written) if raw is not None else None for raw in raws]
+
+    def _write_batch(self, rows, locations=None):
+        database = self.current_database()
+        if self.conn is not None and self.conn_database != database:
+            self._disconnect()
+        if self.conn is None:
+            self.conn = connect(database)
+            self.conn_database = database
+
+        with self.conn:
+            return insert_mails(self.conn, rows, locations, self.compress_threshold, self.compress_level)
+
+    # Returns the database to insert into: the database itself, or the partition for
+    # now, which is only looked for again once its time is up (or after an error)
+    def current_database(self):
+        if self.partition_minutes <= 0:
+            return self.database
+
+        now = time.time()
+        if self.conn_database is None or now >= self.partition_end:
+            self.partition_end = partition_start(now, self.partition_minutes) + self.partition_minutes * 60
+            return open_partition(self.database, self.partition_minutes, now)
+        return self.conn_database
+
+    def _disconnect(self):
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except Exception:
+            pass
+        finally:
+            self.conn = None
+            self.conn_database = None
+
+    def close(self):
+        self._disconnect()
+        if self.segments is not None:
+            self.segments.close()
+
+
+# Background sweeper that purges old emails. Every interval seconds it deletes
+# the emails older than max_age_minutes, chunk_size emails per transaction, so
+# the database's write lock is only ever held briefly and ingest can carry on
+# in between chunks. The attachments no longer used by any email are then
+# deleted the same way.
+#
+# Given the SegmentLog raw messages are stored in as segments, whole segments are
+# then deleted once none of their emails are left.
+#
+# With partition_minutes, where the database is split into partitions (see
+# open_partition), each partition is deleted as a whole once all of its time is
+# older than max_age_minutes. Only the database itself has emails deleted from it.
+# The newest partition is always kept, for the next to carry on from.
+#
+# After each sweep, on_sweep is called with how many emails were deleted.
+class MailSweeper(object):
+
+    def __init__(self, database=None, max_age_minutes=30, interval=60,
+                 chunk_size=500, on_error=None, segments=None, partition_minutes=0,
+                 on_sweep=None):
+        self.database = database or config.settings['database']
+        self.max_age_minutes = max_age_minutes
+        self.interval = interval
+        self.chunk_size = max(1, chunk_size)
+        self.on_error = on_error
+        self.on_sweep = on_sweep
+        self.segments = segments
+        self.partition_minutes = partition_minutes
+        self.conn = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='MailSweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                deleted = self.sweep()
+            except Exception as e:
+                self.close()
+                if self.on_error is not None:
+                    self.on_error(e)
+                continue
+            if self.on_sweep is not None:
+                self.on_sweep(deleted)
+
+        # The connection belongs to this thread, so it has to be closed here
+        self.close()
+
+    # Deletes all emails older than max_age_minutes, returning how many were deleted
+    def sweep(self):
+        if self.conn is None:
+            self.conn = connect(self.database)
+
+        cutoff = int((time.time() - self.max_age_minutes * 60) * 1000)
+        total = 0
+        while not self._stopping.is_set():
+            with self.conn:
+                deleted = self.conn.execute(PURGE_MAIL_SQL, (cutoff, self.chunk_size)).rowcount
+            total += deleted
+            if deleted < self.chunk_size:
+                break
+
+        self.collect()
+        self.drop_partitions(cutoff / 1000.0)
+        self.drop_segments()
+        return total
+
+    # Deletes the attachments no email uses any more, returning how many were deleted
+    def collect(self):
+        if self.conn is None:
+            self.conn = connect(self.database)
+
+        total = 0
+        while not self._stopping.is_set():
+            with self.conn:
+                deleted = self.conn.execute(DELETE_UNUSED_MAIL_BLOBS_SQL, (self.chunk_size,)).rowcount
+            total += deleted
+            if deleted < self.chunk_size:
+                break
+        return total
+
+    # Deletes the partitions (other than the newest) whose time all comes before
+    # cutoff (in seconds since the epoch), returning how many were deleted
+    def drop_partitions(self, cutoff):
+        if self.partition_minutes <= 0:
+            return 0
+
+        dropped = 0
+        for start, path in partitions(self.database)[:-1]:
+            if start + self.partition_minutes * 60 > cutoff:
+                break
+            if drop_partition(path):
+                dropped += 1
+        return dropped
+
+    # Deletes the segments of the segment log that no email uses any more, returning
+    # how many were deleted
+    def drop_segments(self):
+        if self.segments is None:
+            return 0
+        if self.conn is None:
+            self.conn = connect(self.database)
+
+        # Listed first: any segment the writer starts from here on is newer, and kept
+        ids = self.segments.segment_ids()
+        if len(ids) < 2:
+            return 0
+
+        used = [self.conn.execute(SELECT_FIRST_RAW_SEGMENT_SQL).fetchone()[0]]
+        if self.partition_minutes > 0:
+            for start, path in partitions(self.database):
+                conn = connect(path, read_only=True)
+                try:
+                    used.append(conn.execute(SELECT_FIRST_RAW_SEGMENT_SQL).fetchone()[0])
+                finally:
+                    conn.close()
+        used = [segment for segment in used if segment is not None]
+        return self.segments.drop(ids, min(used) if used else None)
+
+    def close(self):
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except Exception:
+            pass
+        finally:
+            self.conn = None
@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+"""
+Parses the emails received by the smtpy service into the fields stored for
+each of them, so nothing has to be parsed again when they're queried.
+
+The headers are read straight from the received bytes, keeping only the
+ones stored (Subject, Message-ID, To, Cc, Date and Content-Type). A plain
+text or HTML email that isn't transfer-encoded needs nothing more, and its
+body is decoded as is. Otherwise the MIME parts are walked, again straight
+from the bytes, for the text and HTML bodies and the attachments; each
+attachment is given by where its (still encoded) content is in the email,
+so it can be stored apart from the rest of the email (see smtpy_db).
+
+An email too big to have been received into memory is parsed from the file
+it was spooled to, through a read-only memory map of it, rather than being
+read back in; its attachments are then copied out of that map a chunk at a
+time as they're stored.
+
+Subjects, To and Cc are decoded from RFC 2047 encoded-words,
+eg: '=?utf-8?q?Caf=C3=A9?=' becomes 'Café'.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import io
+import os
+import re
+import mmap
+import quopri
+import codecs
+import binascii
+import urllib.parse
+import email.errors
+import email.header
+import email.utils
+import collections
+
+
+# The fields parsed from an email. body is the text body, or the HTML body for an
+# email that only has HTML; size is the length of raw, the email as received (as
+# bytes, or the memory map of the file it was spooled to; see message_data)
+ParsedEmail = collections.namedtuple('ParsedEmail', (
+    'subject', 'message_id', 'to', 'cc', 'date', 'content_type',
+    'body', 'html_body', 'size', 'raw', 'attachments'))
+
+# An attachment (or inline image) of an email. Its content, as it was sent (eg: in
+# base64), is raw[start:end]
+Attachment = collections.namedtuple('Attachment', (
+    'start', 'end', 'filename', 'content_type', 'content_id', 'transfer_encoding'))
+
+# The headers read from each email, by their lower-cased names
+HEADERS = {
+    b'subject': 'subject',
+    b'message-id': 'message_id',
+    b'to': 'to',
+    b'cc': 'cc',
+    b'date': 'date',
+    b'content-type': 'content_type',
+    b'content-transfer-encoding': 'transfer_encoding',
+    b'content-disposition': 'disposition',
+    b'content-id': 'content_id',
+}
+
+# Headers that can hold RFC 2047 encoded-words
+ENCODED_HEADERS = ('subject', 'to', 'cc')
+
+# Transfer encodings where the body is already the text as sent
+PLAIN_TRANSFER_ENCODINGS = ('', '7bit', '8bit', 'binary')
+
+_HEADER_LINE = re.compile(rb'([!-9;-~]+)[ \t]*:')
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+# A parameter of a header, eg: boundary="abc" or filename*=utf-8''a%20b.pdf
+_PARAM = r'(?:^|;)\s*%s(\*?)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))'
+
+# Bytes that can follow a multipart boundary, on its line
+_BOUNDARY_END = (b'', b'-', b'\r', b'\n', b' ', b'\t')
+
+
+# Parses an email, given as received: bytes, a str, or a binary file of it
+def parse(data):
+    data = message_data(data)
+
+    headers, offset = parse_headers(data)
+    content_type = headers.get('content_type', '')
+    mime_type = content_type.partition(';')[0].strip().lower()
+    transfer_encoding = headers.get('transfer_encoding', '').strip().lower()
+    attachments = []
+    # An email sent over SMTP ends with a CRLF, which isn't part of its body
+    end = max(offset, len(data) - 2) if data[-2:] == b'\r\n' else len(data)
+
+    if mime_type in ('', 'text/plain', 'text/html') and transfer_encoding in PLAIN_TRANSFER_ENCODINGS:
+        text = decode_text(decode_transfer(data[offset:end], transfer_encoding), content_type)
+        if mime_type == 'text/html':
+            text, html = None, text
+        else:
+            html = None
+    else:
+        bodies = {}
+        walk_part(data, offset, end, headers, bodies, attachments)
+        text, html = bodies.get('plain'), bodies.get('html')
+
+    return ParsedEmail(
+        subject = headers.get('subject', ''),
+        message_id = headers.get('message_id'),
+        to = headers.get('to'),
+        cc = headers.get('cc'),
+        date = headers.get('date'),
+        content_type = content_type or None,
+        body = text if text is not None else (html or ''),
+        html_body = html,
+        size = len(data),
+        raw = data,
+        attachments = attachments)
+
+
+# Returns the bytes of an email given to parse(). A file on disk, such as the one
+# an email was spooled to, is memory mapped rather than read, and the map stays
+# valid (and the file's content with it) once the file is closed, until the map
+# itself is. A BytesIO's bytes are used as they are, without copying them
+def message_data(data):
+    if isinstance(data, io.BytesIO):
+        return data.getvalue()
+    if hasattr(data, 'read'):
+        try:
+            fileno = data.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return data.read()
+        data.flush()
+        if os.fstat(fileno).st_size == 0:
+            return b''
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    if isinstance(data, str):
+        return data.encode('utf-8', 'surrogateescape')
+    return data
+
+
+# Reads the stored headers from an email's bytes (or from a part of it, between start
+# and end), returning them as a dict (of the names in HEADERS), and where the body
+# that follows starts. The first of each header is kept, unfolded, and the headers
+# end at the first blank line or at the first line that isn't a header
+def parse_headers(data, start=0, end=None):
+    values = {}
+    name = None
+    pos = start
+    length = len(data) if end is None else end
+
+    while pos < length:
+        end = data.find(b'\n', pos, length)
+        if end < 0:
+            end = length
+        line = data[pos:end].rstrip(b'\r')
+
+        if not line:
+            pos = end + 1
+            break
+
+        if line[:1] in (b' ', b'\t'):
+            # A folded header carries on from the line before
+            if name is not None:
+                values[name].append(line)
+        else:
+            match = _HEADER_LINE.match(line)
+            if match is None:
+                break
+            name = HEADERS.get(match.group(1).lower())
+            if name is not None and name not in values:
+                values[name] = [line[match.end():]]
+            else:
+                name = None
+        pos = end + 1
+
+    headers = {}
+    for name, lines in values.items():
+        value = b''.join(lines).strip().decode('utf-8', 'replace')
+        if name in ENCODED_HEADERS and '=?' in value:
+            value = decode_header(value)
+        headers[name] = value
+    return headers, min(pos, length)
+
+
+# Decodes any RFC 2047 encoded-words in a header's value
+def decode_header(value):
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except (LookupError, UnicodeError, ValueError, email.errors.HeaderParseError):
+        return value
+
+
+# Decodes the bytes of a text body, using the charset in its Content-Type (or UTF-8)
+def decode_text(body, content_type=''):
+    match = _CHARSET.search(content_type)
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return body.decode(charset, 'replace')
+
+
+# Decodes the bytes of a body from its Content-Transfer-Encoding. The line endings
+# of a body that isn't in base64 are those it was sent with, and CRLFs become LFs
+def decode_transfer(body, transfer_encoding):
+    transfer_encoding = transfer_encoding.strip().lower()
+    try:
+        if transfer_encoding == 'base64':
+            return binascii.a2b_base64(body)
+        body = body.replace(b'\r\n', b'\n')
+        if transfer_encoding == 'quoted-printable':
+            return quopri.decodestring(body)
+    except (binascii.Error, ValueError):
+        pass
+    return body
+
+
+# Returns a parameter of a header's value, eg: header_param(content_type, 'boundary')
+def header_param(value, name):
+    match = re.search(_PARAM % re.escape(name), value, re.IGNORECASE)
+    if match is None:
+        return None
+    extended, quoted, token = match.groups()
+    param = re.sub(r'\\(.)', r'\1', quoted) if quoted is not None else token
+    if extended:
+        # RFC 2231, eg: utf-8''a%20b.pdf
+        charset, _, text = email.utils.decode_rfc2231(param)
+        try:
+            param = urllib.parse.unquote(text, encoding=charset or 'us-ascii', errors='replace')
+        except LookupError:
+            param = urllib.parse.unquote(text, errors='replace')
+    elif '=?' in param:
+        param = decode_header(param)
+    return param
+
+
+# Walks a MIME part of an email, whose body is data[start:end], recording the first
+# text and HTML bodies found in bodies (as 'plain' and 'html'), and any other parts as
+# attachments. Multipart parts are walked into
+def walk_part(data, start, end, headers, bodies, attachments):
+    content_type = headers.get('content_type', '')
+    mime_type = content_type.partition(';')[0].strip().lower() or 'text/plain'
+
+    if mime_type.startswith('multipart/'):
+        boundary = header_param(content_type, 'boundary')
+        if boundary:
+            for part_start, part_end in split_multipart(data, start, end, boundary.encode('utf-8', 'replace')):
+                part_headers, body_start = parse_headers(data, part_start, part_end)
+                walk_part(data, body_start, part_end, part_headers, bodies, attachments)
+            return
+
+    disposition = headers.get('disposition', '')
+    filename = header_param(disposition, 'filename') or header_param(content_type, 'name')
+    transfer_encoding = headers.get('transfer_encoding', '')
+    subtype = mime_type[5:]
+
+    if (mime_type.startswith('text/') and subtype in ('plain', 'html') and subtype not in bodies
+            and filename is None and disposition.partition(';')[0].strip().lower() != 'attachment'):
+        bodies[subtype] = decode_text(decode_transfer(data[start:end], transfer_encoding), content_type)
+    else:
+        attachments.append(Attachment(start, end, filename, mime_type,
+                                      headers.get('content_id'), transfer_encoding.strip().lower() or None))
+
+
+# Returns the (start, end) of each part of a multipart body, data[start:end], which is
+# split by lines of '--' + boundary. The line break before each boundary belongs to it
+def split_multipart(data, start, end, boundary):
+    delimiter = b'--' + boundary
+    parts = []
+    part_start = None
+    pos = start
+
+    while True:
+        i = data.find(delimiter, pos, end)
+        if i < 0:
+            break
+        after = i + len(delimiter)
+        if (i > start and data[i - 1:i] != b'\n') or data[after:after + 1] not in _BOUNDARY_END:
+            pos = after
+            continue
+
+        if part_start is not None:
+            part_end = i
+            if part_end > part_start and data[part_end - 1:part_end] == b'\n':
+                part_end -= 1
+            if part_end > part_start and data[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+            parts.append((part_start, part_end))
+
+        # The closing boundary, eg: --abc--
+        if data[after:after + 2] == b'--':
+            return parts
+        line_end = data.find(b'\n', after, end)
+        if line_end < 0:
+            return parts
+        part_start = pos = line_end + 1
+
+    # Without a closing boundary, the last part runs to the end
+    if part_start is not None and part_start < end:
+        parts.append((part_start, end))
+    return parts
@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+"""
+Notifications of newly stored emails, sent from the smtpy service to the
+smtpy API so that requests waiting on an email can be answered as soon as it
+is committed, without the API polling the database.
+
+After each batch of emails is committed, the service's MailNotifier sends a
+UDP datagram on localhost listing each email's MailLogId, sender and
+recipients. The API's MailListener receives these into a ring buffer of the
+most recent emails, and wakes up any requests waiting for a match.
+
+Notifications are only a hint: one can be lost (eg: if the API isn't running
+when it's sent), so anything waiting should still check the database now and
+again.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import json
+import time
+import socket
+import threading
+import collections
+
+
+# Largest datagram sent, kept well below the 64KB limit of UDP
+MAX_DATAGRAM = 32768
+
+# Number of recent emails a MailListener remembers
+RING_SIZE = 10000
+
+
+# Sends notifications of stored emails to a MailListener at host/port
+class MailNotifier(object):
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # Sends (MailLogId, sender, recipients) for each of the events, split over as
+    # many datagrams as needed. Failures are ignored, as nothing may be listening
+    def notify(self, events):
+        datagram = []
+        size = 2
+        for event in events:
+            event = json.dumps(list(event))
+            if datagram and size + len(event) + 1 > MAX_DATAGRAM:
+                self._send(datagram)
+                datagram = []
+                size = 2
+            datagram.append(event)
+            size += len(event) + 1
+        if datagram:
+            self._send(datagram)
+
+    def _send(self, datagram):
+        try:
+            self.sock.sendto(('[' + ','.join(datagram) + ']').encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+# Receives notifications of stored emails, remembering the most recent ones in a
+# ring buffer, and lets threads wait until one they're interested in arrives.
+# Without a port, nothing is received and emails are only known of via publish()
+class MailListener(object):
+
+    def __init__(self, host=None, port=None, size=RING_SIZE):
+        self.address = (host, port) if port else None
+        self.events = collections.deque(maxlen=size)
+        self.latest = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.sock = None
+        self._thread = None
+
+    def start(self):
+        self.closed = False
+        if self.address is not None and self._thread is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(self.address)
+            self._thread = threading.Thread(target=self._run, name='MailListener', daemon=True)
+            self._thread.start()
+
+    # Stops receiving, and wakes up any waiting threads so they can give up
+    def stop(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        if self._thread is not None:
+            # Wake the receiving thread with an empty datagram, so it sees the socket is closing
+            sock, self.sock = self.sock, None
+            try:
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(b'', sock.getsockname())
+            except OSError:
+                pass
+            self._thread.join()
+            self._thread = None
+            sock.close()
+
+    def _run(self):
+        sock = self.sock
+        while self.sock is not None:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                continue
+            try:
+                events = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            self.publish((int(e[0]), e[1], e[2]) for e in events)
+
+    # Records newly stored emails, as (MailLogId, sender, recipients), waking any
+    # waiting threads
+    def publish(self, events):
+        with self.condition:
+            for event in events:
+                self.events.append(event)
+                if event[0] > self.latest:
+                    self.latest = event[0]
+            self.condition.notify_all()
+
+    # Waits up to timeout seconds for an email after MailLogId 'after', for which
+    # match(sender, recipients) is true. Returns the matching MailLogIds, which
+    # will be empty if there were none in time, or if the listener was stopped.
+    # Each time, only the newest emails are checked, back as far as the first one
+    # that isn't after 'after'
+    def wait(self, match, after, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                ids = []
+                for event in reversed(self.events):
+                    if event[0] <= after:
+                        break
+                    if match(event[1], event[2]):
+                        ids.append(event[0])
+                if ids:
+                    return ids[::-1]
+
+                # Nothing newer has matched, so only look at what arrives from here on
+                after = max(after, self.latest)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.closed:
+                    return []
+                self.condition.wait(remaining)
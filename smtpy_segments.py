@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+"""
+Append-only log of the raw messages received by the smtpy service, kept in a
+directory of segment files rather than in the database (see the storage
+'segment_directory' setting).
+
+Each batch of raw messages is appended to the newest segment, and only where
+each message is (its segment, offset and length) is stored in MailLog. Once a
+segment reaches segment_size bytes, the next batch starts a new one. Segments
+are never changed once written, so old emails are purged by deleting whole
+segments, once no email in MailLog still uses them (see MailSweeper).
+
+Messages are read back through a memory map of just the part of the segment
+they're in, or the segment file can be opened to send them straight from it.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import re
+import mmap
+import threading
+
+
+# Segment files are named by their number, eg: 000000000042.seg
+SEGMENT_NAME = '%012d.seg'
+
+_SEGMENT_FILE = re.compile(r'^(\d+)\.seg$')
+
+
+# Returns the path of a segment in directory
+def segment_path(directory, segment):
+    return os.path.join(directory, SEGMENT_NAME % segment)
+
+
+# Returns the numbers of the segments in directory, oldest first
+def segment_ids(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(m.group(1)) for m in map(_SEGMENT_FILE.match, names) if m is not None)
+
+
+# Reads length bytes from offset in a segment, through a memory map of only the
+# pages they're on
+def read(directory, segment, offset, length):
+    if length <= 0:
+        return b''
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(segment_path(directory, segment), 'rb') as f:
+        with mmap.mmap(f.fileno(), offset - start + length, access=mmap.ACCESS_READ, offset=start) as m:
+            return m[offset - start:]
+
+
+# Opens a segment to read from, eg: to send part of it with sendfile()
+def open_segment(directory, segment):
+    return open(segment_path(directory, segment), 'rb')
+
+
+# The segments of raw messages in a directory, appended to by one writer (the
+# MailWriter) and purged by one sweeper (the MailSweeper). The writer always starts
+# a new segment, after the newest already in the directory, and a segment is only
+# ever appended to while it's the newest, so the sweeper never deletes the newest.
+# With sync, each batch is flushed to disk before append() returns, so it's there
+# before the emails using it are committed
+class SegmentLog(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, sync=True):
+        self.directory = directory
+        self.segment_size = max(1, segment_size)
+        self.sync = sync
+        self.segment = None
+        self.file = None
+        self._lock = threading.Lock()
+
+    # Appends a batch of raw messages to the newest segment, returning the (segment,
+    # offset, length) each was written at. A new segment is started first if there is
+    # none, or the newest has reached segment_size. Each raw message is bytes, or has
+    # chunks() to write it from a chunk at a time (see smtpy_db.SpooledData)
+    def append(self, datas):
+        with self._lock:
+            if self.file is None or self.file.tell() >= self.segment_size:
+                self._rotate()
+
+            locations = []
+            offset = self.file.tell()
+            for data in datas:
+                if hasattr(data, 'chunks'):
+                    self.file.writelines(data.chunks())
+                else:
+                    self.file.write(data)
+                locations.append((self.segment, offset, len(data)))
+                offset += len(data)
+
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            return locations
+
+    def _rotate(self):
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        ids = segment_ids(self.directory)
+        segment = (ids[-1] if ids else 0) + 1
+        self.file = open(segment_path(self.directory, segment), 'xb')
+        self.segment = segment
+
+    # Deletes the segments before first_used (the oldest segment an email still
+    # uses, or None for none), other than the newest. The segments have to be listed
+    # before first_used is looked up, so the writer can't have started using any of
+    # them since (see MailSweeper.drop_segments): pass in the listed ids. The newest
+    # listed is taken to be the one the writer is appending to, as it's only ever
+    # appending to the newest on disk; the writer is usually another SegmentLog, so
+    # which it is isn't known here. A segment that can't be deleted yet (eg: on
+    # Windows, while the API is reading from it) is left for next time. Returns how
+    # many were deleted
+    def drop(self, ids, first_used):
+        dropped = 0
+        for segment in ids[:-1]:
+            if first_used is not None and segment >= first_used:
+                break
+            try:
+                os.remove(segment_path(self.directory, segment))
+                dropped += 1
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+        return dropped
+
+    def segment_ids(self):
+        return segment_ids(self.directory)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.segment = None
+
+    def close(self):
+        with self._lock:
+            self._close()
@@ -5,14 +5,29 @@ which will listen on the specified host/port in the config file for incoming
 emails.
 
 By default, the SMTP server will be set up to allow UTF-8 emails, and to
-automatically purge emails that become older than 30 minutes.
+automatically purge emails that become older than 30 minutes. The purge runs
+in the background every 'purge_interval_seconds', and the age can be changed
+via the 'purge_after_minutes' setting.
 
 To disable UTF-8, set the 'use_utf8' setting in the smtp-config to False.
 To disable the purging of emails, set the 'purge_email' setting to False.
 
+Received emails are queued and written to the database in batches; see the
+'batch_size', 'batch_max_delay_ms' and 'queue_size' settings.
+
+To make use of more than one core, set the 'workers' setting to the number
+of SMTP worker processes to run. Each worker binds the host/port using
+SO_REUSEPORT (or, where that isn't supported, shares one listening socket)
+and puts the emails it receives onto a queue, which this service process
+drains and writes to the database.
+
 This Windows service will also automatically create the SQLite database
 if it doesn't yet exist, as well as the required table.
 
+With the storage 'backend' setting as 'memory', emails are instead only kept
+in this service's memory, so this service also serves the API itself (and
+the API service shouldn't be started); see smtpy_storage.
+
 Copyright (c) 2015, Matthew Kelly (Badgerati)
 Company: Cadaeic Studios
 License: MIT (see LICENSE for details)
@@ -22,54 +37,73 @@ import win32serviceutil
 import win32service
 import win32event
 import servicemanager
+import os
+import sys
 import socket
-import smtpdutf8 as smtpd
-import asyncore
-import sqlite3
-import re
+import smtpdasync as smtpd
+import queue
+import threading
 import traceback
+import multiprocessing
 import smtpy_config as config
+import smtpy_db
+import smtpy_notify
+import smtpy_mime
+import smtpy_storage
 
 # This is the mock SMTP server that will be listening on the specified host/port.
-# It will insert any email into the SQLite database - purging older emails if enabled.
+# It will insert any email into the SQLite database.
 class MockSmtpServer(smtpd.SMTPServer):
 
+    # Each email is given to process_message as the file it was spooled to, so it
+    # can be parsed straight from the received bytes. One too big to have been kept
+    # in memory is parsed from, and stored from, a memory map of that file
+    stream_data = True
+
+    # and with its CRLF line endings, so its raw message is stored as it was sent
+    keep_crlf = True
+
+    def __init__(self, *args, writer=None, **kwargs):
+        # Emails are queued and written in batches over one long-lived connection.
+        # A worker process is given a writer that only queues to the service process
+        if writer is None:
+            writer = create_writer(on_error = self.log_write_error)
+            smtpd.SMTPServer.__init__(self, *args, **kwargs)
+            writer.start()
+        else:
+            smtpd.SMTPServer.__init__(self, *args, **kwargs)
+        self.writer = writer
+        self.compression = smtpy_db.compression_settings()
+        self.attachment_threshold = smtpy_db.attachment_threshold()
+
+    # Logs any error from the background writer thread
+    def log_write_error(self, e):
+        servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                              servicemanager.PYS_SERVICE_STARTED,
+                              ('MailWriter', str(e) + '\n' + traceback.format_exc()))
+
     # Records a received email into the SQLite database
     def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
         try:
-            matches = re.search('^.*?\'(?P<ip>.*?)\'.*?(?P<port>\d+).*?$', str(peer))
-            ip = matches.group('ip')
-            port = matches.group('port')
-            subject = ''
+            ip = peer[0]
+            port = peer[1]
+            mail = smtpy_mime.parse(data)
+            raw, attachments = smtpy_db.extract_attachments(mail.raw, mail.attachments, self.attachment_threshold)
 
-            # Split up the data and parse for modules
-            split_data = str(data).split('\\n')
-            for value in split_data:
-                if value.startswith('Subject: '):
-                    subject = value.replace('Subject: ', '')
-
-            # Split data again to retrieve the main body of the message
-            split_data_body = str(data).split('\\n\\n')
-            body = split_data_body[len(split_data_body) - 1]
+            # Compressed here, so with workers it's spread over their processes. The
+            # recipients are kept as a list, so they needn't be parsed to be indexed
+            row = smtpy_db.compress_row((str(ip), int(port), mail.subject, str(mailfrom), list(rcpttos), mail.body,
+                                         mail.message_id, mail.to, mail.cc, mail.date, mail.content_type,
+                                         mail.html_body, mail.size, raw, None, attachments), *self.compression)
 
             try:
-                # Store email in database
-                conn = None
-                conn = sqlite3.connect(config.settings['database'])
-                sql = "INSERT INTO MailLog(IPAddress, PortNumber, Subject, Sender, Recipients, Body) VALUES (?, ?, ?, ?, ?, ?)"
-                conn.execute(sql, (str(ip), str(port), str(subject), str(mailfrom), str(rcpttos), str(body)))
-                conn.commit()
-
-                # If enabled, purge emails older than 30 minutes
-                if config.settings['smtp']['purge_email'] is True:
-                    sql = "DELETE FROM MailLog WHERE TimeStamp < DATETIME('now', '-30 minute')"
-                    conn.execute(sql)
-                    conn.commit()
-                    
-                conn.close()
+                # Queue email to be stored in the database
+                self.writer.put(row)
+            except queue.Full:
+                smtpy_db.close_row(row)
+                return '451 Requested action aborted: too many emails waiting to be stored'
             except Exception as e:
-                if conn is not None:
-                    conn.close()
+                smtpy_db.close_row(row)
                 servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
                                   servicemanager.PYS_SERVICE_STARTED,
                                   ('process_message', str(e) + '\n' + traceback.format_exc()))
@@ -80,6 +114,51 @@ class MockSmtpServer(smtpd.SMTPServer):
         return
 
 
+# Creates the writer used to record received emails, as per the smtp-config. Once
+# they're stored, the API service is notified of them (if notify_port is set); an
+# API served from this process learns of them from the store itself. A worker's
+# writer is never started: it only puts emails onto the service process's queue
+def create_writer(on_error=None, mail_queue=None):
+    store = smtpy_storage.default_store()
+    if config.settings['api']['notify_port'] and not store.in_memory:
+        store.subscribe(smtpy_notify.MailNotifier(config.settings['api']['host'],
+                                                  config.settings['api']['notify_port']).notify)
+
+    return store.create_writer(
+        on_error = on_error,
+        mail_queue = mail_queue,
+        batch_size = config.settings['smtp']['batch_size'],
+        batch_delay = config.settings['smtp']['batch_max_delay_ms'] / 1000.0,
+        queue_size = config.settings['smtp']['queue_size'])
+
+
+# Entry point of each SMTP worker process. Emails are put onto mail_queue for the
+# service process to write; sock is the listening socket to share if this platform
+# has no SO_REUSEPORT, otherwise the worker binds the host/port itself
+def run_worker(mail_queue, stopping, sock=None):
+    try:
+        server = MockSmtpServer(
+            (config.settings['smtp']['host'], config.settings['smtp']['port']),
+            None,
+            writer = create_writer(mail_queue = mail_queue),
+            reuse_port = (sock is None),
+            sock = sock,
+            enable_SMTPUTF8 = config.settings['smtp']['use_utf8'],
+            decode_data = (not config.settings['smtp']['use_utf8']))
+
+        # Stop serving once the service tells the workers to stop
+        def wait_for_stop():
+            stopping.wait()
+            server.close()
+
+        threading.Thread(target=wait_for_stop, daemon=True).start()
+        server.serve_forever()
+    except Exception as e:
+        servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                              servicemanager.PYS_SERVICE_STARTED,
+                              ('SmtpWorker', str(e) + '\n' + traceback.format_exc()))
+
+
 # Main Windows service
 class SmtpService(win32serviceutil.ServiceFramework):
     _svc_name_ = config.settings['smtp']['svc_name']
@@ -89,38 +168,51 @@ class SmtpService(win32serviceutil.ServiceFramework):
     def __init__(self, args):
         win32serviceutil.ServiceFramework.__init__(self, args)
         self.hWaitStop = win32event.CreateEvent(None, 0, 0 , None)
+        self.server = None
+        self.writer = None
+        self.sweeper = None
+        self.api = None
+        self.logged_high_water_mark = 0
+        self.stopping = multiprocessing.Event()
         socket.setdefaulttimeout(60)
 
+        self.migrating = False
+
         try:
             # Attempt to create the database and table
-            conn = None
-            conn = sqlite3.connect(config.settings['database'])
-            sql = """CREATE TABLE IF NOT EXISTS MailLog
-                    (
-                        MailLogId INTEGER PRIMARY KEY AUTOINCREMENT,
-                        IPAddress TEXT,
-                        PortNumber TEXT,
-                        Subject TEXT,
-                        Sender TEXT,
-                        Recipients TEXT,
-                        Body TEXT,
-                        TimeStamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )"""
-            conn.execute(sql)
-            conn.commit()
-            conn.close()
-        except Exception:
-            if conn is not None:
-                conn.close()
+            self.migrating = smtpy_storage.default_store().create_schema()
+        except Exception as e:
             servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
                                   servicemanager.PYS_SERVICE_STARTED,
                                   (self._svc_name_, str(e) + '\n' + traceback.format_exc()))
 
         
+    # Logs any error from the background sweeper thread
+    def log_sweep_error(self, e):
+        servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                              servicemanager.PYS_SERVICE_STARTED,
+                              ('MailSweeper', str(e) + '\n' + traceback.format_exc()))
+
+
+    # Logs how many emails each sweep purged, along with the high-water mark of the
+    # queue of emails waiting to be written, whenever either is worth noting
+    def log_sweep(self, purged):
+        writer = self.writer
+        high_water_mark = writer.high_water_mark if writer is not None else 0
+        if purged or high_water_mark > self.logged_high_water_mark:
+            self.logged_high_water_mark = high_water_mark
+            servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
+                                  servicemanager.PYS_SERVICE_STARTED,
+                                  ('MailSweeper', 'Purged %d emails, write queue high-water mark: %d' % (purged, high_water_mark)))
+
+
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
-        asyncore.close_all()
-        raise asyncore.ExitNow('Service is quitting')            
+        self.stopping.set()
+        if self.server is not None:
+            self.server.close()
+        if self.api is not None:
+            self.api.__stop__()
         win32event.SetEvent(self.hWaitStop)
 
 
@@ -131,18 +223,146 @@ class SmtpService(win32serviceutil.ServiceFramework):
         self.main()
 
 
+    # Moves emails stored by an older version of smtpy over to the current schema
+    def migrate(self):
+        try:
+            moved = smtpy_storage.default_store().migrate()
+            servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
+                                  servicemanager.PYS_SERVICE_STARTED,
+                                  (self._svc_name_, 'Migrated %d emails to schema version %d' % (moved, smtpy_db.SCHEMA_VERSION)))
+        except Exception as e:
+            servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                                  servicemanager.PYS_SERVICE_STARTED,
+                                  ('migrate', str(e) + '\n' + traceback.format_exc()))
+
+
     def main(self):
         try:
-            server = MockSmtpServer(
-                (config.settings['smtp']['host'], config.settings['smtp']['port']),
-                None,
-                enable_SMTPUTF8 = config.settings['smtp']['use_utf8'],
-                decode_data = (not config.settings['smtp']['use_utf8']))
-            asyncore.loop()
+            # Emails from an older schema are moved over while new ones are received
+            if self.migrating:
+                threading.Thread(target=self.migrate, name='MailMigration', daemon=True).start()
+
+            # If enabled, purge older emails in the background
+            if config.settings['smtp']['purge_email'] is True:
+                self.sweeper = smtpy_storage.default_store().create_sweeper(
+                    max_age_minutes = config.settings['smtp']['purge_after_minutes'],
+                    interval = config.settings['smtp']['purge_interval_seconds'],
+                    chunk_size = config.settings['smtp']['purge_chunk_size'],
+                    on_error = self.log_sweep_error,
+                    on_sweep = self.log_sweep)
+                self.sweeper.start()
+
+            # Emails kept in memory can only be read from this process, so serve the API too
+            if smtpy_storage.default_store().in_memory:
+                self.run_api()
+
+            if config.settings['smtp']['workers'] > 1:
+                writer = self.run_workers(config.settings['smtp']['workers'])
+            else:
+                writer = self.run_server()
+
+            servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
+                                  servicemanager.PYS_SERVICE_STARTED,
+                                  (self._svc_name_, 'Write queue high-water mark: %d' % writer.high_water_mark))
         except Exception as e:
             servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
                                   servicemanager.PYS_SERVICE_STARTED,
                                   (self._svc_name_, str(e) + '\n' + traceback.format_exc()))
+        finally:
+            if self.sweeper is not None:
+                self.sweeper.stop()
+
+
+    # Serves the API from a background thread of this process
+    def run_api(self):
+        import smtpy_api
+        self.api = smtpy_api
+        threading.Thread(target=self.serve_api, name='SmtpyApi', daemon=True).start()
+
+
+    def serve_api(self):
+        try:
+            self.api.__init__()
+        except Exception as e:
+            servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                                  servicemanager.PYS_SERVICE_STARTED,
+                                  ('SmtpyApi', str(e) + '\n' + traceback.format_exc()))
+
+
+    # Serves SMTP from this process until the service is stopped, returning the writer
+    def run_server(self):
+        self.server = MockSmtpServer(
+            (config.settings['smtp']['host'], config.settings['smtp']['port']),
+            None,
+            enable_SMTPUTF8 = config.settings['smtp']['use_utf8'],
+            decode_data = (not config.settings['smtp']['use_utf8']))
+        self.writer = self.server.writer
+        try:
+            if not self.stopping.is_set():
+                self.server.serve_forever()
+        finally:
+            self.server.writer.stop()
+        return self.server.writer
+
+
+    # Serves SMTP from the given number of worker processes until the service is
+    # stopped, writing the emails they receive from this process. Returns the writer
+    def run_workers(self, count):
+        # Under pythonservice.exe, workers must be started with python.exe instead
+        if os.path.basename(sys.executable).lower().startswith('pythonservice'):
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+
+        writer = create_writer(on_error = self.log_write_error,
+                               mail_queue = multiprocessing.Queue(config.settings['smtp']['queue_size']))
+        writer.start()
+        self.writer = writer
+
+        # Without SO_REUSEPORT, bind once here and hand the socket to every worker
+        sock = None
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            sock = socket.create_server((config.settings['smtp']['host'], config.settings['smtp']['port']),
+                                        backlog = 100)
+
+        workers = []
+        try:
+            for i in range(count):
+                workers.append(self.start_worker(writer.queue, sock))
+
+            # Restart any worker that has died, until the service is stopped
+            while not self.stopping.wait(5):
+                for i, worker in enumerate(workers):
+                    if not worker.is_alive():
+                        servicemanager.LogMsg(servicemanager.EVENTLOG_WARNING_TYPE,
+                                              servicemanager.PYS_SERVICE_STARTED,
+                                              (self._svc_name_, '%s exited with code %s, restarting' % (worker.name, worker.exitcode)))
+                        workers[i] = self.start_worker(writer.queue, sock)
+        finally:
+            self.stopping.set()
+            for worker in workers:
+                worker.join(10)
+                if worker.is_alive():
+                    worker.terminate()
+            if sock is not None:
+                sock.close()
+            writer.stop()
+        return writer
+
+
+    def start_worker(self, mail_queue, sock):
+        worker = multiprocessing.Process(target = run_worker,
+                                         args = (mail_queue, self.stopping, sock),
+                                         name = 'SmtpWorker',
+                                         daemon = True)
+        worker.start()
+        worker.name = 'SmtpWorker-%d' % worker.pid
+        return worker
+
+
+    # Logs any error from the background writer thread
+    def log_write_error(self, e):
+        servicemanager.LogMsg(servicemanager.EVENTLOG_ERROR_TYPE,
+                              servicemanager.PYS_SERVICE_STARTED,
+                              ('MailWriter', str(e) + '\n' + traceback.format_exc()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,605 @@
+#! /usr/bin/env python3
+"""
+Where the smtpy service stores received emails, and the API reads them from,
+as chosen by the storage 'backend' setting:
+
+    sqlite - the SQLite database (see smtpy_db), shared by the smtp service
+             and the API running as separate services
+    memory - the smtp service's memory, bounded by a number of emails and
+             bytes. Nothing is written to disk, and everything is lost when
+             the service stops, which is fine for CI runs. The API can only
+             read the emails from the same process, so the smtp service
+             serves the API itself (see smtpy_service)
+
+Both are a MailStore: received emails are stored (in batches, by the writer
+from create_writer()), then got, queried, searched, deleted and purged, and
+subscribers are told of each email as it's stored.
+
+Emails are given as rows for smtpy_db.INSERT_MAIL_SQL, and returned as dicts
+of the columns in smtpy_db.MAIL_COLUMNS.
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import io
+import re
+import time
+import sqlite3
+import threading
+import contextlib
+import collections
+import smtpy_config as config
+import smtpy_db
+
+
+BACKENDS = ('memory', 'sqlite')
+
+
+# Formats the datarows into a nice dictionary
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+# Interface of the stores of received emails. Emails are looked up by sender,
+# recipient (case-folded, see smtpy_db.fold_address) or recipient domain, and
+# always come back newest first, unless said otherwise.
+class MailStore(object):
+
+    # Whether the emails are only kept in this process's memory
+    in_memory = False
+
+    def __init__(self):
+        self.subscribers = []
+        self._subscribers_lock = threading.Lock()
+
+    # Creates anything the store needs before it's used, returning whether there are
+    # emails from an older version to move over with migrate()
+    def create_schema(self):
+        return False
+
+    def migrate(self):
+        return 0
+
+    # Returns the writer the smtp service queues received emails onto (see
+    # smtpy_db.MailWriter), which stores them in batches
+    def create_writer(self, on_error=None, mail_queue=None, batch_size=500,
+                      batch_delay=0.05, queue_size=50000):
+        raise NotImplementedError()
+
+    # Returns the background sweeper purging emails older than max_age_minutes
+    # every interval seconds (see smtpy_db.MailSweeper)
+    def create_sweeper(self, max_age_minutes=30, interval=60, chunk_size=500, on_error=None, on_sweep=None):
+        raise NotImplementedError()
+
+    # Stores emails straight away, returning the MailLogId of the last of them
+    def store(self, rows):
+        raise NotImplementedError()
+
+    # Returns an email, or None if there's no email with that MailLogId
+    def get(self, mail_log_id):
+        raise NotImplementedError()
+
+    # Returns up to amount emails from a sender, to a recipient, or to a domain,
+    # only those after a MailLogId if after is given
+    def query(self, sender=None, recipient=None, domain=None, after=None, amount=1):
+        raise NotImplementedError()
+
+    # Returns summaries (MailLogId, Sender, Recipients, Subject and Size) of up to
+    # amount emails after a MailLogId, oldest first, optionally only those from a
+    # sender and/or to a recipient
+    def summaries(self, after, sender='', recipient='', amount=500):
+        raise NotImplementedError()
+
+    # Returns the MailLogId of the last email stored, or 0 if there are none
+    def last_id(self):
+        raise NotImplementedError()
+
+    # Returns up to amount emails whose subject or body match a search, best first
+    def search(self, q, amount=10):
+        raise NotImplementedError()
+
+    # Returns the attachments stored apart from an email (FileName, ContentType,
+    # ContentId, TransferEncoding, Size and BlobHash)
+    def attachments(self, mail_log_id):
+        raise NotImplementedError()
+
+    # Opens an email's raw message as for smtpy_db.open_raw_message, returning (file,
+    # offset, size) or None. Anything that has to be kept open until it's been read
+    # is entered into the ExitStack stack
+    def open_raw(self, mail_log_id, stack):
+        raise NotImplementedError()
+
+    # Deletes an email by its MailLogId, or all of a sender's emails
+    def delete(self, mail_log_id=None, sender=None):
+        raise NotImplementedError()
+
+    # Deletes the emails older than max_age_minutes, returning how many were deleted
+    def purge(self, max_age_minutes):
+        raise NotImplementedError()
+
+    # Calls callback with a list of (MailLogId, sender, recipients) for each batch of
+    # emails stored from now on
+    def subscribe(self, callback):
+        with self._subscribers_lock:
+            self.subscribers.append(callback)
+
+    def publish(self, events):
+        events = list(events)
+        with self._subscribers_lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(events)
+
+    # Tells the subscribers of a batch of rows just stored, the first of which was
+    # given first_id
+    def publish_rows(self, first_id, rows):
+        self.publish((first_id + i, row[3], row[4]) for i, row in enumerate(rows))
+
+    def close(self):
+        pass
+
+
+# Emails stored in the SQLite database, which may be split into partitions. Reads
+# go through a pool of read-only connections, and writes through their own pool
+class SqliteStore(MailStore):
+
+    def __init__(self, database=None, threads=16):
+        MailStore.__init__(self)
+        self.database = database
+        self.read_pool = smtpy_db.ConnectionPool(database, size=max(1, threads),
+                                                 read_only=True, row_factory=dict_factory)
+        self.write_pool = smtpy_db.ConnectionPool(database, size=1, row_factory=dict_factory)
+
+    def create_schema(self):
+        return smtpy_db.create_schema(self.database)
+
+    def migrate(self):
+        return smtpy_db.migrate(self.database)
+
+    def create_writer(self, on_error=None, mail_queue=None, batch_size=500,
+                      batch_delay=0.05, queue_size=50000):
+        compress_threshold, compress_level = smtpy_db.compression_settings()
+        return smtpy_db.MailWriter(
+            self.database,
+            batch_size = batch_size,
+            batch_delay = batch_delay,
+            queue_size = queue_size,
+            on_error = on_error,
+            mail_queue = mail_queue,
+            on_commit = self.publish_rows,
+            segments = smtpy_db.segment_log(),
+            partition_minutes = smtpy_db.partition_minutes(),
+            compress_threshold = compress_threshold,
+            compress_level = compress_level)
+
+    def create_sweeper(self, max_age_minutes=30, interval=60, chunk_size=500, on_error=None, on_sweep=None):
+        return smtpy_db.MailSweeper(
+            self.database,
+            max_age_minutes = max_age_minutes,
+            interval = interval,
+            chunk_size = chunk_size,
+            on_error = on_error,
+            on_sweep = on_sweep,
+            segments = smtpy_db.segment_log(),
+            partition_minutes = smtpy_db.partition_minutes())
+
+    # If inserting the emails fails, such as when a newer partition has just sealed
+    # the database, they're inserted once more into what's then the current database
+    # (as a MailWriter does)
+    def store(self, rows):
+        try:
+            last_id = self._insert(rows)
+        except sqlite3.Error:
+            last_id = self._insert(rows)
+        self.publish_rows(last_id - len(rows) + 1, rows)
+        return last_id
+
+    def _insert(self, rows):
+        with self.write_pool.connection(smtpy_db.current_database(self.database)) as conn:
+            with conn:
+                return smtpy_db.insert_mails(conn, rows, None, *smtpy_db.compression_settings())
+
+    def get(self, mail_log_id):
+        values = self.read_pool.fetch(smtpy_db.SELECT_MAIL_SQL, (mail_log_id,), 1)
+        return values[0] if values else None
+
+    def query(self, sender=None, recipient=None, domain=None, after=None, amount=1):
+        if sender is not None:
+            sql, value = (smtpy_db.SELECT_MAIL_BY_SENDER_SQL, smtpy_db.SELECT_MAIL_BY_SENDER_AFTER_SQL), sender
+        elif recipient is not None:
+            sql, value = (smtpy_db.SELECT_MAIL_BY_RECIPIENT_SQL, smtpy_db.SELECT_MAIL_BY_RECIPIENT_AFTER_SQL), smtpy_db.fold_address(recipient)
+        elif domain is not None:
+            sql, value = (smtpy_db.SELECT_MAIL_BY_DOMAIN_SQL, smtpy_db.SELECT_MAIL_BY_DOMAIN_AFTER_SQL), smtpy_db.fold_address(domain)
+        else:
+            raise ValueError('a sender, recipient or domain is required')
+
+        if after is None:
+            return self.read_pool.fetch(sql[0], (value, amount), amount)
+        return self.read_pool.fetch(sql[1], (value, after, amount), amount)
+
+    def summaries(self, after, sender='', recipient='', amount=500):
+        address = smtpy_db.fold_address(recipient)
+        return self.read_pool.fetch(smtpy_db.SELECT_MAIL_SUMMARIES_AFTER_SQL,
+                                    (after, sender, sender, address, address, amount),
+                                    amount, newest_first=False)
+
+    def last_id(self):
+        values = self.read_pool.fetch(smtpy_db.SELECT_LAST_MAIL_ID_SQL, (), 1)
+        return values[0]['MailLogId'] if values else 0
+
+    # The search is an SQLite FTS5 query, eg: 'reset AND password', '"order confirmed"'
+    # or 'invoic*'; text that isn't a valid query (such as an email address) is
+    # searched for word by word. The best matches of each partition are merged by
+    # rank, though a partition ranks its emails against only its own
+    def search(self, q, amount=10):
+        try:
+            values = self._search(q, amount)
+        except sqlite3.OperationalError:
+            values = self._search(smtpy_db.search_terms(q), amount)
+        for value in values:
+            del value['MatchRank']
+        return values
+
+    def _search(self, q, amount):
+        return self.read_pool.fetch(smtpy_db.SEARCH_MAIL_SQL, (q, amount), amount,
+                                    key=lambda value: value['MatchRank'])
+
+    def attachments(self, mail_log_id):
+        return self.read_pool.fetch(smtpy_db.SELECT_MAIL_ATTACHMENTS_SQL, (mail_log_id,))
+
+    # The connection is kept until the raw message has been read
+    def open_raw(self, mail_log_id, stack):
+        for database in self.read_pool.databases():
+            with contextlib.ExitStack() as attempt:
+                conn = attempt.enter_context(self.read_pool.connection(database))
+                raw = smtpy_db.open_raw_message(conn, mail_log_id)
+                if raw is not None:
+                    stack.push(attempt.pop_all())
+                    return raw
+        return None
+
+    def delete(self, mail_log_id=None, sender=None):
+        if mail_log_id is not None:
+            self.write_pool.execute_all(smtpy_db.DELETE_MAIL_SQL, (mail_log_id,))
+        if sender is not None:
+            self.write_pool.execute_all(smtpy_db.DELETE_MAIL_BY_SENDER_SQL, (sender,))
+
+    def purge(self, max_age_minutes):
+        sweeper = self.create_sweeper(max_age_minutes)
+        try:
+            return sweeper.sweep()
+        finally:
+            sweeper.close()
+
+    def close(self):
+        self.read_pool.close()
+        self.write_pool.close()
+
+
+# An email held by a MemoryStore: its row (as for INSERT_MAIL_SQL), when it was
+# stored (in seconds since the epoch), its case-folded recipient addresses and
+# their domains, and roughly how many bytes it takes up
+MemoryMail = collections.namedtuple('MemoryMail', (
+    'mail_log_id', 'timestamp', 'row', 'addresses', 'domains', 'size'))
+
+# The words of a MemoryStore search, and of the emails searched, and the FTS5
+# operators ignored in a search
+SEARCH_WORD = re.compile(r'\w+')
+SEARCH_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+# Emails held in memory, up to max_emails of them and max_bytes in total (roughly:
+# the lengths of their bodies, raw messages and attachments). Beyond either, the
+# least recently used emails (stored, got or returned longest ago) are evicted.
+# Emails are indexed by sender, recipient and domain, so looking them up only
+# touches the emails returned. Searches are for emails containing every word
+# searched for as a whole word (regardless of case), newest first. Attachments of
+# at least compress_threshold bytes are kept compressed
+class MemoryStore(MailStore):
+
+    in_memory = True
+
+    def __init__(self, max_emails=10000, max_bytes=256 * 1024 * 1024, compress_threshold=0, compress_level=6):
+        MailStore.__init__(self)
+        self.max_emails = max(1, max_emails)
+        self.max_bytes = max_bytes
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.bytes = 0
+        self.latest = 0
+        self.mails = {}
+        self.recently_used = collections.OrderedDict()
+        self.by_sender = {}
+        self.by_address = {}
+        self.by_domain = {}
+        self._lock = threading.Lock()
+
+    def create_writer(self, on_error=None, mail_queue=None, batch_size=500,
+                      batch_delay=0.05, queue_size=50000):
+        return MemoryWriter(self, batch_size=batch_size, batch_delay=batch_delay,
+                            queue_size=queue_size, on_error=on_error, mail_queue=mail_queue)
+
+    def create_sweeper(self, max_age_minutes=30, interval=60, chunk_size=500, on_error=None, on_sweep=None):
+        return MemorySweeper(self, max_age_minutes=max_age_minutes, interval=interval,
+                             on_error=on_error, on_sweep=on_sweep)
+
+    # Anything still spooled (see smtpy_db.SpooledData) is read into memory to be kept.
+    # Attachments are compressed before taking the lock
+    def store(self, rows):
+        kept = []
+        for row in rows:
+            row = tuple(smtpy_db.read_row(row)) + (None,) * (smtpy_db.MAIL_ROW_LENGTH - len(row))
+            attachments = smtpy_db.compress_attachments(row[smtpy_db.ROW_ATTACHMENTS], self.compress_threshold,
+                                                        self.compress_level)
+            kept.append(row[:smtpy_db.ROW_ATTACHMENTS] + (attachments,) + row[smtpy_db.ROW_ATTACHMENTS + 1:])
+
+        now = time.time()
+        with self._lock:
+            first_id = self.latest + 1
+            for row in kept:
+                self.latest += 1
+                self._add(self.latest, now, row)
+            self._evict()
+            last_id = self.latest
+        self.publish_rows(first_id, rows)
+        return last_id
+
+    # The row is kept with its recipients as they'd be stored in the Recipients column
+    def _add(self, mail_log_id, timestamp, row):
+        recipients = smtpy_db.recipient_rows(mail_log_id, row[smtpy_db.ROW_RECIPIENTS])
+        row = (row[:smtpy_db.ROW_RECIPIENTS] + (smtpy_db.recipients_text(row[smtpy_db.ROW_RECIPIENTS]),) +
+               row[smtpy_db.ROW_RECIPIENTS + 1:])
+        attachments = row[smtpy_db.ROW_ATTACHMENTS] or ()
+        size = sum(len(value) for value in row[:smtpy_db.ROW_ATTACHMENTS] if isinstance(value, (str, bytes)))
+        size += sum(len(attachment[smtpy_db.ATTACHMENT_DATA]) for attachment in attachments)
+
+        mail = MemoryMail(mail_log_id, timestamp, row,
+                          tuple(r[1] for r in recipients), tuple(dict.fromkeys(r[2] for r in recipients)), size)
+        self.mails[mail_log_id] = mail
+        self.recently_used[mail_log_id] = None
+        self.by_sender.setdefault(row[3], {})[mail_log_id] = None
+        for address in mail.addresses:
+            self.by_address.setdefault(address, {})[mail_log_id] = None
+        for domain in mail.domains:
+            self.by_domain.setdefault(domain, {})[mail_log_id] = None
+        self.bytes += size
+
+    def _remove(self, mail_log_id):
+        mail = self.mails.pop(mail_log_id, None)
+        if mail is None:
+            return False
+        del self.recently_used[mail_log_id]
+        self._unindex(self.by_sender, mail.row[3], mail_log_id)
+        for address in mail.addresses:
+            self._unindex(self.by_address, address, mail_log_id)
+        for domain in mail.domains:
+            self._unindex(self.by_domain, domain, mail_log_id)
+        self.bytes -= mail.size
+        return True
+
+    def _unindex(self, index, key, mail_log_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.pop(mail_log_id, None)
+            if not ids:
+                del index[key]
+
+    # Evicts the least recently used emails, until within max_emails and max_bytes.
+    # The last email stored is always kept, however large
+    def _evict(self):
+        while len(self.mails) > 1 and (len(self.mails) > self.max_emails or self.bytes > self.max_bytes):
+            self._remove(next(iter(self.recently_used)))
+
+    def _use(self, mail_log_id):
+        self.recently_used.move_to_end(mail_log_id)
+
+    # Returns an email as a dict of the columns in MAIL_COLUMNS
+    def _columns(self, mail):
+        row = mail.row
+        body = smtpy_db.inflate_text(row[5])
+        return {
+            'MailLogId': mail.mail_log_id,
+            'IPAddress': row[0],
+            'PortNumber': None if row[1] is None else str(row[1]),
+            'Subject': row[2],
+            'Sender': row[3],
+            'Recipients': row[4],
+            'Body': body,
+            'TimeStamp': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mail.timestamp)),
+            'MessageId': row[6],
+            'ToHeader': row[7],
+            'CcHeader': row[8],
+            'DateHeader': row[9],
+            'ContentType': row[10],
+            'HtmlBody': smtpy_db.inflate_text(row[smtpy_db.ROW_HTML_BODY]),
+            'Size': self._size(mail, body),
+        }
+
+    def _size(self, mail, body=None):
+        if mail.row[smtpy_db.ROW_SIZE] is not None:
+            return mail.row[smtpy_db.ROW_SIZE]
+        if body is None:
+            body = smtpy_db.inflate_text(mail.row[5])
+        return None if body is None else len(str(body).encode('utf-8'))
+
+    def get(self, mail_log_id):
+        with self._lock:
+            mail = self.mails.get(int(mail_log_id))
+            if mail is None:
+                return None
+            self._use(mail.mail_log_id)
+            return self._columns(mail)
+
+    def query(self, sender=None, recipient=None, domain=None, after=None, amount=1):
+        with self._lock:
+            if sender is not None:
+                ids = self.by_sender.get(sender, {})
+            elif recipient is not None:
+                ids = self.by_address.get(smtpy_db.fold_address(recipient), {})
+            elif domain is not None:
+                ids = self.by_domain.get(smtpy_db.fold_address(domain), {})
+            else:
+                raise ValueError('a sender, recipient or domain is required')
+
+            values = []
+            for mail_log_id in reversed(ids):
+                if len(values) >= amount or (after is not None and mail_log_id <= after):
+                    break
+                values.append(self._columns(self.mails[mail_log_id]))
+            for value in values:
+                self._use(value['MailLogId'])
+            return values
+
+    def summaries(self, after, sender='', recipient='', amount=500):
+        address = smtpy_db.fold_address(recipient)
+        with self._lock:
+            if sender:
+                ids = self.by_sender.get(sender, {})
+            elif address:
+                ids = self.by_address.get(address, {})
+            else:
+                ids = self.mails
+
+            # The ids are in the order they were stored, so only the newest are looked at
+            newer = []
+            for mail_log_id in reversed(ids):
+                if mail_log_id <= after:
+                    break
+                newer.append(mail_log_id)
+
+            values = []
+            for mail_log_id in reversed(newer):
+                mail = self.mails[mail_log_id]
+                if address and address not in mail.addresses:
+                    continue
+                values.append({
+                    'MailLogId': mail_log_id,
+                    'Sender': mail.row[3],
+                    'Recipients': mail.row[4],
+                    'Subject': mail.row[2],
+                    'Size': self._size(mail),
+                })
+                if len(values) >= amount:
+                    break
+            return values
+
+    def last_id(self):
+        with self._lock:
+            return next(reversed(self.mails), 0)
+
+    # The search is for emails with every word of q in their subject or body, newest
+    # first. Unlike SqliteStore's FTS5 search, words are only matched whole (so
+    # 'invoic*' doesn't match invoice), phrases and the AND, OR and NOT operators
+    # aren't supported (the words just all have to be there), and accents count
+    def search(self, q, amount=10):
+        words = set(word.casefold() for word in SEARCH_WORD.findall(q) if word not in SEARCH_OPERATORS)
+        with self._lock:
+            values = []
+            for mail in reversed(self.mails.values()):
+                if len(values) >= amount:
+                    break
+                text = '%s\n%s' % (mail.row[2] or '', smtpy_db.inflate_text(mail.row[5]) or '')
+                if words <= set(SEARCH_WORD.findall(text.casefold())):
+                    values.append(self._columns(mail))
+            for value in values:
+                self._use(value['MailLogId'])
+            return values
+
+    def attachments(self, mail_log_id):
+        with self._lock:
+            mail = self.mails.get(int(mail_log_id))
+            if mail is None:
+                return []
+            return [{'FileName': a[5], 'ContentType': a[6], 'ContentId': a[7],
+                     'TransferEncoding': a[8], 'Size': a[4], 'BlobHash': a[1]}
+                    for a in mail.row[smtpy_db.ROW_ATTACHMENTS] or ()]
+
+    def open_raw(self, mail_log_id, stack):
+        with self._lock:
+            mail = self.mails.get(int(mail_log_id))
+            if mail is None or mail.row[smtpy_db.ROW_RAW] is None:
+                return None
+            self._use(mail.mail_log_id)
+            row = mail.row
+
+        raw = smtpy_db.join_attachments(row[smtpy_db.ROW_RAW], row[smtpy_db.ROW_RAW_COMPRESSED],
+                                        [(a[0], a[smtpy_db.ATTACHMENT_DATA], a[smtpy_db.ATTACHMENT_COMPRESSED])
+                                         for a in row[smtpy_db.ROW_ATTACHMENTS] or ()])
+        return io.BytesIO(raw), 0, len(raw)
+
+    def delete(self, mail_log_id=None, sender=None):
+        with self._lock:
+            if mail_log_id is not None:
+                self._remove(int(mail_log_id))
+            if sender is not None:
+                for mail_log_id in list(self.by_sender.get(sender, ())):
+                    self._remove(mail_log_id)
+
+    # Emails are held in the order they were stored, so only the expired ones are looked at
+    def purge(self, max_age_minutes):
+        cutoff = time.time() - max_age_minutes * 60
+        with self._lock:
+            expired = []
+            for mail in self.mails.values():
+                if mail.timestamp >= cutoff:
+                    break
+                expired.append(mail.mail_log_id)
+            for mail_log_id in expired:
+                self._remove(mail_log_id)
+            return len(expired)
+
+
+# The MailWriter of a MemoryStore, storing each batch of emails in its memory
+class MemoryWriter(smtpy_db.MailWriter):
+
+    def __init__(self, store, **kwargs):
+        smtpy_db.MailWriter.__init__(self, **kwargs)
+        self.store = store
+
+    def write_batch(self, rows):
+        self.store.store(rows)
+
+
+# The MailSweeper of a MemoryStore, purging old emails from its memory
+class MemorySweeper(smtpy_db.MailSweeper):
+
+    def __init__(self, store, **kwargs):
+        smtpy_db.MailSweeper.__init__(self, **kwargs)
+        self.store = store
+
+    def sweep(self):
+        return self.store.purge(self.max_age_minutes)
+
+
+# Opens the store chosen by the storage settings
+def open_store(backend=None):
+    storage = config.settings.get('storage', {})
+    backend = backend or storage.get('backend', 'sqlite')
+    if backend == 'sqlite':
+        return SqliteStore(threads=config.settings.get('api', {}).get('threads', 16))
+    if backend == 'memory':
+        compress_threshold, compress_level = smtpy_db.compression_settings()
+        return MemoryStore(max_emails = storage.get('memory_max_emails', 10000),
+                           max_bytes = int(storage.get('memory_max_mb', 256) * 1024 * 1024),
+                           compress_threshold = compress_threshold,
+                           compress_level = compress_level)
+    raise ValueError('unknown storage backend %r, expected one of: %s' % (backend, ', '.join(BACKENDS)))
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+# Returns the store chosen by the storage settings, opened once for this process,
+# so the smtp service and API share it when they're run together
+def default_store():
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = open_store()
+        return _default_store
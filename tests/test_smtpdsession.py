@@ -0,0 +1,478 @@
+#! /usr/bin/env python3
+"""
+Tests for the SMTP session (smtpdsession) as run by the asyncio engine
+(smtpdasync), driving an SMTPProtocol with scripted client bytes through a
+transport that records the replies, so no sockets are needed; and once over
+a real socket, with smtplib.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import smtplib
+import threading
+import unittest
+import smtpdasync
+import smtpdsession
+
+
+# Stands in for an SMTPServer, recording each message given to process_message
+class Server(object):
+    data_size_limit = smtpdsession.DATA_SIZE_DEFAULT
+    data_spool_size = smtpdsession.DATA_SPOOL_SIZE_DEFAULT
+    enable_SMTPUTF8 = False
+    _decode_data = False
+    stream_data = False
+    keep_crlf = False
+    status = None
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+        self._sessions = set()
+        self.messages = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if hasattr(data, 'read'):
+            data = data.read()
+        self.messages.append((mailfrom, list(rcpttos), data))
+        return self.status
+
+
+# Stands in for an asyncio transport, recording everything written to it
+class Transport(object):
+
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 2525) if name == 'peername' else None
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+# Returns the reply codes of some reply lines
+def codes(lines):
+    return [line[:3] for line in lines]
+
+
+class SessionTestCase(unittest.TestCase):
+
+    # Opens a session to a Server with the given settings, returning the greeting
+    def connect(self, **settings):
+        self.server = Server(**settings)
+        self.transport = Transport()
+        self.session = smtpdasync.SMTPProtocol(self.server)
+        self.session.connection_made(self.transport)
+        return self.replies()
+
+    # Sends each of chunks, as separate reads, returning the reply lines to them all
+    def send(self, *chunks):
+        for chunk in chunks:
+            self.session.data_received(chunk)
+        return self.replies()
+
+    def replies(self):
+        data = b''.join(self.transport.writes)
+        self.transport.writes = []
+        return data.decode('utf-8').split('\r\n')[:-1]
+
+    # Greets the server and starts an email, ready for DATA or BDAT
+    def start_mail(self, rcpttos=(b'to@domain.com',)):
+        self.assertEqual(set(codes(self.send(b'EHLO client\r\n'))), {'250'})
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n'), ['250 OK'])
+        for rcptto in rcpttos:
+            self.assertEqual(self.send(b'RCPT TO:<' + rcptto + b'>\r\n'), ['250 OK'])
+
+
+class TestGreeting(SessionTestCase):
+
+    def test_greeting(self):
+        greeting = self.connect()
+        self.assertEqual(codes(greeting), ['220'])
+        self.assertIn(smtpdsession.__version__, greeting[0])
+
+    def test_helo(self):
+        self.connect()
+        self.assertEqual(self.send(b'HELO\r\n'), ['501 Syntax: HELO hostname'])
+        self.assertEqual(codes(self.send(b'HELO client\r\n')), ['250'])
+        self.assertEqual(self.send(b'HELO client\r\n'), ['503 Duplicate HELO/EHLO'])
+        self.assertEqual(self.send(b'EHLO client\r\n'), ['503 Duplicate HELO/EHLO'])
+
+    def test_ehlo(self):
+        self.connect(data_size_limit=1000)
+        lines = self.send(b'ehlo client\r\n')
+        self.assertEqual([line[4:] for line in lines[1:]],
+                         ['SIZE 1000', '8BITMIME', 'CHUNKING', 'BINARYMIME', 'PIPELINING', 'HELP'])
+        self.assertTrue(all(line.startswith('250-') for line in lines[:-1]))
+        self.assertTrue(lines[-1].startswith('250 '))
+
+    def test_ehlo_without_chunking_when_decoding(self):
+        self.connect(_decode_data=True, data_size_limit=0)
+        self.assertEqual([line[4:] for line in self.send(b'EHLO client\r\n')[1:]], ['PIPELINING', 'HELP'])
+
+    def test_helo_gives_no_extensions(self):
+        self.connect()
+        self.send(b'HELO client\r\n')
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com> SIZE=10\r\n'),
+                         ['501 Syntax: MAIL FROM: <address>'])
+
+
+class TestTransaction(SessionTestCase):
+
+    def test_one_email(self):
+        self.connect()
+        self.start_mail((b'one@domain.com', b'two@domain.com'))
+        self.assertEqual(codes(self.send(b'DATA\r\n')), ['354'])
+        self.assertEqual(self.send(b'Subject: hi\r\n\r\nbody\r\n.\r\n'), ['250 OK'])
+        self.assertEqual(self.server.messages,
+                         [('from@domain.com', ['one@domain.com', 'two@domain.com'], b'Subject: hi\n\nbody')])
+
+    def test_emails_one_after_another(self):
+        self.connect()
+        self.start_mail()
+        for i in range(3):
+            if i:
+                self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n', b'RCPT TO:<to@domain.com>\r\n'),
+                                 ['250 OK', '250 OK'])
+            self.send(b'DATA\r\n')
+            self.assertEqual(self.send(b'email %d\r\n.\r\n' % i), ['250 OK'])
+        self.assertEqual([data for _, _, data in self.server.messages], [b'email 0', b'email 1', b'email 2'])
+
+    def test_status_from_process_message(self):
+        self.connect(status='451 Requested action aborted')
+        self.start_mail()
+        self.send(b'DATA\r\n')
+        self.assertEqual(self.send(b'body\r\n.\r\n'), ['451 Requested action aborted'])
+        # The transaction is over either way
+        self.assertEqual(codes(self.send(b'MAIL FROM:<from@domain.com>\r\n')), ['250'])
+
+    def test_decoded_data(self):
+        self.connect(_decode_data=True)
+        self.start_mail()
+        self.send(b'DATA\r\n')
+        self.send('Subject: café\r\n\r\nbody\r\n.\r\n'.encode('utf-8'))
+        self.assertEqual(self.server.messages[0][2], 'Subject: café\n\nbody')
+
+    def test_streamed_data(self):
+        self.connect(stream_data=True, keep_crlf=True)
+        self.start_mail()
+        self.send(b'DATA\r\n', b'Subject: hi\r\n\r\nbody\r\n.\r\n')
+        self.assertEqual(self.server.messages[0][2], b'Subject: hi\r\n\r\nbody\r\n')
+
+    def test_rset(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'RSET\r\n'), ['250 OK'])
+        self.assertEqual(self.send(b'DATA\r\n'), ['503 Error: need RCPT command'])
+        self.assertEqual(self.send(b'RCPT TO:<to@domain.com>\r\n'), ['503 Error: need MAIL command'])
+        # The greeting is kept
+        self.assertEqual(self.send(b'MAIL FROM:<other@domain.com>\r\n'), ['250 OK'])
+        self.assertEqual(self.send(b'RSET now\r\n'), ['501 Syntax: RSET'])
+
+    def test_quit(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'QUIT\r\n'), ['221 Bye'])
+        self.assertTrue(self.transport.closed)
+
+    def test_nothing_after_quit(self):
+        self.connect()
+        self.assertEqual(self.send(b'QUIT\r\nNOOP\r\n'), ['221 Bye'])
+        self.assertEqual(self.send(b'NOOP\r\n'), [])
+
+    def test_connection_lost_mid_data(self):
+        self.connect()
+        self.start_mail()
+        self.send(b'DATA\r\n', b'part of a body')
+        self.session.connection_lost(None)
+        self.assertIsNone(self.session.data_file)
+        self.assertNotIn(self.session, self.server._sessions)
+        self.assertEqual(self.server.messages, [])
+
+
+class TestBadSequences(SessionTestCase):
+
+    def test_before_helo(self):
+        self.connect()
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n'), ['503 Error: send HELO first'])
+        self.assertEqual(self.send(b'RCPT TO:<to@domain.com>\r\n'), ['503 Error: send HELO first'])
+        self.assertEqual(self.send(b'DATA\r\n'), ['503 Error: send HELO first'])
+
+    def test_out_of_order(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.assertEqual(self.send(b'RCPT TO:<to@domain.com>\r\n'), ['503 Error: need MAIL command'])
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n'), ['250 OK'])
+        self.assertEqual(self.send(b'DATA\r\n'), ['503 Error: need RCPT command'])
+        self.assertEqual(self.send(b'MAIL FROM:<again@domain.com>\r\n'), ['503 Error: nested MAIL command'])
+
+    def test_bad_syntax(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.assertEqual(self.send(b'\r\n'), ['500 Error: bad syntax'])
+        self.assertEqual(self.send(b'FOO bar\r\n'), ['500 Error: command "FOO" not recognized'])
+        self.assertEqual(codes(self.send(b'MAIL FROM:\r\n')), ['501'])
+        self.assertEqual(codes(self.send(b'MAIL FROM:<from@domain.com> BODY=9BIT\r\n')), ['501'])
+        self.assertEqual(codes(self.send(b'MAIL FROM:<from@domain.com> FOO=1\r\n')), ['555'])
+        self.send(b'MAIL FROM:<from@domain.com>\r\n')
+        self.assertEqual(codes(self.send(b'RCPT TO:\r\n')), ['501'])
+        self.send(b'RCPT TO:<to@domain.com>\r\n')
+        self.assertEqual(self.send(b'DATA now\r\n'), ['501 Syntax: DATA'])
+
+    def test_line_too_long(self):
+        self.connect()
+        self.assertEqual(self.send(b'NOOP ' + b'x' * 600 + b'\r\n'), ['500 Error: line too long'])
+        self.assertEqual(self.send(b'NOOP\r\n'), ['250 OK'])
+
+    def test_command_split_across_reads(self):
+        self.connect()
+        self.assertEqual(self.send(b'NO', b'OP\r', b'\n'), ['250 OK'])
+
+
+class TestSize(SessionTestCase):
+
+    def test_declared_size_too_big(self):
+        self.connect(data_size_limit=1000)
+        self.send(b'EHLO client\r\n')
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com> SIZE=1001\r\n'),
+                         ['552 Error: message size exceeds fixed maximum message size'])
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com> SIZE=1000\r\n'), ['250 OK'])
+
+    def test_declared_size_not_a_number(self):
+        self.connect(data_size_limit=1000)
+        self.send(b'EHLO client\r\n')
+        self.assertEqual(codes(self.send(b'MAIL FROM:<from@domain.com> SIZE=ten\r\n')), ['501'])
+
+    def test_data_too_big(self):
+        self.connect(data_size_limit=1000)
+        self.start_mail()
+        self.send(b'DATA\r\n')
+        self.assertEqual(self.send(b'x' * 600 + b'\r\n', b'x' * 600 + b'\r\n.\r\n'), ['552 Error: Too much mail data'])
+        self.assertEqual(self.server.messages, [])
+        # The session carries on as normal afterwards
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n'), ['250 OK'])
+
+
+class TestPipelining(SessionTestCase):
+
+    # Returns the separate writes made to the transport, as lists of reply lines
+    def writes(self):
+        writes = [data.decode('utf-8').split('\r\n')[:-1] for data in self.transport.writes]
+        self.transport.writes = []
+        return writes
+
+    def test_replies_in_one_write(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.session.data_received(b'MAIL FROM:<from@domain.com>\r\nRCPT TO:<one@domain.com>\r\n'
+                                   b'RCPT TO:<two@domain.com>\r\nDATA\r\n')
+        # The 354 isn't held back for the email, and the replies before it go with it
+        self.assertEqual(self.writes(), [['250 OK', '250 OK', '250 OK', '354 End data with <CR><LF>.<CR><LF>']])
+        self.session.data_received(b'body\r\n.\r\nQUIT\r\n')
+        self.assertEqual(self.writes(), [['250 OK', '221 Bye']])
+        self.assertEqual(self.server.messages, [('from@domain.com', ['one@domain.com', 'two@domain.com'], b'body')])
+
+    def test_whole_transactions_in_one_packet(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.session.data_received(b''.join(b'MAIL FROM:<from@domain.com>\r\nRCPT TO:<to@domain.com>\r\n'
+                                            b'DATA\r\nemail %d\r\n.\r\n' % i for i in range(3)) + b'NOOP\r\n')
+        self.assertEqual(self.writes(), [['250 OK', '250 OK', '354 End data with <CR><LF>.<CR><LF>', '250 OK'] * 3 + ['250 OK']])
+        self.assertEqual([data for _, _, data in self.server.messages], [b'email 0', b'email 1', b'email 2'])
+
+    # Each command gets its own reply, in order, whether it fails or not
+    def test_failed_commands_in_order(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.session.data_received(b'MAIL FROM:<from@domain.com>\r\nRCPT TO:<no@domain.com> FOO=1\r\nRCPT TO:<to@domain.com>\r\n'
+                                   b'FOO\r\nDATA\r\nbody\r\n.\r\n')
+        self.assertEqual(codes(self.writes()[0]), ['250', '555', '250', '500', '354', '250'])
+        self.assertEqual(self.server.messages, [('from@domain.com', ['to@domain.com'], b'body')])
+
+    # A command that's only partly in one packet is replied to once the rest arrives
+    def test_split_between_packets(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.session.data_received(b'MAIL FROM:<from@domain.com>\r\nRCPT TO:<to@')
+        self.assertEqual(self.writes(), [['250 OK']])
+        self.session.data_received(b'domain.com>\r\nDATA\r\n')
+        self.assertEqual(self.writes(), [['250 OK', '354 End data with <CR><LF>.<CR><LF>']])
+
+
+class TestDataSplits(SessionTestCase):
+
+    # The lines of an email, several of which start with dots, so are sent dot-stuffed
+    LINES = [b'Subject: dots', b'', b'.one dot', b'..two dots', b'.', b'a.b', b'.\r', b'', b'end.']
+
+    # The email as sent, then a command pipelined after it
+    WIRE = b''.join((b'.' + line if line.startswith(b'.') else line) + b'\r\n' for line in LINES) + b'.\r\nNOOP\r\n'
+
+    # Sends the email split into the given reads, checking what's received
+    def assert_received(self, chunks, keep_crlf):
+        self.assertEqual(self.send(b'MAIL FROM:<from@domain.com>\r\n', b'RCPT TO:<to@domain.com>\r\n', b'DATA\r\n'),
+                         ['250 OK', '250 OK', '354 End data with <CR><LF>.<CR><LF>'])
+        self.assertEqual(self.send(*chunks), ['250 OK', '250 OK'], chunks)
+        expected = b'\r\n'.join(self.LINES) + b'\r\n' if keep_crlf else b'\n'.join(self.LINES)
+        self.assertEqual(self.server.messages.pop()[2], expected, chunks)
+
+    def check_splits(self, **settings):
+        for keep_crlf in (False, True):
+            self.connect(keep_crlf=keep_crlf, **settings)
+            self.send(b'EHLO client\r\n')
+            self.assert_received([self.WIRE], keep_crlf)
+            self.assert_received([self.WIRE[i:i + 1] for i in range(len(self.WIRE))], keep_crlf)
+            for i in range(1, len(self.WIRE)):
+                self.assert_received([self.WIRE[:i], self.WIRE[i:]], keep_crlf)
+
+    # Every split puts the terminator, a CRLF or a stuffed dot across two reads somewhere
+    def test_every_split(self):
+        self.check_splits()
+
+    # Likewise while what's received is written to the spool as it goes, and spills to disk
+    def test_every_split_spooled(self):
+        self.check_splits(data_spool_size=4, stream_data=True)
+
+    # A terminator split across reads that turns out not to be one
+    def test_almost_a_terminator(self):
+        self.connect()
+        self.start_mail()
+        self.send(b'DATA\r\n')
+        self.assertEqual(self.send(b'one\r\n', b'.', b'\r', b'x\r\n', b'.\r', b'\n'), ['250 OK'])
+        self.assertEqual(self.server.messages[0][2], b'one\n\rx')
+
+
+class TestBdat(SessionTestCase):
+
+    def test_chunks(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 12\r\nSubject: hi\r'), ['250 OK 12 octets received'])
+        self.assertEqual(self.send(b'BDAT 7 LAST\r\n\n\r\nbody'), ['250 OK'])
+        self.assertEqual(self.server.messages, [('from@domain.com', ['to@domain.com'], b'Subject: hi\n\nbody')])
+
+    # The chunk, and the command giving its size, can arrive in any number of reads
+    def test_split_across_reads(self):
+        self.connect()
+        self.start_mail()
+        wire = b'BDAT 10\r\n.\r\n\r\n.body' + b'BDAT 7 LAST\r\n\r\nend\r\nNOOP\r\n'
+        for i in range(1, len(wire)):
+            self.assertEqual(self.send(wire[:i], wire[i:]), ['250 OK 10 octets received', '250 OK', '250 OK'], i)
+            self.assertEqual(self.server.messages.pop()[2], b'.\n\n.body\nend\n')
+            self.send(b'MAIL FROM:<from@domain.com>\r\n', b'RCPT TO:<to@domain.com>\r\n')
+
+    def test_zero_last(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 4\r\nbody', b'BDAT 0 LAST\r\n'), ['250 OK 4 octets received', '250 OK'])
+        self.assertEqual(self.server.messages[0][2], b'body')
+
+    def test_empty_message(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 0 LAST\r\n'), ['250 OK'])
+        self.assertEqual(self.server.messages[0][2], b'')
+
+    # The chunk is still read, rather than taken as commands
+    def test_after_failed_rcpt(self):
+        self.connect()
+        self.send(b'EHLO client\r\n', b'MAIL FROM:<from@domain.com>\r\n')
+        self.assertEqual(codes(self.send(b'RCPT TO:<to@domain.com> FOO=1\r\n')), ['555'])
+        self.assertEqual(self.send(b'BDAT 12 LAST\r\nQUIT\r\nQUIT\r\n', b'NOOP\r\n'),
+                         ['503 Error: need RCPT command', '250 OK'])
+        self.assertEqual(self.server.messages, [])
+        self.assertFalse(self.transport.closed)
+
+    def test_before_helo(self):
+        self.connect()
+        self.assertEqual(self.send(b'BDAT 4 LAST\r\nbody'), ['503 Error: send HELO first'])
+
+    def test_mixed_with_data(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 4\r\nbody'), ['250 OK 4 octets received'])
+        self.assertEqual(self.send(b'DATA\r\n'), ['503 Error: BDAT transaction in progress'])
+        self.assertEqual(self.send(b'BDAT 0 LAST\r\n'), ['250 OK'])
+        # DATA, then BDAT, work as normal once the BDAT transaction is over
+        self.send(b'MAIL FROM:<from@domain.com>\r\n', b'RCPT TO:<to@domain.com>\r\n')
+        self.assertEqual(self.send(b'DATA\r\n', b'by data\r\n.\r\n'), ['354 End data with <CR><LF>.<CR><LF>', '250 OK'])
+        self.send(b'MAIL FROM:<from@domain.com>\r\n', b'RCPT TO:<to@domain.com>\r\n')
+        self.assertEqual(self.send(b'BDAT 7 LAST\r\nby bdat'), ['250 OK'])
+        self.assertEqual([data for _, _, data in self.server.messages], [b'body', b'by data', b'by bdat'])
+
+    def test_binarymime(self):
+        self.connect()
+        self.send(b'EHLO client\r\n', b'MAIL FROM:<from@domain.com> BODY=BINARYMIME\r\n', b'RCPT TO:<to@domain.com>\r\n')
+        self.assertEqual(self.send(b'DATA\r\n'), ['503 Error: BINARYMIME requires BDAT'])
+        self.assertEqual(self.send(b'BDAT 6 LAST\r\n\x00\r\n\xff\r\n'), ['250 OK'])
+        self.assertEqual(self.server.messages[0][2], b'\x00\r\n\xff\r\n')
+
+    # The commands between chunks aren't counted as part of the email, however big they are
+    def test_big_chunks(self):
+        self.connect()
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 1000\r\n' + b'x' * 1000, b'BDAT 1000 LAST\r\n' + b'y' * 1000),
+                         ['250 OK 1000 octets received', '250 OK'])
+        self.assertEqual(self.server.messages[0][2], b'x' * 1000 + b'y' * 1000)
+
+    # The size limit is for the whole email, across chunks
+    def test_too_much_data(self):
+        self.connect(data_size_limit=10)
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 8\r\n12345678', b'BDAT 8 LAST\r\n12345678'),
+                         ['250 OK 8 octets received', '552 Error: Too much mail data'])
+        self.assertEqual(self.server.messages, [])
+
+    def test_bad_sizes(self):
+        self.connect()
+        self.start_mail()
+        for arg in (b'', b' -1', b' +1', b' 1.0', b' \xc2\xb2', b' \xd9\xa1 LAST', b' 1 FIRST', b' 1 LAST NOW'):
+            self.assertEqual(self.send(b'BDAT' + arg + b'\r\n'), ['501 Syntax: BDAT <chunk-size> [LAST]'], arg)
+        self.assertEqual(self.send(b'BDAT 1 last\r\nx'), ['250 OK'])
+
+    # Likewise for the size given to MAIL
+    def test_bad_declared_size(self):
+        self.connect()
+        self.send(b'EHLO client\r\n')
+        self.assertEqual(codes(self.send(b'MAIL FROM:<from@domain.com> SIZE=\xc2\xb2\r\n')), ['501'])
+
+    def test_not_while_decoding(self):
+        self.connect(_decode_data=True)
+        self.start_mail()
+        self.assertEqual(self.send(b'BDAT 4 LAST\r\n'), ['500 Error: command "BDAT" not recognized'])
+
+
+class TestOverSocket(unittest.TestCase):
+
+    def test_smtplib(self):
+        class Recorder(smtpdasync.SMTPServer):
+            messages = []
+
+            def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+                self.messages.append((mailfrom, rcpttos, data))
+
+        server = Recorder(('127.0.0.1', 0), None, decode_data=False)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            port = server.sockets[0].getsockname()[1]
+            with smtplib.SMTP('127.0.0.1', port) as client:
+                client.sendmail('from@domain.com', ['to@domain.com'], b'Subject: hi\r\n\r\n.dot\r\nbody')
+        finally:
+            server.close()
+            thread.join()
+        self.assertEqual(Recorder.messages, [('from@domain.com', ['to@domain.com'], b'Subject: hi\n\n.dot\nbody')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+#! /usr/bin/env python3
+"""
+Tests for smtpy_api, making requests of it over HTTP as a client would. The API
+is served once for all of the tests, from a database of its own, by a small
+pool of threads so that its limits are quickly reached.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import copy
+import json
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import importlib
+import threading
+import http.client
+import bottle
+import smtpy_db
+import smtpy_config as config
+
+
+THREADS = 4
+MAX_WAITERS = 2
+KEEPALIVE_TIMEOUT = 1
+MAX_STREAMS = 2
+
+smtpy_api = None
+_settings = None
+_directory = None
+_thread = None
+
+
+# The API reads its settings once imported, so it's only imported once they're set
+def setUpModule():
+    global smtpy_api, _settings, _directory, _thread
+    _settings = copy.deepcopy(config.settings)
+    _directory = tempfile.mkdtemp()
+
+    config.settings['database'] = os.path.join(_directory, 'smtpy.db')
+    config.settings['storage'].update(backend='sqlite', segment_directory=None, partition_minutes=0)
+    config.settings['api'].update(port=0, notify_port=0, threads=THREADS, max_waiters=MAX_WAITERS,
+                                 keepalive_timeout=KEEPALIVE_TIMEOUT, max_streams=MAX_STREAMS)
+    smtpy_db.create_schema(config.settings['database'])
+
+    smtpy_api = importlib.import_module('smtpy_api')
+    _thread = threading.Thread(target=smtpy_api.__init__, daemon=True)
+    _thread.start()
+    deadline = time.monotonic() + 10
+    while smtpy_api.__server__ is None or smtpy_api.__server__.server is None:
+        if time.monotonic() > deadline:
+            raise RuntimeError('the API did not start')
+        time.sleep(0.01)
+
+
+def tearDownModule():
+    smtpy_api.__stop__()
+    _thread.join(10)
+    config.settings.clear()
+    config.settings.update(_settings)
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+# Opens a connection to the API
+def connect():
+    return http.client.HTTPConnection('127.0.0.1', smtpy_api.__server__.server.server_port, timeout=30)
+
+
+# Makes a GET request of the API, returning the response and its body
+def get(path, connection=None, headers=None):
+    conn = connection or connect()
+    try:
+        conn.request('GET', path, headers=headers or {})
+        resp = conn.getresponse()
+        return resp, resp.read()
+    finally:
+        if connection is None:
+            conn.close()
+
+
+# Makes a GET request of the API, returning its status and JSON body
+def get_json(path):
+    resp, body = get(path)
+    return resp.status, json.loads(body.decode('utf-8'))
+
+
+# Creates an email through the API, returning its MailLogId
+def create_email(sender, recipients='to@domain.com', subject='Test'):
+    status, value = get_json('/create/email?sender=%s&recipients=%s&subject=%s' % (sender, recipients, subject))
+    return value['MailLogId']
+
+
+# Makes a request on a thread of its own, so others can be made while it waits
+class Request(threading.Thread):
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.result = None
+        self.elapsed = None
+        self.start()
+
+    def run(self):
+        started = time.monotonic()
+        self.result = get_json(self.path)
+        self.elapsed = time.monotonic() - started
+
+
+class TestWaitEmails(unittest.TestCase):
+
+    def test_timeout(self):
+        started = time.monotonic()
+        status, values = get_json('/wait/emails?email=timeout@domain.com&timeout=0.5')
+        self.assertEqual((status, values), (200, []))
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+    def test_existing_email(self):
+        mail_log_id = create_email('existing@domain.com')
+        status, values = get_json('/wait/emails?email=existing@domain.com&timeout=10')
+        self.assertEqual([v['MailLogId'] for v in values], [mail_log_id])
+
+    def test_wakes_when_stored(self):
+        waiter = Request('/wait/emails?email=wake@domain.com&timeout=10')
+        time.sleep(0.5)
+        mail_log_id = create_email('wake@domain.com')
+        waiter.join(10)
+
+        self.assertEqual([v['MailLogId'] for v in waiter.result[1]], [mail_log_id])
+        # Well before the store would have been checked again
+        self.assertLess(waiter.elapsed, smtpy_api.WAIT_RECHECK_SECONDS)
+
+    def test_only_wakes_for_a_match(self):
+        last = create_email('after@domain.com')
+        waiter = Request('/wait/emails/to?email=Match@Domain.com&timeout=10&after=%d' % last)
+        time.sleep(0.5)
+        create_email('after@domain.com', recipients='other@domain.com')
+        time.sleep(0.5)
+        self.assertIsNone(waiter.result)
+
+        mail_log_id = create_email('after@domain.com', recipients='match@domain.com')
+        waiter.join(10)
+        self.assertEqual([v['MailLogId'] for v in waiter.result[1]], [mail_log_id])
+
+    def test_max_waiters(self):
+        self.assertEqual(smtpy_api.WAITER_LIMIT, MAX_WAITERS)
+        waiters = [Request('/wait/emails?email=cap@domain.com&timeout=10') for _ in range(MAX_WAITERS)]
+        time.sleep(0.5)
+
+        resp, body = get('/wait/emails?email=cap@domain.com&timeout=10')
+        self.assertEqual(resp.status, 503)
+        self.assertEqual(resp.getheader('Retry-After'), str(smtpy_api.BUSY_RETRY_SECONDS))
+
+        # Other requests are still served while the waiters hold their threads
+        self.assertEqual(get_json('/retrieve/emails?email=cap@domain.com'), (200, []))
+
+        mail_log_id = create_email('cap@domain.com')
+        for waiter in waiters:
+            waiter.join(10)
+            self.assertEqual([v['MailLogId'] for v in waiter.result[1]], [mail_log_id])
+
+        # The waiters' slots are given back
+        waiters = [Request('/wait/emails?email=cap@domain.com&timeout=0.5&after=%d' % mail_log_id)
+                   for _ in range(MAX_WAITERS)]
+        for waiter in waiters:
+            waiter.join(10)
+            self.assertEqual(waiter.result, (200, []))
+
+
+# Returns the threads of the API's pool
+def pool_threads():
+    return [t for t in threading.enumerate() if t.name.startswith('smtpy-api_')]
+
+
+class TestKeepAlive(unittest.TestCase):
+
+    def test_requests_on_one_connection(self):
+        conn = connect()
+        try:
+            resp, body = get('/retrieve/emails?email=keepalive@domain.com', conn)
+            sock = conn.sock
+            self.assertEqual(resp.version, 11)
+            self.assertIsNotNone(sock)
+
+            for path in ('/retrieve/emails/to?email=keepalive@domain.com',
+                         '/retrieve/email?mailLogId=1',
+                         '/search/emails?q=keepalive'):
+                resp, body = get(path, conn)
+                self.assertEqual(resp.status, 200)
+                self.assertIs(conn.sock, sock)
+        finally:
+            conn.close()
+
+    def test_pipelined_requests(self):
+        request = b'GET /retrieve/emails?email=pipelined@domain.com HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        with socket.create_connection(('127.0.0.1', smtpy_api.__server__.server.server_port), timeout=30) as sock:
+            sock.sendall(request * 3)
+            received = b''
+            while received.count(b'HTTP/1.1 200') < 3 or not received.endswith(b'[]'):
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received += data
+        self.assertEqual(received.count(b'HTTP/1.1 200'), 3)
+
+    def test_closed_when_idle(self):
+        conn = connect()
+        try:
+            get('/retrieve/emails?email=idle@domain.com', conn)
+            conn.sock.settimeout(KEEPALIVE_TIMEOUT + 10)
+            started = time.monotonic()
+            self.assertEqual(conn.sock.recv(1), b'')
+            self.assertGreaterEqual(time.monotonic() - started, KEEPALIVE_TIMEOUT)
+        finally:
+            conn.close()
+
+    def test_idle_connections_dont_hold_threads(self):
+        connections = [connect() for _ in range(THREADS * 3)]
+        try:
+            for conn in connections:
+                resp, body = get('/retrieve/emails?email=pool@domain.com', conn)
+                self.assertEqual(resp.status, 200)
+
+            # Every connection is still open, and served again, by no more than the pool
+            for conn in connections:
+                sock = conn.sock
+                resp, body = get('/retrieve/emails?email=pool@domain.com', conn)
+                self.assertEqual(resp.status, 200)
+                self.assertIs(conn.sock, sock)
+            self.assertLessEqual(len(pool_threads()), THREADS)
+        finally:
+            for conn in connections:
+                conn.close()
+
+
+# A client of /stream/emails, reading its events one at a time
+class Stream(object):
+
+    def __init__(self, path='/stream/emails', headers=None, port=None):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port or smtpy_api.__server__.server.server_port, timeout=10)
+        self.conn.request('GET', path, headers=headers or {})
+        self.response = self.conn.getresponse()
+
+    # Returns the fields of the next event (or comment), or None once the stream has ended
+    def read(self):
+        fields = {}
+        while True:
+            line = self.response.readline()
+            if not line:
+                return None
+            line = line.decode('utf-8').rstrip('\n')
+            if not line:
+                return fields
+            name, _, value = line.partition(':')
+            fields[name] = value.lstrip(' ')
+
+    def close(self):
+        self.conn.close()
+
+
+class TestStreamEmails(unittest.TestCase):
+
+    def setUp(self):
+        self.streams = []
+
+    # A stream only notices its client has gone when it next sends something, so
+    # they're ended by stopping the listener, which gives back their slots
+    def tearDown(self):
+        self.end_streams()
+        for stream in self.streams:
+            stream.close()
+
+    def end_streams(self):
+        smtpy_api.listener.stop()
+        try:
+            for stream in self.streams:
+                while stream.read() is not None:
+                    pass
+        finally:
+            smtpy_api.listener.start()
+
+    def open(self, path='/stream/emails', headers=None, port=None):
+        stream = Stream(path, headers, port)
+        self.streams.append(stream)
+        return stream
+
+    # Returns the data of a stream's next event, which is for an email
+    def read_email(self, stream):
+        event = stream.read()
+        data = json.loads(event['data'])
+        self.assertEqual(int(event['id']), data['MailLogId'])
+        return data
+
+    def test_retry(self):
+        stream = self.open('/stream/emails?sender=retry@domain.com')
+        self.assertEqual(stream.response.status, 200)
+        self.assertEqual(stream.response.getheader('Content-Type'), 'text/event-stream; charset=utf-8')
+        self.assertEqual(stream.read(), {'retry': '2000'})
+
+    def test_new_emails(self):
+        create_email('new@domain.com')
+        stream = self.open('/stream/emails?sender=new@domain.com')
+        stream.read()
+
+        mail_log_id = create_email('new@domain.com', subject='Streamed')
+        create_email('other@domain.com')
+        data = self.read_email(stream)
+        self.assertEqual((data['MailLogId'], data['Sender'], data['Subject']),
+                         (mail_log_id, 'new@domain.com', 'Streamed'))
+
+    def test_last_event_id(self):
+        ids = [create_email('replay@domain.com') for _ in range(3)]
+
+        stream = self.open('/stream/emails?sender=replay@domain.com', {'Last-Event-ID': str(ids[0])})
+        stream.read()
+        self.assertEqual([self.read_email(stream)['MailLogId'] for _ in ids[1:]], ids[1:])
+
+        # Then carries on with what's stored from now on
+        ids.append(create_email('replay@domain.com'))
+        self.assertEqual(self.read_email(stream)['MailLogId'], ids[-1])
+
+        stream = self.open('/stream/emails?sender=replay@domain.com&lastEventId=%d' % ids[1])
+        stream.read()
+        self.assertEqual([self.read_email(stream)['MailLogId'] for _ in ids[2:]], ids[2:])
+
+    def test_recipient(self):
+        stream = self.open('/stream/emails?recipient=Streamed@Domain.com')
+        stream.read()
+        create_email('from@domain.com', recipients='other@domain.com')
+        mail_log_id = create_email('from@domain.com', recipients='streamed@domain.com')
+        self.assertEqual(self.read_email(stream)['MailLogId'], mail_log_id)
+
+    def test_max_streams(self):
+        streams = [self.open('/stream/emails?sender=cap@domain.com') for _ in range(MAX_STREAMS)]
+        for stream in streams:
+            self.assertEqual(stream.read(), {'retry': '2000'})
+
+        resp, body = get('/stream/emails?sender=cap@domain.com')
+        self.assertEqual(resp.status, 503)
+        self.assertEqual(resp.getheader('Retry-After'), str(smtpy_api.BUSY_RETRY_SECONDS))
+
+        self.end_streams()
+        stream = self.open('/stream/emails?sender=cap@domain.com')
+        self.assertEqual(stream.response.status, 200)
+
+    # Stopping the API as __stop__ does ends its streams, rather than waiting on them
+    def test_stopped(self):
+        server = smtpy_api.ThreadPoolWSGIServer(('127.0.0.1', 0), smtpy_api.KeepAliveRequestHandler,
+                                                threads=2, keepalive_timeout=30)
+        server.set_app(bottle.default_app())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        stream = self.open('/stream/emails?sender=stopped@domain.com', port=server.server_port)
+        stream.read()
+
+        started = time.monotonic()
+        smtpy_api.listener.stop()
+        try:
+            server.shutdown()
+            thread.join(10)
+        finally:
+            smtpy_api.listener.start()
+
+        self.assertIsNone(stream.read())
+        self.assertLess(time.monotonic() - started, smtpy_api.WAIT_RECHECK_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
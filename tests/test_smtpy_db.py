@@ -0,0 +1,427 @@
+#! /usr/bin/env python3
+"""
+Tests for smtpy_db, checking that a database from the first version of smtpy is
+upgraded without losing or renumbering any of its emails, while new emails are
+still being stored; and that a database split into partitions hands each email
+to exactly one of them, and is read from as though it weren't split; and that
+attachments are only compressed when they're first stored.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import copy
+import time
+import queue
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import threading
+import contextlib
+import smtpy_db
+import smtpy_mime
+import smtpy_storage
+import smtpy_config as config
+from unittest import mock
+
+
+# The first version's MailLog, as created by smtpy before it had a schema version
+LEGACY_MAIL_LOG_SQL = """CREATE TABLE IF NOT EXISTS MailLog
+                    (
+                        MailLogId INTEGER PRIMARY KEY AUTOINCREMENT,
+                        IPAddress TEXT,
+                        PortNumber TEXT,
+                        Subject TEXT,
+                        Sender TEXT,
+                        Recipients TEXT,
+                        Body TEXT,
+                        TimeStamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )"""
+
+LEGACY_EMAILS = 300
+
+
+# Returns the body the first version stored for an email received over SMTP: the
+# tail of the repr of its bytes, after the headers
+def legacy_body(data):
+    return str(data).split('\\n\\n')[-1]
+
+
+class TestDecodeLegacyBody(unittest.TestCase):
+
+    def test_repr_of_bytes(self):
+        data = b'Subject: hi\n\nline 1\nl\xc3\xa9 it\'s a \\ and a "quote"\n'
+        self.assertEqual(smtpy_db.decode_legacy_body(legacy_body(data)),
+                         'line 1\nl\xe9 it\'s a \\ and a "quote"\n')
+
+    def test_repr_with_double_quotes(self):
+        data = b'Subject: hi\n\nit\'s\n'
+        self.assertTrue(legacy_body(data).endswith('"'))
+        self.assertEqual(smtpy_db.decode_legacy_body(legacy_body(data)), 'it\'s\n')
+
+    def test_kept_as_is(self):
+        for body in ('plain body', 'two\nlines\'', '', None):
+            self.assertEqual(smtpy_db.decode_legacy_body(body), body)
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+
+        conn = sqlite3.connect(self.database)
+        conn.execute(LEGACY_MAIL_LOG_SQL)
+        for i in range(1, LEGACY_EMAILS + 1):
+            data = ('Subject: Email %d\n\nBody of email %d\nit\'s café\n' % (i, i)).encode('utf-8')
+            conn.execute("""INSERT INTO MailLog(IPAddress, PortNumber, Subject, Sender, Recipients, Body, TimeStamp)
+                            VALUES ('127.0.0.1', '5555', ?, 'old@domain.com', ?, ?, '2015-07-01 12:00:00')""",
+                         ('Email %d' % i, str(['To%d@Domain.com' % i, 'cc@other.com']), legacy_body(data)))
+
+        # One created through the API, and the last handed out since deleted
+        conn.execute("""INSERT INTO MailLog(IPAddress, PortNumber, Subject, Sender, Recipients, Body)
+                        VALUES ('127.0.0.1', '1234', 'API', 'api@domain.com', 'api@domain.com', 'plain body')""")
+        conn.execute("INSERT INTO MailLog(Sender, Body) VALUES ('deleted@domain.com', 'deleted')")
+        conn.execute('DELETE FROM MailLog WHERE MailLogId = ?', (LEGACY_EMAILS + 2,))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def query(self, sql, params=()):
+        conn = smtpy_db.connect(self.database)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    # Migrates the emails a few at a time, while a writer stores new ones in between
+    def migrate_while_writing(self, count):
+        self.assertTrue(smtpy_db.create_schema(self.database))
+        writer = smtpy_db.MailWriter(self.database)
+        moved = []
+        thread = threading.Thread(target=lambda: moved.append(smtpy_db.migrate(self.database, batch_size=25)))
+        thread.start()
+        try:
+            for i in range(count):
+                writer.write_batch([('127.0.0.1', 25, 'New %d' % i, 'new@domain.com',
+                                     ['new%d@domain.com' % i], 'new body %d' % i)])
+        finally:
+            thread.join()
+            writer.close()
+        return moved[0]
+
+    def test_migrate(self):
+        self.assertEqual(self.migrate_while_writing(50), LEGACY_EMAILS + 1)
+        self.assertFalse(smtpy_db.create_schema(self.database))
+        self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name = 'MailLog_v1'"), [])
+
+        # The old emails keep their MailLogIds, and new ones carry on after the deleted one
+        old = self.query("SELECT MailLogId FROM MailLog WHERE Sender IN ('old@domain.com', 'api@domain.com') ORDER BY MailLogId")
+        self.assertEqual([r[0] for r in old], list(range(1, LEGACY_EMAILS + 2)))
+        new = self.query("SELECT MailLogId FROM MailLog WHERE Sender = 'new@domain.com' ORDER BY MailLogId")
+        self.assertEqual([r[0] for r in new], list(range(LEGACY_EMAILS + 3, LEGACY_EMAILS + 53)))
+
+        rows = self.query('SELECT PortNumber, Body, typeof(TimeStamp) FROM MailLog WHERE MailLogId IN (1, ?) ORDER BY MailLogId',
+                          (LEGACY_EMAILS + 1,))
+        self.assertEqual(rows, [(5555, 'Body of email 1\nit\'s café\n', 'integer'),
+                                (1234, 'plain body', 'integer')])
+
+    def test_recipients(self):
+        self.migrate_while_writing(10)
+
+        self.assertEqual(self.query('SELECT Address, Domain FROM MailRecipient WHERE MailLogId = 7 ORDER BY Address'),
+                         [('cc@other.com', 'other.com'), ('to7@domain.com', 'domain.com')])
+        self.assertEqual(self.query('SELECT Address FROM MailRecipient WHERE MailLogId = ?', (LEGACY_EMAILS + 1,)),
+                         [('api@domain.com',)])
+        self.assertEqual(self.query('SELECT COUNT(*) FROM MailRecipient'), [(LEGACY_EMAILS * 2 + 1 + 10,)])
+
+        # The migrated emails are found by recipient, as new ones are
+        self.assertEqual(self.query(smtpy_db.SELECT_MAIL_BY_RECIPIENT_SQL, ('to7@domain.com', 10))[0][0], 7)
+        self.assertEqual(len(self.query(smtpy_db.SELECT_MAIL_BY_DOMAIN_SQL, ('other.com', 1000))), LEGACY_EMAILS)
+
+
+# Stands in for the time module within smtpy_db, so partitions start when told to
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# Start of a partition, in seconds since the epoch
+START = 1800000000
+PARTITION_MINUTES = 10
+
+
+# Returns a row for an email, as for smtpy_db.INSERT_MAIL_SQL
+def mail_row(subject, body='body', sender='from@domain.com'):
+    return ('127.0.0.1', 25, subject, sender, ['to@domain.com'], body)
+
+
+class TestPartitions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+        self.settings = copy.deepcopy(config.settings)
+        config.settings['database'] = self.database
+        config.settings['storage'].update(partition_minutes=PARTITION_MINUTES, segment_directory=None)
+        config.settings['smtp'].update(purge_email=True, purge_after_minutes=30)
+
+        self.clock = Clock(START)
+        patcher = mock.patch.object(smtpy_db, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        smtpy_db.create_schema(self.database)
+        self.writers = []
+        self.store = smtpy_storage.SqliteStore(self.database, threads=1)
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+        self.store.close()
+        config.settings.clear()
+        config.settings.update(self.settings)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def writer(self, partition_minutes=PARTITION_MINUTES):
+        writer = smtpy_db.MailWriter(self.database, partition_minutes=partition_minutes)
+        self.writers.append(writer)
+        return writer
+
+    def partitions(self):
+        return [path for start, path in smtpy_db.partitions(self.database)]
+
+    # Returns the MailLogIds in a database, or one of its partitions
+    def ids(self, database):
+        conn = smtpy_db.connect(database)
+        try:
+            return [r[0] for r in conn.execute('SELECT MailLogId FROM MailLog ORDER BY MailLogId')]
+        finally:
+            conn.close()
+
+    def assert_sealed(self, database):
+        conn = smtpy_db.connect(database)
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                with conn:
+                    smtpy_db.insert_mails(conn, [mail_row('Sealed')])
+        finally:
+            conn.close()
+
+    def test_sealed(self):
+        writer = self.writer()
+        writer.write_batch([mail_row('One'), mail_row('Two')])
+        self.clock.now += PARTITION_MINUTES * 60
+        writer.write_batch([mail_row('Three')])
+
+        first, second = self.partitions()
+        self.assertEqual(first, smtpy_db.partition_path(self.database, START))
+        self.assertEqual((self.ids(first), self.ids(second), self.ids(self.database)), ([1, 2], [3], []))
+        self.assert_sealed(self.database)
+        self.assert_sealed(first)
+
+        self.assertEqual([v['MailLogId'] for v in self.store.query(sender='from@domain.com', amount=10)], [3, 2, 1])
+
+    # Once no longer split, emails go into the database again, after the newest partition's
+    def test_unseal(self):
+        self.writer().write_batch([mail_row('One'), mail_row('Two')])
+        self.assert_sealed(self.database)
+        config.settings['storage']['partition_minutes'] = 0
+        smtpy_db.create_schema(self.database)
+
+        self.writer(0).write_batch([mail_row('Three')])
+        self.assertEqual((self.ids(self.partitions()[0]), self.ids(self.database)), ([1, 2], [3]))
+
+    # A writer that took its partition to still be the newest, just as a newer one was
+    # started, inserts the batch into the newer one instead
+    def test_sealed_retry(self):
+        late = self.writer()
+        late.write_batch([mail_row('One')])
+
+        self.clock.now += PARTITION_MINUTES * 60
+        self.writer().write_batch([mail_row('Two')])
+
+        self.clock.now -= 1
+        late.write_batch([mail_row('Three')])
+        first, second = self.partitions()
+        self.assertEqual((self.ids(first), self.ids(second)), ([1], [2, 3]))
+
+    def test_drop_partition(self):
+        writer = self.writer()
+        for i in range(4):
+            writer.write_batch([mail_row('Email %d' % i)])
+            self.clock.now += PARTITION_MINUTES * 60
+        paths = self.partitions()
+        self.assertEqual(len(paths), 4)
+
+        # Only partitions whose every email has expired go, and never the newest
+        sweeper = smtpy_db.MailSweeper(self.database, max_age_minutes=30, partition_minutes=PARTITION_MINUTES)
+        try:
+            self.assertEqual(sweeper.drop_partitions(START + PARTITION_MINUTES * 60 * 2), 2)
+            self.assertEqual(self.partitions(), paths[2:])
+            self.assertEqual(sweeper.drop_partitions(START + PARTITION_MINUTES * 60 * 10), 1)
+            self.assertEqual(self.partitions(), paths[3:])
+        finally:
+            sweeper.close()
+        self.assertEqual([v['MailLogId'] for v in self.store.query(sender='from@domain.com', amount=10)], [4])
+
+        # Along with its WAL files, and a partition already gone is taken as dropped
+        for suffix in ('-wal', '-shm'):
+            open(paths[0] + suffix, 'wb').close()
+        self.assertTrue(smtpy_db.drop_partition(paths[0]))
+        self.assertFalse(any(name.startswith(os.path.basename(paths[0])) for name in os.listdir(self.directory)))
+
+    # The best matches come first, whichever partition they're in
+    def test_search(self):
+        writer = self.writer()
+        filler = ' '.join('word%d' % i for i in range(50))
+        writer.write_batch([mail_row('Invoice', 'Your invoice'), mail_row('Other', filler)])
+        self.clock.now += PARTITION_MINUTES * 60
+        writer.write_batch([mail_row('Newer', filler + ' invoice'), mail_row('Another', filler)])
+
+        values = self.store.search('invoice', 10)
+        self.assertEqual([v['MailLogId'] for v in values], [1, 3])
+        self.assertNotIn('MatchRank', values[0])
+        self.assertEqual([v['MailLogId'] for v in self.store.search('invoice', 1)], [1])
+
+
+# Returns the row of an email with an attachment taken out of it, as the smtp
+# service queues it to be stored
+def attachment_row(subject, data):
+    raw = ('Subject: %s\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n--b\r\n'
+           'Content-Type: application/pdf\r\nContent-Disposition: attachment; filename="a.pdf"\r\n'
+           'Content-Transfer-Encoding: base64\r\n\r\n' % subject).encode('ascii') + data + b'\r\n--b--\r\n'
+    mail = smtpy_mime.parse(raw)
+    stored, attachments = smtpy_db.extract_attachments(mail.raw, mail.attachments, 1)
+    return raw, smtpy_db.compress_row(('127.0.0.1', 25, subject, 'from@domain.com', ['to@domain.com'], mail.body,
+                                       None, None, None, None, mail.content_type, None, mail.size,
+                                       stored, None, attachments), 1)
+
+
+class TestAttachments(unittest.TestCase):
+
+    DATA = b'QUJD' * 1000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+        smtpy_db.create_schema(self.database)
+        self.conn = smtpy_db.connect(self.database)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Rows are queued with their attachments only hashed, not compressed
+    def test_queued_uncompressed(self):
+        raw, row = attachment_row('Queued', self.DATA)
+        attachment = row[smtpy_db.ROW_ATTACHMENTS][0]
+        self.assertEqual(attachment[smtpy_db.ATTACHMENT_DATA], self.DATA)
+        self.assertIsNone(attachment[smtpy_db.ATTACHMENT_COMPRESSED])
+        self.assertEqual(attachment[1], smtpy_db.hash_data(self.DATA))
+
+    def test_compressed_once(self):
+        emails = [attachment_row('Email %d' % i, self.DATA) for i in range(3)]
+        with mock.patch.object(smtpy_db, 'compress', wraps=smtpy_db.compress) as compress:
+            with self.conn:
+                smtpy_db.insert_mails(self.conn, [emails[0][1], emails[1][1]], None, 1)
+            with self.conn:
+                last_id = smtpy_db.insert_mails(self.conn, [emails[2][1]], None, 1)
+        self.assertEqual(compress.call_count, 1)
+
+        self.assertEqual(self.conn.execute('SELECT Compressed, RefCount, LENGTH(Data) < ? FROM MailBlob',
+                                           (len(self.DATA),)).fetchall(), [(1, 3, 1)])
+        for mail_log_id, (raw, row) in zip(range(last_id - 2, last_id + 1), emails):
+            self.assertEqual(smtpy_db.read_raw_message(self.conn, mail_log_id), raw)
+
+    def test_below_threshold(self):
+        raw, row = attachment_row('Small', self.DATA)
+        with self.conn:
+            mail_log_id = smtpy_db.insert_mails(self.conn, [row], None, len(self.DATA) + 1)
+        self.assertEqual(self.conn.execute('SELECT Compressed, Data FROM MailBlob').fetchall(), [(None, self.DATA)])
+        self.assertEqual(smtpy_db.read_raw_message(self.conn, mail_log_id), raw)
+
+    def test_writer(self):
+        writer = smtpy_db.MailWriter(self.database, compress_threshold=1)
+        try:
+            raw, row = attachment_row('Written', self.DATA)
+            writer.write_batch([row])
+        finally:
+            writer.close()
+        self.assertEqual(self.conn.execute('SELECT Compressed FROM MailBlob').fetchall(), [(1,)])
+
+    def test_memory_store(self):
+        store = smtpy_storage.MemoryStore(compress_threshold=1)
+        raw, row = attachment_row('Memory', self.DATA)
+        mail_log_id = store.store([row])
+        attachment = store.mails[mail_log_id].row[smtpy_db.ROW_ATTACHMENTS][0]
+        self.assertEqual(attachment[smtpy_db.ATTACHMENT_COMPRESSED], 1)
+        with contextlib.ExitStack() as stack:
+            file, offset, size = store.open_raw(mail_log_id, stack)
+            self.assertEqual(file.read(), raw)
+
+
+class TestBackgroundThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+        smtpy_db.create_schema(self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Only the writer draining the queue keeps its high-water mark, not those putting
+    # emails onto it from elsewhere (eg: the SMTP workers)
+    def test_high_water_mark(self):
+        mail_queue = queue.Queue()
+        worker = smtpy_db.MailWriter(self.database, mail_queue=mail_queue)
+        for i in range(5):
+            worker.put(mail_row('Email %d' % i))
+        self.assertEqual(worker.high_water_mark, 0)
+
+        writer = smtpy_db.MailWriter(self.database, mail_queue=mail_queue, batch_size=100)
+        writer.start()
+        writer.stop()
+        self.assertEqual(writer.high_water_mark, 5)
+        self.assertEqual(worker.high_water_mark, 0)
+
+    def test_on_sweep(self):
+        writer = smtpy_db.MailWriter(self.database)
+        try:
+            writer.write_batch([mail_row('One'), mail_row('Two')])
+        finally:
+            writer.close()
+        time.sleep(0.01)
+
+        swept = threading.Event()
+        purged = []
+        def on_sweep(deleted):
+            purged.append(deleted)
+            swept.set()
+
+        sweeper = smtpy_db.MailSweeper(self.database, max_age_minutes=0, interval=0.01, on_sweep=on_sweep)
+        sweeper.start()
+        try:
+            self.assertTrue(swept.wait(10))
+        finally:
+            sweeper.stop()
+        self.assertEqual(purged[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+"""
+Tests for smtpy_mime, checking what is parsed from awkward emails, and that each
+attachment found can be taken out of the email and put back (see smtpy_db), so
+the raw message read back is exactly the email as it was received.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import shutil
+import base64
+import tempfile
+import unittest
+import smtpy_db
+import smtpy_mime
+
+
+PDF = base64.encodebytes(b'%PDF-1.4 not really a pdf ' * 8)
+PNG = base64.encodebytes(b'\x89PNG\r\n\x1a\n' + bytes(range(256)))
+
+
+# Joins the lines of an email with CRLFs, ending with one as an email sent over SMTP does
+def crlf(*lines):
+    return ''.join(line + '\r\n' for line in lines).encode('utf-8')
+
+
+# Returns the base64 of some bytes as the lines of a part's body
+def base64_lines(data):
+    return data.decode('ascii').splitlines()
+
+
+class MimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+        smtpy_db.create_schema(self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Parses an email, checking each attachment's content is where it says it is
+    def parse(self, raw, contents):
+        mail = smtpy_mime.parse(raw)
+        self.assertEqual(mail.raw, raw)
+        self.assertEqual(mail.size, len(raw))
+        self.assertEqual([raw[a.start:a.end] for a in mail.attachments], contents)
+        return mail
+
+    # Stores an email with its attachments taken out of it, and checks the raw
+    # message read back is the email as it was received
+    def assert_round_trip(self, mail):
+        raw, attachments = smtpy_db.extract_attachments(mail.raw, mail.attachments, 1)
+        self.assertEqual(len(attachments), len(mail.attachments))
+        self.assertEqual(len(raw), len(mail.raw) - sum(a.end - a.start for a in mail.attachments))
+
+        row = (u'127.0.0.1', 25, mail.subject, 'from@domain.com', "['to@domain.com']", mail.body,
+               mail.message_id, mail.to, mail.cc, mail.date, mail.content_type,
+               mail.html_body, mail.size, raw, None, attachments)
+        conn = smtpy_db.connect(self.database)
+        try:
+            with conn:
+                mail_log_id = smtpy_db.insert_mails(conn, [row])
+            self.assertEqual(smtpy_db.read_raw_message(conn, mail_log_id), mail.raw)
+        finally:
+            conn.close()
+
+
+class TestNestedMultipart(MimeTestCase):
+
+    def test_parts_within_parts(self):
+        raw = crlf(
+            'Subject: Nested',
+            'Content-Type: multipart/mixed; boundary="outer"',
+            '',
+            'This is a multi-part message in MIME format.',
+            '--outer',
+            'Content-Type: multipart/related; boundary="related"',
+            '',
+            '--related',
+            'Content-Type: multipart/alternative; boundary=alt',
+            '',
+            '--alt',
+            'Content-Type: text/plain; charset=utf-8',
+            '',
+            'Hello in text',
+            '--alt',
+            'Content-Type: text/html; charset=utf-8',
+            '',
+            '<p>Hello in <img src="cid:logo@x"></p>',
+            '--alt--',
+            '--related',
+            'Content-Type: image/png',
+            'Content-Transfer-Encoding: base64',
+            'Content-ID: <logo@x>',
+            '',
+            *base64_lines(PNG),
+            '--related--',
+            '--outer',
+            'Content-Type: application/pdf; name="invoice.pdf"',
+            'Content-Disposition: attachment; filename="invoice.pdf"',
+            'Content-Transfer-Encoding: base64',
+            '',
+            *base64_lines(PDF),
+            '--outer--',
+            'The epilogue.')
+
+        mail = self.parse(raw, [PNG.replace(b'\n', b'\r\n').rstrip(b'\r\n'),
+                                PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')])
+        self.assertEqual(mail.body, 'Hello in text')
+        self.assertEqual(mail.html_body, '<p>Hello in <img src="cid:logo@x"></p>')
+        self.assertEqual([(a.filename, a.content_type, a.content_id, a.transfer_encoding) for a in mail.attachments],
+                         [(None, 'image/png', '<logo@x>', 'base64'),
+                          ('invoice.pdf', 'application/pdf', None, 'base64')])
+        self.assert_round_trip(mail)
+
+
+class TestBoundaryInBody(MimeTestCase):
+
+    def test_boundary_not_on_its_own_line(self):
+        raw = crlf(
+            'Subject: Boundaries',
+            'Content-Type: multipart/mixed; boundary="abc"',
+            '',
+            '--abc',
+            'Content-Type: text/plain',
+            '',
+            'A line mentioning --abc in passing,',
+            '--abcdef is a longer boundary, so not this one,',
+            ' --abc is indented, so not a boundary either',
+            '--abc',
+            'Content-Type: text/csv',
+            'Content-Disposition: attachment; filename=data.csv',
+            '',
+            'a,b',
+            '--abc,--abc',
+            '--abc--')
+
+        mail = self.parse(raw, [b'a,b\r\n--abc,--abc'])
+        self.assertEqual(mail.body, 'A line mentioning --abc in passing,\n'
+                                    '--abcdef is a longer boundary, so not this one,\n'
+                                    ' --abc is indented, so not a boundary either')
+        self.assertEqual(mail.attachments[0].filename, 'data.csv')
+        self.assert_round_trip(mail)
+
+
+class TestMissingClosingBoundary(MimeTestCase):
+
+    def test_last_part_runs_to_the_end(self):
+        raw = crlf(
+            'Subject: Cut short',
+            'Content-Type: multipart/mixed; boundary=b1',
+            '',
+            '--b1',
+            'Content-Type: text/plain',
+            '',
+            'The body',
+            '--b1',
+            'Content-Type: application/pdf',
+            'Content-Disposition: attachment; filename="cut.pdf"',
+            'Content-Transfer-Encoding: base64',
+            '',
+            *base64_lines(PDF))
+
+        # The CRLF ending the email isn't part of the last part
+        mail = self.parse(raw, [PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')])
+        self.assertEqual(mail.body, 'The body')
+        self.assertEqual(mail.attachments[0].filename, 'cut.pdf')
+        self.assert_round_trip(mail)
+
+
+class TestFoldedAndEncodedHeaders(MimeTestCase):
+
+    def test_headers_are_unfolded_and_decoded(self):
+        raw = crlf(
+            # The whitespace between encoded-words isn't part of the subject
+            'Subject: =?utf-8?q?Caf=C3=A9_?=',
+            ' =?utf-8?b?w6AgbGEgY2FydGU=?=',
+            'To: =?iso-8859-1?q?J=F6rg?= <jorg@domain.com>,',
+            '\tanother@domain.com',
+            'Content-Type: multipart/mixed;',
+            '\tboundary="folded"',
+            '',
+            '--folded',
+            'Content-Type: text/plain;',
+            ' charset=iso-8859-1',
+            'Content-Transfer-Encoding: quoted-printable',
+            '',
+            'Men=FC du jour',
+            '--folded',
+            'Content-Type: application/pdf',
+            'Content-Disposition: attachment;',
+            ' filename="=?utf-8?q?men=C3=BC.pdf?="',
+            'Content-Transfer-Encoding: base64',
+            '',
+            *base64_lines(PDF),
+            '--folded--')
+
+        mail = self.parse(raw, [PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')])
+        self.assertEqual(mail.subject, 'Café à la carte')
+        self.assertEqual(mail.to, 'Jörg <jorg@domain.com>,\tanother@domain.com')
+        self.assertEqual(mail.content_type, 'multipart/mixed;\tboundary="folded"')
+        self.assertEqual(mail.body, 'Menü du jour')
+        self.assertEqual(mail.attachments[0].filename, 'menü.pdf')
+        self.assert_round_trip(mail)
+
+
+class TestRfc2231Filenames(MimeTestCase):
+
+    def test_extended_parameters(self):
+        raw = crlf(
+            'Subject: Filenames',
+            'Content-Type: multipart/mixed; boundary=x',
+            '',
+            '--x',
+            'Content-Type: text/plain',
+            '',
+            'See attached',
+            '--x',
+            'Content-Type: application/pdf',
+            "Content-Disposition: attachment; filename*=utf-8''na%C3%AFve%20r%C3%A9sum%C3%A9.pdf",
+            'Content-Transfer-Encoding: base64',
+            '',
+            *base64_lines(PDF),
+            '--x',
+            "Content-Type: text/plain; name*=iso-8859-1'en'%A3%20prices.txt",
+            '',
+            'price list',
+            '--x--')
+
+        mail = self.parse(raw, [PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n'), b'price list'])
+        self.assertEqual(mail.body, 'See attached')
+        self.assertEqual([a.filename for a in mail.attachments], ['naïve résumé.pdf', '£ prices.txt'])
+        self.assert_round_trip(mail)
+
+
+class TestLineEndings(MimeTestCase):
+
+    LINES = (
+        'Subject: Line endings',
+        'Content-Type: multipart/mixed; boundary="le"',
+        '',
+        '--le',
+        'Content-Type: text/plain',
+        '',
+        'First line',
+        'Second line',
+        '--le',
+        'Content-Type: application/pdf',
+        'Content-Disposition: attachment; filename="le.pdf"',
+        'Content-Transfer-Encoding: base64',
+        '',
+        *base64_lines(PDF),
+        '--le--')
+
+    def test_crlf(self):
+        mail = self.parse(crlf(*self.LINES), [PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')])
+        self.assertEqual(mail.body, 'First line\nSecond line')
+        self.assert_round_trip(mail)
+
+    def test_lf(self):
+        raw = crlf(*self.LINES).replace(b'\r\n', b'\n')
+        mail = self.parse(raw, [PDF.rstrip(b'\n')])
+        self.assertEqual(mail.body, 'First line\nSecond line')
+        self.assertEqual(mail.attachments[0].filename, 'le.pdf')
+        self.assert_round_trip(mail)
+
+    def test_mixed(self):
+        raw = crlf(*self.LINES[:8]).replace(b'\r\n', b'\n') + crlf(*self.LINES[8:])
+        mail = self.parse(raw, [PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')])
+        self.assertEqual(mail.body, 'First line\nSecond line')
+        self.assert_round_trip(mail)
+
+
+class TestSpooledFile(MimeTestCase):
+
+    RAW = crlf(
+        'Subject: Spooled',
+        'Content-Type: multipart/mixed; boundary="sp"',
+        '',
+        '--sp',
+        'Content-Type: text/plain',
+        '',
+        'Too big for memory',
+        '--sp',
+        'Content-Type: application/pdf',
+        'Content-Disposition: attachment; filename="big.pdf"',
+        'Content-Transfer-Encoding: base64',
+        '',
+        *base64_lines(PDF),
+        '--sp--')
+
+    # An email spooled to a file is parsed through a map of it, which outlives the file
+    def spool(self):
+        spool = tempfile.TemporaryFile()
+        spool.write(self.RAW)
+        spool.seek(0)
+        try:
+            return smtpy_mime.parse(spool)
+        finally:
+            spool.close()
+
+    def test_parsed_from_the_file(self):
+        mail = self.spool()
+        try:
+            self.assertNotIsInstance(mail.raw, bytes)
+            self.assertEqual(mail.raw[:], self.RAW)
+            self.assertEqual(mail.size, len(self.RAW))
+            self.assertEqual(mail.body, 'Too big for memory')
+            self.assertEqual(mail.attachments[0].filename, 'big.pdf')
+        finally:
+            mail.raw.close()
+
+    # The raw message and attachment are copied from the map as they're stored
+    def test_stored_from_the_file(self):
+        for threshold in (0, 1):
+            mail = self.spool()
+            raw, attachments = smtpy_db.extract_attachments(mail.raw, mail.attachments, threshold)
+            row = (u'127.0.0.1', 25, mail.subject, 'from@domain.com', 'to@domain.com', mail.body,
+                   None, None, None, None, mail.content_type, None, mail.size, raw, None, attachments)
+            self.assertIsInstance(raw, smtpy_db.SpooledData)
+            self.assertEqual(len(attachments), threshold)
+
+            conn = smtpy_db.connect(self.database)
+            try:
+                with conn:
+                    mail_log_id = smtpy_db.insert_mails(conn, [row])
+                smtpy_db.close_row(row)
+                self.assertTrue(mail.raw.closed)
+                self.assertEqual(smtpy_db.read_raw_message(conn, mail_log_id), self.RAW)
+            finally:
+                conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+"""
+Tests for smtpy_segments, checking the sweeper only ever deletes segments no email
+uses any more, and never the one the writer is appending to, which the sweeper's
+own SegmentLog knows nothing of.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import copy
+import shutil
+import tempfile
+import unittest
+import smtpy_db
+import smtpy_segments
+import smtpy_config as config
+
+
+SEGMENT_SIZE = 100
+
+
+class TestDrop(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = smtpy_segments.SegmentLog(self.directory, SEGMENT_SIZE, sync=False)
+        self.sweeper = smtpy_segments.SegmentLog(self.directory, SEGMENT_SIZE, sync=False)
+
+    def tearDown(self):
+        self.writer.close()
+        self.sweeper.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Appends a segment's worth, so the next append starts a new segment
+    def fill(self):
+        return self.writer.append([b'x' * SEGMENT_SIZE])[0]
+
+    def test_keeps_the_writers_segment(self):
+        for _ in range(3):
+            self.fill()
+        self.assertEqual(self.sweeper.drop(self.sweeper.segment_ids(), None), 2)
+        self.assertEqual(self.sweeper.segment_ids(), [3])
+
+        # The writer carries on appending to it
+        segment, offset, length = self.writer.append([b'more'])[0]
+        self.assertEqual(segment, 4)
+        self.assertEqual(smtpy_segments.read(self.directory, 3, 0, SEGMENT_SIZE), b'x' * SEGMENT_SIZE)
+
+    def test_keeps_used_segments(self):
+        for _ in range(4):
+            self.fill()
+        self.assertEqual(self.sweeper.drop(self.sweeper.segment_ids(), 2), 1)
+        self.assertEqual(self.sweeper.segment_ids(), [2, 3, 4])
+
+    # Only the segments listed before first_used was looked up are dropped, so any
+    # the writer has started since, and the one it had been appending to, are kept
+    def test_listed_before_the_writer_moved_on(self):
+        self.fill()
+        self.fill()
+        ids = self.sweeper.segment_ids()
+        self.fill()
+        self.assertEqual(self.sweeper.drop(ids, None), 1)
+        self.assertEqual(self.sweeper.segment_ids(), [2, 3])
+
+    def test_nothing_to_drop(self):
+        self.assertEqual(self.sweeper.drop(self.sweeper.segment_ids(), None), 0)
+        self.fill()
+        self.assertEqual(self.sweeper.drop(self.sweeper.segment_ids(), None), 0)
+        self.assertEqual(self.sweeper.segment_ids(), [1])
+
+
+class TestSweeper(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'smtpy.db')
+        self.settings = copy.deepcopy(config.settings)
+        config.settings['storage'].update(segment_directory=os.path.join(self.directory, 'segments'),
+                                          segment_size_mb=SEGMENT_SIZE / (1024.0 * 1024.0))
+        smtpy_db.create_schema(self.database)
+
+    def tearDown(self):
+        config.settings.clear()
+        config.settings.update(self.settings)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_drop_segments(self):
+        writer = smtpy_db.MailWriter(self.database, segments=smtpy_db.segment_log())
+        sweeper = smtpy_db.MailSweeper(self.database, segments=smtpy_db.segment_log())
+        try:
+            raws = [('Subject: %d\r\n\r\n' % i).encode('ascii') + b'x' * SEGMENT_SIZE for i in range(4)]
+            for raw in raws:
+                writer.write_batch([('127.0.0.1', 25, 'Email', 'from@domain.com', ['to@domain.com'], 'body',
+                                     None, None, None, None, None, None, len(raw), raw)])
+            self.assertEqual(writer.segments.segment_ids(), [1, 2, 3, 4])
+
+            conn = smtpy_db.connect(self.database)
+            try:
+                with conn:
+                    conn.execute('DELETE FROM MailLog WHERE MailLogId < 3')
+                self.assertEqual(sweeper.drop_segments(), 2)
+                self.assertEqual(writer.segments.segment_ids(), [3, 4])
+                self.assertEqual([smtpy_db.read_raw_message(conn, i) for i in (3, 4)], raws[2:])
+
+                # Once no email uses any, all but the writer's are dropped
+                with conn:
+                    conn.execute('DELETE FROM MailLog')
+                self.assertEqual(sweeper.drop_segments(), 1)
+                self.assertEqual(writer.segments.segment_ids(), [4])
+            finally:
+                conn.close()
+        finally:
+            writer.close()
+            sweeper.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+"""
+Tests for smtpy_storage, running the same cases against both the SQLite and the
+in-memory stores so the API answers alike whichever one it's reading from; and
+checking the in-memory store evicts its least recently used emails.
+
+Run from the repository's root with: python -m unittest discover tests
+
+Copyright (c) 2015, Matthew Kelly (Badgerati)
+Company: Cadaeic Studios
+License: MIT (see LICENSE for details)
+"""
+
+import os
+import time
+import base64
+import shutil
+import tempfile
+import unittest
+import contextlib
+import smtpy_db
+import smtpy_mime
+import smtpy_storage
+from unittest import mock
+
+
+PDF = base64.encodebytes(b'%PDF-1.4 not really a pdf ' * 8)
+
+
+# Returns an email with a PDF attached, as it was received
+def mail_with_attachment(subject):
+    lines = ['Subject: ' + subject,
+             'Content-Type: multipart/mixed; boundary="b"',
+             '',
+             '--b',
+             'Content-Type: text/plain',
+             '',
+             'Please find the invoice attached',
+             '--b',
+             'Content-Type: application/pdf; name="invoice.pdf"',
+             'Content-Disposition: attachment; filename="invoice.pdf"',
+             'Content-Transfer-Encoding: base64',
+             ''] + PDF.decode('ascii').splitlines() + ['--b--']
+    return ''.join(line + '\r\n' for line in lines).encode('ascii')
+
+
+# Returns the row of a received email, as the smtp service queues it to be stored
+def received_row(raw, sender='from@domain.com', recipients=('to@domain.com',), threshold=0):
+    mail = smtpy_mime.parse(raw)
+    raw, attachments = smtpy_db.extract_attachments(mail.raw, mail.attachments, 1)
+    return smtpy_db.compress_row(('127.0.0.1', 25, mail.subject, sender, list(recipients), mail.body,
+                                  mail.message_id, mail.to, mail.cc, mail.date, mail.content_type,
+                                  mail.html_body, mail.size, raw, None, attachments), threshold)
+
+
+# Returns the row of an email created through the API
+def created_row(subject, sender='from@domain.com', recipients='to@domain.com', body='body'):
+    return ('127.0.0.1', '1234', subject, sender, recipients, body)
+
+
+# The cases run against each store, which subclasses open with open_store()
+class StoreCases(object):
+
+    def setUp(self):
+        self.store = self.open_store()
+
+    def tearDown(self):
+        self.store.close()
+
+    def ids(self, values):
+        return [value['MailLogId'] for value in values]
+
+    def test_get(self):
+        raw = mail_with_attachment('Invoice')
+        mail_log_id = self.store.store([received_row(raw, recipients=['To@Domain.com', 'cc@other.com'])])
+        value = self.store.get(mail_log_id)
+
+        self.assertEqual(value['MailLogId'], mail_log_id)
+        self.assertEqual(value['PortNumber'], '25')
+        self.assertEqual((value['Subject'], value['Sender'], value['Body']),
+                         ('Invoice', 'from@domain.com', 'Please find the invoice attached'))
+        self.assertEqual(value['Recipients'], str(['To@Domain.com', 'cc@other.com']))
+        self.assertEqual(value['Size'], len(raw))
+        self.assertRegex(value['TimeStamp'], r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+        self.assertIsNone(self.store.get(mail_log_id + 1))
+
+    def test_query(self):
+        ids = [self.store.store([created_row('One', recipients='a@one.com')]),
+               self.store.store([created_row('Two', sender='other@domain.com', recipients=str(['B@Two.com', 'a@one.com']))]),
+               self.store.store([created_row('Three', recipients='c@two.com')])]
+
+        self.assertEqual(self.ids(self.store.query(sender='from@domain.com', amount=10)), [ids[2], ids[0]])
+        self.assertEqual(self.ids(self.store.query(sender='from@domain.com')), [ids[2]])
+        self.assertEqual(self.ids(self.store.query(recipient='A@One.com', amount=10)), [ids[1], ids[0]])
+        self.assertEqual(self.ids(self.store.query(recipient='b@two.com', amount=10)), [ids[1]])
+        self.assertEqual(self.ids(self.store.query(domain='TWO.com', amount=10)), [ids[2], ids[1]])
+        self.assertEqual(self.ids(self.store.query(recipient='a@one.com', after=ids[0], amount=10)), [ids[1]])
+        self.assertEqual(self.store.query(sender='nobody@domain.com', amount=10), [])
+        with self.assertRaises(ValueError):
+            self.store.query(amount=10)
+
+    def test_summaries(self):
+        ids = [self.store.store([created_row('One')]),
+               self.store.store([created_row('Two', sender='other@domain.com', recipients='b@domain.com')]),
+               self.store.store([created_row('Three', body='12345')])]
+
+        self.assertEqual(self.store.last_id(), ids[2])
+        self.assertEqual(self.ids(self.store.summaries(0)), ids)
+        self.assertEqual(self.ids(self.store.summaries(ids[0], amount=1)), [ids[1]])
+        self.assertEqual(self.ids(self.store.summaries(0, sender='from@domain.com')), [ids[0], ids[2]])
+        self.assertEqual(self.ids(self.store.summaries(0, recipient='B@Domain.com')), [ids[1]])
+        self.assertEqual(self.store.summaries(ids[1])[0],
+                         {'MailLogId': ids[2], 'Sender': 'from@domain.com', 'Recipients': 'to@domain.com',
+                          'Subject': 'Three', 'Size': 5})
+
+    # Only cases both stores search alike: an email having every word searched for
+    def test_search(self):
+        ids = [self.store.store([created_row('Reset your password', body='Click the link')]),
+               self.store.store([created_row('Welcome', body='Your password is set')]),
+               self.store.store([created_row('Receipt', body='Sent to from@domain.com')])]
+
+        self.assertEqual(self.ids(self.store.search('reset password')), [ids[0]])
+        self.assertEqual(self.ids(self.store.search('WELCOME')), [ids[1]])
+        self.assertEqual(sorted(self.ids(self.store.search('password'))), ids[:2])
+        self.assertEqual(len(self.store.search('password', 1)), 1)
+        self.assertEqual(self.ids(self.store.search('from@domain.com')), [ids[2]])
+        self.assertEqual(self.store.search('nothing'), [])
+
+    def test_attachments(self):
+        raws = [mail_with_attachment('First'), mail_with_attachment('Second')]
+        ids = [self.store.store([received_row(raw)]) for raw in raws]
+
+        attachments = [self.store.attachments(mail_log_id) for mail_log_id in ids]
+        self.assertEqual(len(attachments[0]), 1)
+        self.assertEqual(attachments[0], attachments[1])
+        attachment = attachments[0][0]
+        self.assertEqual((attachment['FileName'], attachment['ContentType'], attachment['ContentId'],
+                          attachment['TransferEncoding']), ('invoice.pdf', 'application/pdf', None, 'base64'))
+        self.assertEqual(attachment['Size'], len(PDF.replace(b'\n', b'\r\n').rstrip(b'\r\n')))
+        self.assertEqual(self.store.attachments(ids[1] + 1), [])
+
+        # The raw message is put back together as it was received
+        for mail_log_id, raw in zip(ids, raws):
+            with contextlib.ExitStack() as stack:
+                file, offset, size = self.store.open_raw(mail_log_id, stack)
+                stack.callback(file.close)
+                file.seek(offset)
+                self.assertEqual(file.read(size), raw)
+
+    def test_compressed(self):
+        raw = mail_with_attachment('Compressed')
+        mail_log_id = self.store.store([received_row(raw, threshold=1)])
+        self.assertEqual(self.store.get(mail_log_id)['Body'], 'Please find the invoice attached')
+        with contextlib.ExitStack() as stack:
+            file, offset, size = self.store.open_raw(mail_log_id, stack)
+            stack.callback(file.close)
+            file.seek(offset)
+            self.assertEqual(file.read(size), raw)
+
+    def test_delete(self):
+        ids = [self.store.store([created_row('One')]),
+               self.store.store([created_row('Two', sender='other@domain.com')]),
+               self.store.store([created_row('Three')])]
+
+        self.store.delete(mail_log_id=ids[1])
+        self.assertIsNone(self.store.get(ids[1]))
+        self.assertEqual(self.ids(self.store.query(domain='domain.com', amount=10)), [ids[2], ids[0]])
+
+        self.store.delete(sender='from@domain.com')
+        self.assertEqual(self.store.query(domain='domain.com', amount=10), [])
+        self.assertEqual(self.store.search('one'), [])
+        self.assertEqual(self.store.summaries(0), [])
+
+    def test_purge(self):
+        old = self.store.store([created_row('Old')])
+        time.sleep(0.05)
+        cutoff = time.time()
+        time.sleep(0.05)
+        new = self.store.store([created_row('New')])
+
+        with mock.patch('time.time', return_value=cutoff + 30 * 60):
+            self.assertEqual(self.store.purge(30), 1)
+        self.assertIsNone(self.store.get(old))
+        self.assertEqual(self.ids(self.store.query(sender='from@domain.com', amount=10)), [new])
+
+    def test_subscribe(self):
+        published = []
+        self.store.subscribe(published.extend)
+        last_id = self.store.store([created_row('One'), created_row('Two', recipients='b@domain.com')])
+        self.assertEqual(published, [(last_id - 1, 'from@domain.com', 'to@domain.com'),
+                                     (last_id, 'from@domain.com', 'b@domain.com')])
+
+
+class TestSqliteStore(StoreCases, unittest.TestCase):
+
+    def open_store(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        store = smtpy_storage.SqliteStore(os.path.join(self.directory, 'smtpy.db'), threads=2)
+        store.create_schema()
+        return store
+
+
+class TestMemoryStore(StoreCases, unittest.TestCase):
+
+    def open_store(self):
+        return smtpy_storage.MemoryStore()
+
+
+class TestMemoryStoreEviction(unittest.TestCase):
+
+    def test_max_emails(self):
+        store = smtpy_storage.MemoryStore(max_emails=3)
+        ids = [store.store([created_row('Email %d' % i)]) for i in range(3)]
+
+        # Reading an email counts as using it, as does it being returned by a query
+        store.get(ids[0])
+        store.store([created_row('Email 3')])
+        self.assertIsNone(store.get(ids[1]))
+
+        store.query(recipient='to@domain.com', amount=1)
+        store.get(ids[2])
+        last = store.store([created_row('Email 4')])
+        self.assertIsNone(store.get(ids[0]))
+        self.assertEqual(sorted(store.mails), [ids[2], last - 1, last])
+        self.assertEqual(store.by_sender['from@domain.com'].keys(), store.mails.keys())
+
+    def test_max_bytes(self):
+        store = smtpy_storage.MemoryStore(max_bytes=300)
+        first = store.store([created_row('First', body='x' * 100)])
+        second = store.store([created_row('Second', body='y' * 100)])
+        third = store.store([created_row('Third', body='z' * 100)])
+        self.assertEqual(sorted(store.mails), [second, third])
+        self.assertLessEqual(store.bytes, 300)
+
+        # The last email stored is kept, however large
+        huge = store.store([created_row('Huge', body='h' * 1000)])
+        self.assertEqual(list(store.mails), [huge])
+        self.assertIsNone(store.get(first))
+
+    def test_deleted_recipients_unindexed(self):
+        store = smtpy_storage.MemoryStore(max_emails=1)
+        store.store([created_row('One', recipients='a@one.com')])
+        store.store([created_row('Two', recipients='b@two.com')])
+        self.assertEqual((list(store.by_address), list(store.by_domain)), (['b@two.com'], ['two.com']))
+
+
+if __name__ == '__main__':
+    unittest.main()